@@ -1,19 +1,18 @@
-from flask import Flask, jsonify, request, send_from_directory, redirect, url_for, session
+from flask import Flask, jsonify, request, send_from_directory, redirect, url_for, session, abort
 from flask_cors import CORS
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask_jwt_extended import jwt_required, create_access_token, get_jwt_identity
 from extensions import db, jwt
 from datetime import datetime, timedelta
 from models import QRCode, Scan
+from redirect_cache import resolve_short_code, remove_short_code, load_short_codes, LookupUnavailable
+from scan_writer import scan_writer
+from scan_capture import record_scan, with_scan_token
+from server_timing import stage, timed
 import os
 import logging
 from dotenv import load_dotenv
 from pathlib import Path
-import qrcode
-from io import BytesIO
-import base64
-import uuid
-import geoip2.database
 from user_agents import parse
 from sqlalchemy import text, inspect
 from functools import wraps
@@ -129,6 +128,10 @@ def create_app():
     app.register_blueprint(folders_bp, url_prefix='/api/folders')
     from routes.qrcodes_stats import bp as qrcodes_stats_bp
     app.register_blueprint(qrcodes_stats_bp, url_prefix='/api/qrcodes')
+    from routes.ingest import bp as ingest_bp
+    app.register_blueprint(ingest_bp, url_prefix='/api/scans')
+    from routes.beacon import bp as beacon_bp
+    app.register_blueprint(beacon_bp, url_prefix='/api')
     
     # Configure CORS for production: only allow frontend domain and /api/*
     CORS(app, resources={
@@ -143,95 +146,33 @@ def create_app():
     # Create tables if they don't exist
     with app.app_context():
         db.create_all()
+        load_short_codes()
+
+    # Scans are written in batches by a background thread per worker
+    scan_writer.init_app(app)
         
     # Add health check endpoint
     @app.route('/api/health')
     def health_check():
         return jsonify({"status": "healthy"}), 200
 
-    # Add QR code creation endpoint
-    @app.route('/api/qrcodes', methods=['POST'])
-    @jwt_required()
-    def create_qrcode():
-        data = request.get_json()
-        if not data or not data.get('target_url'):
-            return jsonify({"msg": "Target URL is required"}), 400
-        
-        # Generate short code
-        short_code = str(uuid.uuid4())[:8]
-        
-        # Create QR code
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data['target_url'])
-        qr.make(fit=True)
-        
-        # Generate QR code image
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Save QR code to database
-        qr_code = QRCode(
-            name=data.get('name', 'Untitled'),
-            target_url=data['target_url'],
-            short_code=short_code,
-            folder=data.get('folder')
-        )
-        
-        db.session.add(qr_code)
-        db.session.commit()
-        
-        # Convert image to base64
-        buffered = BytesIO()
-        # Robustly ensure img is a true PIL Image before saving
-        if hasattr(img, "get_image"):
-            img = img.get_image()
-        elif hasattr(img, "to_image"):
-            img = img.to_image()
-        elif not hasattr(img, "save"):
-            import logging
-            logging.error(f"QR make_image returned unexpected type: {type(img)}")
-            raise TypeError(f"QR make_image returned unexpected type: {type(img)}")
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        return jsonify({
-            "id": qr_code.id,
-            "name": qr_code.name,
-            "short_code": qr_code.short_code,
-            "target_url": qr_code.target_url,
-            "folder": qr_code.folder,
-            "created_at": qr_code.created_at.isoformat(),
-            "qr_code_image": f"data:image/png;base64,{img_str}",
-            "short_url": f"{request.host_url}r/{short_code}"
-        }), 201
-    
     # Add short URL redirection endpoint
     @app.route('/r/<short_code>', methods=['GET'])
+    @timed
     def redirect_short_code(short_code):
-        qr_code = QRCode.query.filter_by(short_code=short_code).first_or_404()
+        try:
+            with stage('lookup'):
+                qr_code = resolve_short_code(short_code)
+        except LookupUnavailable:
+            abort(503)
+        if qr_code is None:
+            abort(404)
         
         # Log the scan
-        if request.remote_addr != '127.0.0.1':  # Don't log localhost scans
-            user_agent = parse(request.user_agent.string)
-            
-            scan = Scan(
-                qr_code_id=qr_code.id,
-                ip_address=request.remote_addr,
-                user_agent=request.user_agent.string,
-                device_type=user_agent.device.family,
-                os_family=user_agent.os.family,
-                browser_family=user_agent.browser.family,
-                referrer_domain=request.referrer
-            )
-            
-            db.session.add(scan)
-            db.session.commit()
+        token = record_scan(qr_code.qr_id, request.remote_addr, request.user_agent.string, request.referrer,
+                            request.method)
         
-        return redirect(qr_code.target_url)
+        return redirect(with_scan_token(qr_code.location, token))
     
     # Add QR code listing endpoint
     @app.route('/api/qrcodes', methods=['GET'])
@@ -255,6 +196,7 @@ def create_app():
     @jwt_required()
     def get_qrcode(qrcode_id):
         qr = QRCode.query.get_or_404(qrcode_id)
+        scans = Scan.with_names(Scan.device, Scan.os, Scan.browser, Scan.referrer).filter_by(qr_code_id=qr.id)
         
         return jsonify({
             'id': qr.id,
@@ -271,7 +213,7 @@ def create_app():
                 'os_family': scan.os_family,
                 'browser_family': scan.browser_family,
                 'referrer_domain': scan.referrer_domain
-            } for scan in qr.scans],
+            } for scan in scans],
             'short_url': f"{request.host_url}r/{qr.short_code}"
         })
     
@@ -283,6 +225,7 @@ def create_app():
         
         db.session.delete(qr)
         db.session.commit()
+        remove_short_code(qr.short_code)
         
         return jsonify({"msg": "QR code deleted successfully"}), 200
     
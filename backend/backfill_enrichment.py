@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Re-enrich historical scans with device, OS, browser and GeoIP location.
+
+Scans stored before deferred enrichment (scan_enrichment.py) have no
+location and device fields from older parsers. This walks scans by
+primary key from the start of the table up to the live enrichment
+watermark, in ranges of --range-size ids found by keyset pagination, and
+hands each range to a process pool. Every worker has its own engine,
+User-Agent cache and GeoIP reader, and writes its range back with batched
+UPDATEs of --chunk-size rows, each in its own short transaction.
+
+Progress is checkpointed in the 'backfill' row of enrichment_watermarks:
+the highest id below which every range has finished. An interrupted run
+continues from there; ranges that were in flight are done again, which is
+harmless. --rate caps the scans per second handed to the pool so the
+backfill does not crowd out the redirect service's database work.
+
+    python backfill_enrichment.py --workers 4 --rate 5000
+    python backfill_enrichment.py --restart --until 2500000
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = 'backfill'
+
+_engine = None
+
+
+def _init_worker():
+    global _engine
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from standalone_db import create_standalone_engine
+
+    _engine = create_standalone_engine(pool_size=1, max_overflow=0)
+
+
+def _enrich_range(low, high, chunk_size):
+    from scan_enrichment import scan_enricher
+
+    return scan_enricher.enrich_range(_engine, low, high, chunk_size)
+
+
+class Backfill:
+
+    def __init__(self, engine, workers=2, range_size=5000, chunk_size=500, rate=2000.0):
+        from models import EnrichmentWatermark, Scan
+
+        self.engine = engine
+        self.workers = workers
+        self.range_size = range_size
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self._scans = Scan.__table__
+        self._watermarks = EnrichmentWatermark.__table__
+        self.ranges = 0
+        self.enriched = 0
+
+    def load_checkpoint(self):
+        from sqlalchemy import select
+
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(self._watermarks.c.last_scan_id).where(self._watermarks.c.name == CHECKPOINT)
+            ).scalar()
+
+    def save_checkpoint(self, last_scan_id):
+        from sqlalchemy import func, insert, update
+
+        w = self._watermarks
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                update(w).where(w.c.name == CHECKPOINT).values(last_scan_id=last_scan_id, updated_at=func.now())
+            ).rowcount
+            if not updated:
+                conn.execute(insert(w).values(name=CHECKPOINT, last_scan_id=last_scan_id))
+
+    def default_end(self):
+        """The live enrichment watermark, or the last scan if there is none."""
+        from sqlalchemy import func, select
+
+        from scan_enrichment import WATERMARK
+
+        with self.engine.connect() as conn:
+            end = conn.execute(
+                select(self._watermarks.c.last_scan_id).where(self._watermarks.c.name == WATERMARK)
+            ).scalar()
+            if end is None:
+                end = conn.execute(select(func.coalesce(func.max(self._scans.c.id), 0))).scalar()
+        return end
+
+    def ranges_from(self, after, end):
+        """(low, high] id ranges of up to range_size scans, by keyset pagination."""
+        from sqlalchemy import bindparam, select
+
+        next_boundary = (
+            select(self._scans.c.id)
+            .where(self._scans.c.id > bindparam('after'), self._scans.c.id <= bindparam('end'))
+            .order_by(self._scans.c.id)
+            .offset(self.range_size - 1)
+            .limit(1)
+        )
+        while after < end:
+            with self.engine.connect() as conn:
+                high = conn.execute(next_boundary, {'after': after, 'end': end}).scalar()
+            high = end if high is None else high
+            yield after, high
+            after = high
+
+    def run(self, start, end):
+        started = time.monotonic()
+        submitted = 0
+        pending = deque()
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+        )
+        try:
+            for low, high in self.ranges_from(start, end):
+                # Hold back until the pool is under the --rate budget.
+                delay = submitted / self.rate - (time.monotonic() - started) if self.rate else 0
+                if delay > 0:
+                    time.sleep(delay)
+                pending.append((high, pool.submit(_enrich_range, low, high, self.chunk_size)))
+                submitted += self.range_size
+                while len(pending) >= self.workers * 2 or (pending and pending[0][1].done()):
+                    self._finish(pending.popleft(), started)
+            while pending:
+                self._finish(pending.popleft(), started)
+        finally:
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def _finish(self, item, started):
+        # Ranges complete in order here, so the checkpoint never passes a
+        # range that has not been written.
+        high, future = item
+        self.enriched += future.result()
+        self.ranges += 1
+        self.save_checkpoint(high)
+        elapsed = time.monotonic() - started
+        logger.info("Enriched through scan %d: %d scans, %.0f/s", high, self.enriched, self.enriched / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2, help="enrichment processes")
+    parser.add_argument('--range-size', type=int, default=5000, help="scans per range handed to a worker")
+    parser.add_argument('--chunk-size', type=int, default=500, help="scans per UPDATE transaction")
+    parser.add_argument('--rate', type=float, default=2000, help="max scans per second (0 for no limit)")
+    parser.add_argument('--until', type=int, help="last scan id to enrich (default: the live enrichment watermark)")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the first scan")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from standalone_db import create_standalone_engine
+
+    engine = create_standalone_engine(pool_size=1, max_overflow=1)
+    backfill = Backfill(engine, workers=args.workers, range_size=args.range_size,
+                        chunk_size=args.chunk_size, rate=args.rate)
+    start = 0 if args.restart else (backfill.load_checkpoint() or 0)
+    end = args.until if args.until is not None else backfill.default_end()
+    logger.info("Backfilling scans %d to %d with %d workers", start + 1, end, args.workers)
+    try:
+        backfill.run(start, end)
+    except KeyboardInterrupt:
+        logger.info("Interrupted; the next run resumes from the checkpoint")
+    logger.info("Enriched %d scans in %d ranges", backfill.enriched, backfill.ranges)
+
+
+if __name__ == '__main__':
+    main()
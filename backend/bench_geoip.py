@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Benchmark GeoIP lookups: bare reader versus the /24-/48 prefix cache.
+
+Draws addresses from a fixed set of networks with a skewed (Pareto)
+popularity, like scans clustering on a few carrier and office networks,
+and resolves them with the reader in each memory-mapped mode and through
+GeoLocator. Needs a GeoLite2 City database (update_geolite.py).
+
+    python bench_geoip.py --lookups 200000 --networks 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+
+def addresses(count, networks, seed):
+    rng = random.Random(seed)
+    prefixes = [(rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255)) for _ in range(networks)]
+    result = []
+    for _ in range(count):
+        index = min(int(rng.paretovariate(1.2)) - 1, networks - 1)
+        a, b, c = prefixes[index]
+        result.append(f"{a}.{b}.{c}.{rng.randint(1, 254)}")
+    return result
+
+
+def run(label, lookup, ips):
+    for ip in ips[:1000]:
+        lookup(ip)
+    start = time.perf_counter()
+    for ip in ips:
+        lookup(ip)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {len(ips) / elapsed:>10.0f} lookups/s   {elapsed / len(ips) * 1e6:>6.2f} us/lookup")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help="GeoLite2-City.mmdb (default: GEOIP_DB_PATH or backend/GeoLite2-City.mmdb)")
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--networks', type=int, default=5000, help="distinct /24 networks to draw from")
+    parser.add_argument('--cache-size', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import geoip2.errors
+    import maxminddb
+    from geoip2.database import Reader
+    from geoip_lookup import DEFAULT_GEOIP_PATH, GeoLocator
+
+    path = args.db or os.getenv('GEOIP_DB_PATH', DEFAULT_GEOIP_PATH)
+    if not os.path.exists(path):
+        sys.exit(f"No GeoIP database at {path}; run update_geolite.py or pass --db")
+    ips = addresses(args.lookups, args.networks, args.seed)
+
+    for label, mode in (('reader MODE_MMAP', maxminddb.MODE_MMAP), ('reader MODE_MMAP_EXT', maxminddb.MODE_MMAP_EXT)):
+        try:
+            reader = Reader(path, mode=mode)
+        except ValueError:
+            print(f"{label:<22} unavailable")
+            continue
+
+        def lookup(ip, reader=reader):
+            try:
+                return reader.city(ip)
+            except geoip2.errors.AddressNotFoundError:
+                return None
+
+        run(label, lookup, ips)
+        reader.close()
+
+    locator = GeoLocator(path, cache_size=args.cache_size)
+    run('prefix cache', locator.locate, ips)
+    stats = locator.stats()
+    print(f"prefix cache hit rate {stats['cache_hits'] / (stats['cache_hits'] + stats['cache_misses']):.1%}, "
+          f"{stats['cached_prefixes']} networks cached")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Per-call cost of the hot-path queries, built per call vs prebuilt.
+
+Each query is run both the way it used to be written (an ORM select built
+for every call, and four separate queries plus an ORM load for the stats
+summary) and through the prebuilt Core statements the app now uses, against
+a throwaway SQLite database so the difference is statement construction and
+compilation rather than database work.
+
+    python bench_queries.py --calls 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+
+def run(label, fn, count):
+    for _ in range(min(500, count)):
+        fn()
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed / count * 1e6:>8.1f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--scans', type=int, default=200, help="scan rows for the benchmarked code")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_queries_')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    os.environ.setdefault('SCAN_SPOOL_DIR', os.path.join(tmpdir, 'spool'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    from datetime import datetime
+    from sqlalchemy import func, select
+    from app import app
+    from extensions import db
+    from models import QRCode, Scan, User
+    from redirect_cache import LOOKUP_STATEMENT
+    from routes.qrcodes_stats import QRCODE_STATS_STATEMENT
+    from scan_writer import scan_writer
+    logging.disable(logging.CRITICAL)
+
+    with app.app_context():
+        user = User(email='bench@example.com')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        qrcode = QRCode(name='bench', target_url='https://example.com/landing', short_code='bench01',
+                        user_id=user.id)
+        db.session.add(qrcode)
+        db.session.flush()
+        qrcode_id = qrcode.id
+        db.session.add_all(Scan(qr_code_id=qrcode_id, timestamp=datetime.utcnow(), city=f"city{i % 7}",
+                                country=f"country{i % 3}") for i in range(args.scans))
+        db.session.commit()
+
+        def lookup_orm():
+            db.session.execute(
+                select(QRCode.id, QRCode.target_url).where(QRCode.short_code == 'bench01')).first()
+
+        def lookup_prebuilt():
+            db.session.execute(LOOKUP_STATEMENT, {'short_code': 'bench01'}).first()
+
+        def stats_orm():
+            db.session.get(QRCode, qrcode_id)
+            db.session.query(func.count(Scan.id)).filter(Scan.qr_code_id == qrcode_id).scalar()
+            db.session.query(Scan).filter(Scan.qr_code_id == qrcode_id).order_by(Scan.timestamp.desc()).first()
+            db.session.query(func.count(func.distinct(Scan.city))).filter(Scan.qr_code_id == qrcode_id).scalar()
+            db.session.query(func.count(func.distinct(Scan.country))).filter(Scan.qr_code_id == qrcode_id).scalar()
+            # The ORM load above keeps the object in the identity map.
+            db.session.expunge_all()
+
+        def stats_prebuilt():
+            db.session.execute(QRCODE_STATS_STATEMENT, {'qrcode_id': qrcode_id}).first()
+
+        run('lookup: ORM select per call', lookup_orm, args.calls)
+        run('lookup: prebuilt Core statement', lookup_prebuilt, args.calls)
+        run('stats: 5 ORM queries', stats_orm, args.calls // 10)
+        run('stats: 1 prebuilt Core statement', stats_prebuilt, args.calls // 10)
+    scan_writer.stop()
+
+
+if __name__ == '__main__':
+    main()
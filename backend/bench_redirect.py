@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare the /r/<short_code> route in create_app() with redirect_wsgi.
+
+Runs both WSGI callables in-process against a throwaway SQLite database so
+the numbers reflect per-request framework and lookup overhead rather than
+network or Postgres latency. Scans are queued for the batched writer in
+both cases.
+
+    python bench_redirect.py --requests 20000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def run(label, wsgi_app, path, count):
+    from werkzeug.test import Client
+
+    client = Client(wsgi_app)
+    environ = {
+        'REMOTE_ADDR': '203.0.113.7',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) '
+                           'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+    }
+    for _ in range(min(200, count)):
+        client.get(path, environ_base=environ)
+    timings = []
+    start = time.perf_counter()
+    for _ in range(count):
+        t0 = time.perf_counter()
+        response = client.get(path, environ_base=environ)
+        timings.append(time.perf_counter() - t0)
+        assert response.status_code == 302, response.status_code
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    print(f"{label:<14} {count / elapsed:>10.0f} req/s   "
+          f"p50 {statistics.median(timings) * 1e6:>7.0f} us   "
+          f"p99 {timings[int(len(timings) * 0.99) - 1] * 1e6:>7.0f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=10000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_redirect_')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    os.environ.setdefault('SCAN_SPOOL_DIR', os.path.join(tmpdir, 'spool'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    from app import app
+    from extensions import db
+    from models import QRCode, User
+    from redirect_cache import register_short_code
+    from redirect_wsgi import application
+    from scan_writer import scan_writer
+    logging.disable(logging.CRITICAL)
+
+    with app.app_context():
+        user = User(email='bench@example.com')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        qr = QRCode(name='bench', target_url='https://example.com/landing?campaign=bench',
+                    short_code='bench01', user_id=user.id)
+        db.session.add(qr)
+        db.session.commit()
+        # Both apps loaded the (empty) short-code filter when imported.
+        register_short_code(qr.short_code, qr.id, qr.target_url)
+
+    run('flask app', app, '/r/bench01', args.requests)
+    run('redirect_wsgi', application, '/r/bench01', args.requests)
+    scan_writer.stop()
+
+
+if __name__ == '__main__':
+    main()
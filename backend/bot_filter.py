@@ -0,0 +1,115 @@
+"""Fast classification of bot, monitor and link-preview requests.
+
+Runs on the redirect path before any parsing or database work. User-agent
+signatures live in bot_signatures.txt (or BOT_SIGNATURES_PATH) as
+"<category> <regex>" lines and are compiled into one alternation; the file
+is re-read when its mtime changes. HEAD requests and requests without a
+User-Agent are classified too. Results are memoized per user-agent string,
+since a few thousand distinct strings cover nearly all traffic.
+"""
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIGNATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_signatures.txt')
+
+
+def compile_signatures(lines):
+    """Compile "<category> <regex>" lines into one pattern with a group per line."""
+    alternatives = []
+    categories = {}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        category, _, pattern = line.partition(' ')
+        pattern = pattern.strip()
+        if not pattern:
+            raise ValueError(f"line {number}: expected '<category> <regex>'")
+        re.compile(pattern)
+        group = f"g{len(alternatives)}"
+        alternatives.append(f"(?P<{group}>{pattern})")
+        categories[group] = category
+    if not alternatives:
+        return None, categories
+    return re.compile('|'.join(alternatives), re.IGNORECASE), categories
+
+
+class BotClassifier:
+
+    def __init__(self, path=DEFAULT_SIGNATURES_PATH, check_interval=5.0, cache_size=4096):
+        self.path = path
+        self.check_interval = check_interval
+        self._match = functools.lru_cache(maxsize=cache_size)(self._match_uncached)
+        self._compiled = (None, {})
+        self._mtime = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    compiled = compile_signatures(f)
+            except (OSError, ValueError, re.error):
+                # Keep the signatures that were working.
+                logger.exception("Could not load bot signatures from %s", self.path)
+                self._mtime = mtime
+                return
+            self._compiled = compiled
+            self._match.cache_clear()
+            self._mtime = mtime
+            self.reloads += 1
+            logger.info("Loaded %d bot signatures from %s", len(compiled[1]), self.path)
+
+    def classify(self, user_agent, method='GET'):
+        """Return the bot category for a request, or None for a person."""
+        if method == 'HEAD':
+            return 'head'
+        if not user_agent:
+            return 'empty'
+        self._maybe_reload()
+        return self._match(user_agent)
+
+    def _match_uncached(self, user_agent):
+        pattern, categories = self._compiled
+        if pattern is None:
+            return None
+        match = pattern.search(user_agent)
+        if match is None:
+            return None
+        return categories[match.lastgroup]
+
+    def stats(self):
+        info = self._match.cache_info()
+        return {
+            'signatures': len(self._compiled[1]),
+            'reloads': self.reloads,
+            'cache_hits': info.hits,
+            'cache_misses': info.misses,
+            'cache_size': info.currsize,
+        }
+
+
+bot_classifier = BotClassifier(
+    path=os.getenv('BOT_SIGNATURES_PATH', DEFAULT_SIGNATURES_PATH),
+    check_interval=float(os.getenv('BOT_SIGNATURES_CHECK_INTERVAL', 5)),
+)
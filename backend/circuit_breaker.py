@@ -0,0 +1,91 @@
+"""Circuit breaker guarding database access from the redirect path.
+
+After DB_BREAKER_FAILURES consecutive failures (errors, or calls slower than
+DB_LATENCY_BUDGET seconds) the breaker opens and callers stop touching the
+database: redirects are served from cached target URLs and scans go to the
+local spool. After DB_BREAKER_RESET seconds a single trial call is let
+through; if it succeeds the breaker closes again.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0, latency_budget=0.5):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """Return True if the caller may use the database now."""
+        if self._state == CLOSED:
+            return True
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return self._state == CLOSED
+
+    def record_success(self, elapsed=0.0):
+        if self.latency_budget and elapsed > self.latency_budget:
+            self.record_failure(reason=f"slow call ({elapsed:.3f}s)")
+            return
+        if self._state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("Database circuit breaker closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self, reason=None):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.trips += 1
+                    logger.warning("Database circuit breaker opened%s",
+                                   f": {reason}" if reason else "")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def stats(self):
+        return {
+            'state': self._state,
+            'consecutive_failures': self._failures,
+            'trips': self.trips,
+            'failure_threshold': self.failure_threshold,
+            'reset_timeout': self.reset_timeout,
+            'latency_budget': self.latency_budget,
+        }
+
+
+db_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv('DB_BREAKER_FAILURES', 3)),
+    reset_timeout=float(os.getenv('DB_BREAKER_RESET', 10)),
+    latency_budget=float(os.getenv('DB_LATENCY_BUDGET', 0.5)),
+)
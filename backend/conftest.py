@@ -0,0 +1,37 @@
+"""Test setup: the backend modules import each other as top-level modules.
+
+Tests that need PostgreSQL run against TEST_POSTGRES_URL, a disposable
+database whose tables they create and drop, and are skipped without it.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='accelqr_pytest_'), 'app.db'))
+os.environ.setdefault('SCAN_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'accelqr_pytest_spool'))
+os.environ.setdefault('QR_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'accelqr_pytest_qr_cache'))
+
+collect_ignore = ['test_app.py']  # starts the development server, not a test
+
+
+@pytest.fixture
+def postgres_engine():
+    url = os.getenv('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    from sqlalchemy import create_engine
+
+    from extensions import db
+    import models  # noqa: F401 (registers the tables)
+
+    engine = create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    try:
+        yield engine
+    finally:
+        db.metadata.drop_all(engine)
+        engine.dispose()
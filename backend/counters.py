@@ -0,0 +1,108 @@
+"""In-memory aggregate counters flushed to the database as upserts.
+
+Counts are accumulated per (table, primary key) and written by the scan
+writer thread as INSERT ... ON CONFLICT DO UPDATE SET count = count + n,
+so a counted event costs a dict update in the request and one row per key
+per flush in the database. A table used here needs a composite primary
+key and an integer ``count`` column.
+
+Counts that cannot be written for a while (the database is down, or the
+process is stopping) can be dumped as plain JSON-able lists and loaded back
+later, so the scan writer can keep them in its spool.
+"""
+import threading
+from datetime import date
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def _upsert(dialect_name, table):
+    key_columns = [column.name for column in table.primary_key.columns]
+    module = postgresql if dialect_name == 'postgresql' else sqlite
+    stmt = module.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={'count': table.c.count + stmt.excluded.count},
+    ), key_columns
+
+
+_statements = {}
+
+
+def upsert_counts(conn, table, counts):
+    """Add {primary key tuple: n} to table's count column in one executemany."""
+    cache_key = (conn.dialect.name, table)
+    if cache_key not in _statements:
+        _statements[cache_key] = _upsert(conn.dialect.name, table)
+    stmt, key_columns = _statements[cache_key]
+    conn.execute(stmt, [dict(zip(key_columns, key), count=n) for key, n in counts.items()])
+
+
+class AggregateCounters:
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, table, key, n=1):
+        """Add n to the row of table whose primary key values are key."""
+        with self._lock:
+            counts = self._counts.setdefault(table, {})
+            counts[key] = counts.get(key, 0) + n
+
+    def pending(self):
+        with self._lock:
+            return sum(len(counts) for counts in self._counts.values())
+
+    def take(self):
+        """Remove and return the accumulated {table: {key: n}}."""
+        with self._lock:
+            pending, self._counts = self._counts, {}
+        return pending
+
+    def merge(self, pending):
+        """Add counts returned by take() back in."""
+        with self._lock:
+            for table, counts in pending.items():
+                current = self._counts.setdefault(table, {})
+                for key, n in counts.items():
+                    current[key] = current.get(key, 0) + n
+
+    def flush(self, engine):
+        """Write the accumulated counts; on failure they are kept for the next flush."""
+        pending = self.take()
+        if not pending:
+            return
+        try:
+            with engine.begin() as conn:
+                for table, counts in pending.items():
+                    upsert_counts(conn, table, counts)
+        except Exception:
+            self.merge(pending)
+            raise
+
+
+def dump_counts(pending):
+    """[[table name, [key values], n], ...] for counts returned by take()."""
+    return [
+        [table.name, [value.isoformat() if isinstance(value, date) else value for value in key], n]
+        for table, counts in pending.items()
+        for key, n in counts.items()
+    ]
+
+
+def load_counts(items, metadata):
+    """The inverse of dump_counts(), with tables looked up in metadata."""
+    pending = {}
+    for name, values, n in items:
+        table = metadata.tables[name]
+        key = tuple(
+            date.fromisoformat(value) if column.type.python_type is date and value is not None else value
+            for column, value in zip(table.primary_key.columns, values)
+        )
+        counts = pending.setdefault(table, {})
+        counts[key] = counts.get(key, 0) + n
+    return pending
+
+
+aggregate_counters = AggregateCounters()
@@ -0,0 +1,148 @@
+"""Dictionary-encoded scan dimensions.
+
+Scans store small integer ids instead of repeating the User-Agent, the
+referrer domain and the device, OS and browser names on every row. Each
+distinct value is stored once in its own table (user_agents, referrers,
+device_types, os_families, browser_families). Ids are resolved through a
+per-worker get-or-create cache, so a known value costs no query.
+
+Lookups run inside the caller's transaction. Ids of rows created in it are
+returned but not cached until a later lookup finds them committed, so a
+rolled-back transaction can never leave a dangling id in the cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import BrowserFamily, DeviceType, OsFamily, Referrer, UserAgent
+
+USER_AGENT_MAX = 512
+
+
+def referrer_domain(referrer):
+    """The lower-cased host name of a referrer URL, or None."""
+    if not referrer:
+        return None
+    try:
+        host = urlsplit(referrer if '//' in referrer else '//' + referrer).hostname
+    except ValueError:
+        return None
+    return host[:253] if host else None
+
+
+class Dimension:
+    """Get-or-create ids for the values of one dimension table."""
+
+    def __init__(self, table, max_length, cache_size=10000):
+        self.table = table
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = {}
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+
+    def normalize(self, value):
+        return value[:self.max_length] if value else None
+
+    def ids(self, conn, values):
+        """{value: id} for the (normalized) values, creating missing rows."""
+        found = {}
+        missing = set()
+        with self._lock:
+            for value in values:
+                if value is None or value in found:
+                    continue
+                row_id = self._ids.get(value)
+                if row_id is None:
+                    missing.add(value)
+                else:
+                    self._ids.move_to_end(value)
+                    found[value] = row_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        if not missing:
+            return found
+        committed = self._select(conn, missing)
+        missing.difference_update(committed)
+        if missing:
+            created = dict(conn.execute(self._insert(conn.dialect.name), [{'value': v} for v in missing]).all())
+            self.created += len(created)
+            found.update(created)
+            missing.difference_update(created)
+            if missing:
+                # Created by another worker since the first select.
+                committed.update(self._select(conn, missing))
+        self._remember(committed)
+        found.update(committed)
+        return found
+
+    def _select(self, conn, values):
+        table = self.table
+        return dict(conn.execute(select(table.c.value, table.c.id).where(table.c.value.in_(values))).all())
+
+    def _insert(self, dialect_name):
+        stmt = self._inserts.get(dialect_name)
+        if stmt is None:
+            if dialect_name == 'postgresql':
+                stmt = postgresql.insert(self.table).on_conflict_do_nothing(index_elements=['value'])
+            elif dialect_name == 'sqlite':
+                stmt = sqlite.insert(self.table).on_conflict_do_nothing(index_elements=['value'])
+            else:
+                stmt = insert(self.table)
+            stmt = stmt.returning(self.table.c.value, self.table.c.id)
+            self._inserts[dialect_name] = stmt
+        return stmt
+
+    def _remember(self, ids):
+        with self._lock:
+            self._ids.update(ids)
+            while len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._ids)
+        return {'cached': size, 'hits': self.hits, 'misses': self.misses, 'created': self.created}
+
+
+_cache_size = int(os.getenv('DIMENSION_CACHE_SIZE', 10000))
+user_agents = Dimension(UserAgent.__table__, USER_AGENT_MAX, _cache_size)
+referrers = Dimension(Referrer.__table__, 253, _cache_size)
+device_types = Dimension(DeviceType.__table__, 50, _cache_size)
+os_families = Dimension(OsFamily.__table__, 100, _cache_size)
+browser_families = Dimension(BrowserFamily.__table__, 100, _cache_size)
+
+
+def encode_scan_rows(conn, rows):
+    """Copies of scan rows with user_agent and referrer_domain replaced by
+    user_agent_id and referrer_id."""
+    agents = [user_agents.normalize(row.get('user_agent')) for row in rows]
+    domains = [referrer_domain(row.get('referrer_domain')) for row in rows]
+    agent_ids = user_agents.ids(conn, agents)
+    referrer_ids = referrers.ids(conn, domains)
+    encoded = []
+    for row, agent, domain in zip(rows, agents, domains):
+        row = dict(row)
+        row.pop('user_agent', None)
+        row.pop('referrer_domain', None)
+        row['user_agent_id'] = agent_ids.get(agent)
+        row['referrer_id'] = referrer_ids.get(domain)
+        encoded.append(row)
+    return encoded
+
+
+def stats():
+    return {
+        'user_agents': user_agents.stats(),
+        'referrers': referrers.stats(),
+        'device_types': device_types.stats(),
+        'os_families': os_families.stats(),
+        'browser_families': browser_families.stats(),
+    }
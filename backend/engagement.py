@@ -0,0 +1,120 @@
+"""Coalesced landing-page engagement updates for stored scans.
+
+Beacons report time_on_page and scrolled for a scan token (the scan's
+ingest_key). Reports are merged in memory per token, keeping the longest
+time and whether the page was scrolled at all, and the scan writer thread
+applies them every few seconds as one batched UPDATE. Reports for a scan
+whose row has not been written yet when the batch runs are dropped.
+"""
+import os
+import re
+import threading
+
+from sqlalchemy import Boolean, Integer, String, bindparam, case, column, or_, update, values
+
+from models import Scan
+
+TOKEN = re.compile(r'^[0-9a-f]{32}$')
+MAX_TIME_ON_PAGE = 24 * 60 * 60
+
+_scans = Scan.__table__
+
+
+def _merged_values(time_on_page, scrolled):
+    return {
+        'time_on_page': case(
+            (or_(_scans.c.time_on_page.is_(None), _scans.c.time_on_page < time_on_page), time_on_page),
+            else_=_scans.c.time_on_page,
+        ),
+        'scrolled': or_(_scans.c.scrolled.is_(True), scrolled),
+    }
+
+
+# executemany form, for drivers where that is not one round trip per row anyway.
+_UPDATE_EACH = (
+    update(_scans)
+    .where(_scans.c.ingest_key == bindparam('token'))
+    .values(**_merged_values(bindparam('t', type_=Integer), bindparam('s', type_=Boolean)))
+)
+
+
+def _update_from_values(rows):
+    """A single UPDATE ... FROM (VALUES ...) for PostgreSQL."""
+    reports = values(
+        column('token', String), column('t', Integer), column('s', Boolean), name='reports'
+    ).data([(row['token'], row['t'], row['s']) for row in rows])
+    return (
+        update(_scans)
+        .where(_scans.c.ingest_key == reports.c.token)
+        .values(**_merged_values(reports.c.t, reports.c.s))
+    )
+
+
+class EngagementBuffer:
+
+    def __init__(self, max_tokens=100000):
+        self.max_tokens = max_tokens
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.applied = 0
+
+    def add(self, token, time_on_page=None, scrolled=False):
+        """Merge one report; False if the token is malformed or the buffer is full."""
+        if not isinstance(token, str) or not TOKEN.match(token):
+            return False
+        if time_on_page is not None:
+            time_on_page = max(0, min(int(time_on_page), MAX_TIME_ON_PAGE))
+        scrolled = bool(scrolled)
+        with self._lock:
+            current = self._pending.get(token)
+            if current is None:
+                if len(self._pending) >= self.max_tokens:
+                    self.dropped += 1
+                    return False
+                self._pending[token] = (time_on_page, scrolled)
+            else:
+                seen_time, seen_scrolled = current
+                if seen_time is not None and (time_on_page is None or seen_time > time_on_page):
+                    time_on_page = seen_time
+                self._pending[token] = (time_on_page, seen_scrolled or scrolled)
+            self.received += 1
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, engine):
+        """Apply the merged reports; on failure they are kept for the next flush."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [{'token': token, 't': t, 's': s} for token, (t, s) in pending.items()]
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == 'postgresql':
+                    result = conn.execute(_update_from_values(rows))
+                else:
+                    result = conn.execute(_UPDATE_EACH, rows)
+        except Exception:
+            with self._lock:
+                for token, report in pending.items():
+                    self._pending.setdefault(token, report)
+            raise
+        self.applied += max(result.rowcount, 0)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'received': self.received,
+            'applied': self.applied,
+            'dropped': self.dropped,
+        }
+
+
+engagement_buffer = EngagementBuffer(max_tokens=int(os.getenv('BEACON_BUFFER_MAX', 100000)))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Export every short code as a static redirect map for the front proxy.
+
+Writes an nginx map file and a JSON snapshot of short_code -> target URL so
+the proxy can answer /r/<short_code> itself, with no Python in the request
+path:
+
+    map $qr_short_code $qr_target {
+        include /etc/nginx/accelqr/redirects.map;
+    }
+
+    location ~ ^/r/(?<qr_short_code>[^/]+)$ {
+        if ($qr_target) {
+            access_log /var/log/nginx/qr_scans.log qr_scans;
+            return 302 $qr_target;
+        }
+        proxy_pass http://accelqr_redirect;
+    }
+
+Codes the map does not contain (created after the last export, or with a
+target URL nginx cannot hold literally) fall through to the redirect
+service, which records those scans itself. Scans answered by nginx are
+loaded from its access log by ingest_access_log.py. Large maps need
+map_hash_max_size raised above the number of codes.
+
+nginx compares map strings ignoring case, but short codes are
+case-sensitive. Codes that are the only one of their spelling in any case
+are written as plain strings, which nginx looks up in a hash. Codes that
+share a spelling with another code (aB3 and Ab3) are written as anchored,
+case-sensitive regexes, which nginx tries in order only after the hash
+misses, so each of them gets only its own requests.
+
+Each run after the first only reads QR codes whose updated_at moved since
+the previous snapshot, plus the list of short codes to notice deletions,
+and leaves both files untouched when nothing changed:
+
+    python export_redirect_map.py --map /etc/nginx/accelqr/redirects.map \\
+        --json /etc/nginx/accelqr/redirects.json --watch 5 --reload-command 'nginx -s reload'
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select
+from werkzeug.urls import iri_to_uri
+
+logger = logging.getLogger(__name__)
+
+# Rows committed just before the previous export can carry an updated_at
+# slightly older than the newest one it saw.
+OVERLAP = timedelta(seconds=5)
+
+_SAFE_CODE = re.compile(r'^[A-Za-z0-9_-]+$')
+# Characters that would end or alter a quoted nginx string, or be expanded as a variable.
+_UNSAFE_TARGET = re.compile(r'["\\$\s]')
+
+
+def _atomic_write(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def render_nginx_map(codes):
+    """Body of an nginx map block: one quoted "short_code" "location" pair per line.
+
+    Codes that differ from another only in case get "~^short_code$" keys.
+    """
+    spellings = {}
+    for short_code in codes:
+        folded = short_code.lower()
+        spellings[folded] = spellings.get(folded, 0) + 1
+    lines = ['default "";']
+    skipped = 0
+    for short_code in sorted(codes):
+        location = codes[short_code]['location']
+        if not _SAFE_CODE.match(short_code) or _UNSAFE_TARGET.search(location):
+            skipped += 1
+            continue
+        key = short_code if spellings[short_code.lower()] == 1 else f'~^{short_code}$'
+        lines.append(f'"{key}" "{location}";')
+    return '\n'.join(lines) + '\n', skipped
+
+
+def export(engine, map_path, json_path, full=False):
+    """Bring both files up to date. Returns (changed, number of codes)."""
+    from models import QRCode
+
+    qrcodes = QRCode.__table__
+    snapshot = None if full else load_snapshot(json_path)
+    codes = dict(snapshot['codes']) if snapshot else {}
+    watermark = snapshot.get('watermark') if snapshot else None
+    watermark = datetime.fromisoformat(watermark) if watermark else None
+
+    query = select(qrcodes.c.short_code, qrcodes.c.id, qrcodes.c.target_url, qrcodes.c.updated_at)
+    if watermark is not None:
+        query = query.where(or_(qrcodes.c.updated_at >= watermark - OVERLAP, qrcodes.c.updated_at.is_(None)))
+    with engine.connect() as conn:
+        changed_rows = conn.execute(query).all()
+        existing = set(conn.execute(select(qrcodes.c.short_code)).scalars()) if snapshot else None
+
+    changed = False
+    if existing is not None:
+        for short_code in set(codes) - existing:
+            del codes[short_code]
+            changed = True
+    for row in changed_rows:
+        entry = {'id': row.id, 'target_url': row.target_url, 'location': iri_to_uri(row.target_url)}
+        if codes.get(row.short_code) != entry:
+            codes[row.short_code] = entry
+            changed = True
+        if row.updated_at is not None and (watermark is None or row.updated_at > watermark):
+            watermark = row.updated_at
+
+    if snapshot is not None and not changed and os.path.exists(map_path):
+        return False, len(codes)
+
+    body, skipped = render_nginx_map(codes)
+    if skipped:
+        logger.warning("%d short codes left out of the nginx map; the redirect service answers them", skipped)
+    _atomic_write(map_path, body)
+    _atomic_write(json_path, json.dumps({
+        'generated_at': datetime.utcnow().isoformat(),
+        'watermark': watermark.isoformat() if watermark else None,
+        'codes': codes,
+    }, sort_keys=True))
+    return True, len(codes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--map', required=True, help="nginx map file to write")
+    parser.add_argument('--json', required=True, help="JSON snapshot to write; also the incremental state")
+    parser.add_argument('--full', action='store_true', help="ignore the previous snapshot and re-read every code")
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help="keep exporting at this interval")
+    parser.add_argument('--reload-command', help="shell command to run after the files change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from standalone_db import create_standalone_engine
+
+    engine = create_standalone_engine(pool_size=1, max_overflow=0)
+    full = args.full
+    while True:
+        try:
+            changed, count = export(engine, args.map, args.json, full=full)
+            full = False
+        except Exception:
+            if not args.watch:
+                raise
+            logger.exception("Redirect map export failed")
+        else:
+            if changed:
+                logger.info("Exported %d short codes to %s", count, args.map)
+                if args.reload_command:
+                    subprocess.run(args.reload_command, shell=True, check=False)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
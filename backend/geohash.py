@@ -0,0 +1,60 @@
+"""Geohash cells for scan locations.
+
+A geohash names a latitude/longitude rectangle with a base-32 string; each
+extra character divides the cell 32 ways, and every prefix of a geohash is
+the cell containing it. Scans store their location's geohash at
+GEOHASH_PRECISION characters (about 1.2 x 0.6 km, finer than what IP
+geolocation can tell), so a heatmap at any coarser precision is a GROUP BY
+on a prefix.
+"""
+GEOHASH_PRECISION = 6
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """The geohash of a point, or None if either coordinate is missing."""
+    if latitude is None or longitude is None:
+        return None
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first.
+        span, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            span[0] = middle
+        else:
+            value = value * 2
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def decode(geohash):
+    """Centre (latitude, longitude) of a geohash cell."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _DECODE[char]
+        for shift in range(4, -1, -1):
+            span = lon_range if even else lat_range
+            middle = (span[0] + span[1]) / 2
+            if value >> shift & 1:
+                span[0] = middle
+            else:
+                span[1] = middle
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
@@ -0,0 +1,180 @@
+"""GeoIP locations for scan enrichment.
+
+Each process opens one geoip2 Reader over GEOIP_DB_PATH (GeoLite2-City.mmdb,
+as downloaded by update_geolite.py) in memory-mapped mode: the database
+stays in the OS page cache, shared by every worker on the host, instead of
+being read into each process's heap. The C extension's mmap mode is used
+when it is installed, the pure-Python one otherwise.
+
+In front of the reader sits an LRU keyed by the address's /24 (IPv4) or
+/48 (IPv6) network. Neighbouring addresses resolve to the same place in
+all but a few cases, and scans cluster on carrier and office networks, so
+most lookups never reach the reader.
+
+The file is stat()ed at most every GEOIP_CHECK_INTERVAL seconds. When
+update_geolite.py renames a new release into place, the new file is opened
+alongside the old one and swapped in; lookups already running finish on the
+old reader, which is closed when the last of them lets go of it. A file
+that fails to open is logged and the old reader stays in use. Without any
+database every lookup returns UNKNOWN_PLACE.
+"""
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import geoip2.database
+import geoip2.errors
+import maxminddb
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GEOIP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GeoLite2-City.mmdb')
+
+Place = namedtuple('Place', ['country', 'region', 'city', 'timezone', 'latitude', 'longitude'])
+UNKNOWN_PLACE = Place(None, None, None, None, None, None)
+
+
+def prefix_key(ip_address):
+    """The /24 or /48 network of an address as bytes, or None if it is not one."""
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.packed[:3] if address.version == 4 else address.packed[:6]
+
+
+def open_reader(path):
+    """A memory-mapped reader for path, using the C extension if available."""
+    try:
+        return geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP_EXT)
+    except ValueError:
+        # maxminddb was installed without its C extension.
+        return geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP)
+
+
+class GeoLocator:
+
+    def __init__(self, path=DEFAULT_GEOIP_PATH, cache_size=50000, check_interval=60.0):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self._reader = None
+        self._signature = None
+        self._last_check = None
+        self._generation = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.reloads = 0
+
+    def locate(self, ip_address):
+        """Country, region, city, timezone and coordinates for an address, as far as known."""
+        key = prefix_key(ip_address) if ip_address else None
+        if key is None:
+            return UNKNOWN_PLACE
+        reader = self.reader()  # first, so a new file clears the cache
+        if reader is None:
+            return UNKNOWN_PLACE
+        with self._lock:
+            place = self._cache.get(key)
+            if place is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return place
+            self.misses += 1
+            generation = self._generation
+            reader = self._reader
+        place = self._lookup(reader, ip_address)
+        with self._lock:
+            if generation != self._generation:
+                # The database was swapped mid-lookup; don't cache an old answer.
+                return place
+            self._cache[key] = place
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return place
+
+    def _lookup(self, reader, ip_address):
+        self.lookups += 1
+        try:
+            response = reader.city(ip_address)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return UNKNOWN_PLACE
+        return Place(
+            response.country.name,
+            response.subdivisions.most_specific.name,
+            response.city.name,
+            response.location.time_zone,
+            response.location.latitude,
+            response.location.longitude,
+        )
+
+    def reader(self):
+        """The current reader, or None while there is no database file."""
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_interval:
+            return self._reader
+        if not self.path or not self._reload_lock.acquire(blocking=False):
+            return self._reader  # another thread is checking
+        try:
+            self._last_check = now
+            self._check()
+        finally:
+            self._reload_lock.release()
+        return self._reader
+
+    def _check(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self._signature:
+            return
+        self._signature = signature
+        try:
+            reader = open_reader(self.path)
+        except Exception:
+            logger.exception("Could not open GeoIP database %s", self.path)
+            return
+        with self._lock:
+            replaced = self._reader is not None
+            self._reader = reader
+            self._generation += 1
+            self._cache.clear()
+        if replaced:
+            # The old reader is left to the garbage collector: a lookup may
+            # still be using it.
+            self.reloads += 1
+            logger.info("Reloaded GeoIP database %s (built %s)", self.path, reader.metadata().build_epoch)
+        else:
+            logger.info("Locating scans with %s", self.path)
+
+    def stats(self):
+        with self._lock:
+            cached = len(self._cache)
+        reader = self._reader
+        return {
+            'database': reader.metadata().database_type if reader is not None else None,
+            'build_epoch': reader.metadata().build_epoch if reader is not None else None,
+            'cached_prefixes': cached,
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'reader_lookups': self.lookups,
+            'reloads': self.reloads,
+        }
+
+
+geo_locator = GeoLocator(
+    path=os.getenv('GEOIP_DB_PATH', DEFAULT_GEOIP_PATH),
+    cache_size=int(os.getenv('GEOIP_CACHE_SIZE', 50000)),
+    check_interval=float(os.getenv('GEOIP_CHECK_INTERVAL', 60)),
+)
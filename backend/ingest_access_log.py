@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Load scans answered by the front proxy from its access log.
+
+Follows the log written for redirects served from export_redirect_map.py's
+map and records each one through the same pipeline as the redirect
+service (bot filter, de-duplication, sampling, exact counts and the
+batched scan writer), with de-duplication and sampling timed by each
+line's own timestamp. The preferred format is one JSON object per line:
+
+    log_format qr_scans escape=json '{"time":"$time_iso8601","ip":"$remote_addr",'
+        '"method":"$request_method","uri":"$uri","status":"$status",'
+        '"ua":"$http_user_agent","referer":"$http_referer","target":"$qr_target"}';
+
+The standard "combined" format is accepted as well. Only 3xx responses to
+/r/<short_code> are recorded.
+
+Progress is checkpointed next to the log as the file's inode, a hash of
+its first line, a generation number and an offset. Each scan's ingest_key
+is derived from all four, so lines re-read after a crash are not stored
+twice as scan rows (counters may count them again). Offsets alone are not
+enough, because a file truncated in place (copytruncate) or a new file on
+a recycled inode starts again at offset 0 with other lines. The generation
+goes up whenever that happens, or when the first line no longer matches
+the checkpoint, so new lines never share a key with old ones. Rotation is
+followed by inode: the old file is read to its end before the new one is
+opened.
+
+    python ingest_access_log.py /var/log/nginx/qr_scans.log
+    python ingest_access_log.py --once /var/log/nginx/qr_scans.log.1
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+PREFIX = '/r/'
+
+_COMBINED = re.compile(
+    r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<uri>\S+)[^"]*" '
+    r'(?P<status>\d{3}) \S+ "(?P<referer>(?:[^"\\]|\\.)*)" "(?P<ua>(?:[^"\\]|\\.)*)"'
+)
+
+
+def _to_utc(moment):
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def parse_line(line):
+    """Return a dict of time, ip, method, uri, status, ua and referer, or None."""
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            fields = json.loads(line)
+            fields['time'] = _to_utc(datetime.fromisoformat(fields['time']))
+        except (ValueError, KeyError, TypeError):
+            return None
+        if fields.get('target') == '':
+            return None  # answered by the redirect service, which recorded it
+        return fields
+    match = _COMBINED.match(line)
+    if match is None:
+        return None
+    fields = match.groupdict()
+    try:
+        fields['time'] = _to_utc(datetime.strptime(fields['time'], '%d/%b/%Y:%H:%M:%S %z'))
+    except ValueError:
+        return None
+    fields['uri'] = fields['uri'].split('?', 1)[0]
+    for key in ('referer', 'ua'):
+        if fields[key] == '-':
+            fields[key] = ''
+    return fields
+
+
+def scan_key(inode, generation, fingerprint, offset):
+    return hashlib.blake2b(f'{inode}:{generation}:{fingerprint}:{offset}'.encode(), digest_size=16).hexdigest()
+
+
+def line_hash(line):
+    return hashlib.blake2b(line, digest_size=8).hexdigest()
+
+
+def first_line_hash(f):
+    """Hash of the file's first complete line, or None if it has none yet."""
+    position = f.tell()
+    f.seek(0)
+    line = f.readline()
+    f.seek(position)
+    return line_hash(line) if line.endswith(b'\n') else None
+
+
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """(inode, offset, generation, fingerprint) of the last saved position."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data['inode'], data['offset'], data.get('generation', 0), data.get('fingerprint')
+        except (FileNotFoundError, ValueError, KeyError):
+            return None, 0, 0, None
+
+    def save(self, inode, offset, generation, fingerprint):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'inode': inode, 'offset': offset, 'generation': generation, 'fingerprint': fingerprint}, f)
+        os.replace(tmp_path, self.path)
+
+
+class AccessLogIngester:
+
+    def __init__(self, path, executor, checkpoint=None, poll_interval=0.5, checkpoint_interval=5.0):
+        self.path = path
+        self.executor = executor
+        self.checkpoint = checkpoint or Checkpoint(path + '.ingest-checkpoint')
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.lines = 0
+        self.recorded = 0
+        self.skipped = 0
+
+    def handle(self, fields, ingest_key):
+        from redirect_cache import LookupUnavailable, resolve_short_code
+        from scan_capture import record_scan
+
+        uri = fields.get('uri') or ''
+        if not uri.startswith(PREFIX) or not str(fields.get('status', '')).startswith('3'):
+            self.skipped += 1
+            return
+        short_code = unquote(uri[len(PREFIX):])
+        while True:
+            try:
+                entry = resolve_short_code(short_code, self.executor)
+                break
+            except LookupUnavailable:
+                time.sleep(1)
+        if entry is None:
+            self.skipped += 1
+            return
+        record_scan(entry.qr_id, fields.get('ip'), fields.get('ua'), fields.get('referer') or None,
+                    fields.get('method') or 'GET', timestamp=fields['time'], ingest_key=ingest_key)
+        self.recorded += 1
+
+    def run(self, once=False):
+        inode, offset, generation, fingerprint = self.checkpoint.load()
+        f = open(self.path, 'rb')
+        stat = os.fstat(f.fileno())
+        current = stat.st_ino
+        if inode != current or stat.st_size < offset or (fingerprint and first_line_hash(f) != fingerprint):
+            # Another file, or this one was truncated since the checkpoint.
+            generation, offset, fingerprint = generation + 1, 0, None
+        elif fingerprint is None:
+            fingerprint = first_line_hash(f)
+        f.seek(offset)
+        # Saved one interval late, so every line it covers has left the
+        # scan writer's queue by then.
+        pending_checkpoint = None
+        last_checkpoint = time.monotonic()
+        buffered = b''
+        try:
+            while True:
+                chunk = f.readline()
+                if chunk:
+                    buffered += chunk
+                    if not buffered.endswith(b'\n'):
+                        continue  # the proxy is still writing this line
+                    line, buffered = buffered, b''
+                    if offset == 0:
+                        fingerprint = line_hash(line)
+                    self.lines += 1
+                    fields = parse_line(line.decode('utf-8', 'replace'))
+                    if fields is None:
+                        self.skipped += 1
+                    else:
+                        self.handle(fields, scan_key(current, generation, fingerprint, offset))
+                    offset += len(line)
+                else:
+                    if once:
+                        break
+                    if os.fstat(f.fileno()).st_size < offset + len(buffered):
+                        # Truncated in place (copytruncate rotation).
+                        f.seek(0)
+                        generation, offset, fingerprint, buffered = generation + 1, 0, None, b''
+                        continue
+                    rotated = self._rotated(current)
+                    if rotated and not buffered:
+                        f.close()
+                        f = open(self.path, 'rb')
+                        current, offset = os.fstat(f.fileno()).st_ino, 0
+                        generation, fingerprint = generation + 1, None
+                        logger.info("Following rotated log %s", self.path)
+                    else:
+                        time.sleep(self.poll_interval)
+                now = time.monotonic()
+                if now - last_checkpoint >= self.checkpoint_interval:
+                    if pending_checkpoint is not None:
+                        self.checkpoint.save(*pending_checkpoint)
+                    pending_checkpoint = (current, offset, generation, fingerprint)
+                    last_checkpoint = now
+        finally:
+            f.close()
+            from scan_writer import scan_writer
+            scan_writer.stop()
+            self.checkpoint.save(current, offset, generation, fingerprint)
+
+    def _rotated(self, inode):
+        try:
+            return os.stat(self.path).st_ino != inode
+        except FileNotFoundError:
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help="access log to read")
+    parser.add_argument('--once', action='store_true', help="stop at the end of the file instead of following it")
+    parser.add_argument('--checkpoint', help="checkpoint file (default: <path>.ingest-checkpoint)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from redirect_cache import load_short_codes
+    from scan_writer import scan_writer
+    from standalone_db import EngineExecutor, create_standalone_engine
+
+    engine = create_standalone_engine(pool_size=2, max_overflow=2)
+    scan_writer.init_engine(engine)
+    executor = EngineExecutor(engine)
+    load_short_codes(executor)
+    ingester = AccessLogIngester(args.path, executor,
+                                 checkpoint=Checkpoint(args.checkpoint) if args.checkpoint else None)
+    try:
+        ingester.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+    logger.info("Read %d lines: %d scans recorded, %d skipped", ingester.lines, ingester.recorded, ingester.skipped)
+
+
+if __name__ == '__main__':
+    main()
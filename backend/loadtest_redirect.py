@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""HTTP load test for a running redirect server.
+
+Opens --concurrency keep-alive connections and issues GET /r/<code> as fast
+as the server answers for --duration seconds, then prints throughput and
+latency percentiles. Run it once against each deployment, e.g.
+
+    gunicorn --chdir backend --workers=2 --threads=4 --worker-class=gthread -b :8000 wsgi:app
+    uvicorn --app-dir backend --workers 2 --no-access-log --port 8001 redirect_asgi:app
+
+    python loadtest_redirect.py http://127.0.0.1:8000 CODE --concurrency 200
+    python loadtest_redirect.py http://127.0.0.1:8001 CODE --concurrency 200
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+USER_AGENT = ('Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/124.0 Mobile Safari/537.36')
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length = 0
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            close = True
+    if length:
+        await reader.readexactly(length)
+    return status, close
+
+
+async def _worker(host, port, request, deadline, latencies, statuses):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request)
+            status, close = await _read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if close:
+                writer.close()
+                writer = None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            statuses['error'] = statuses.get('error', 0) + 1
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def main(args):
+    url = urlsplit(args.base_url)
+    host, port = url.hostname, url.port or 80
+    request = (f"GET /r/{args.short_code} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+               f"User-Agent: {USER_AGENT}\r\nX-Forwarded-For: 198.51.100.23\r\n\r\n").encode()
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + args.duration
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _worker(host, port, request, deadline, latencies, statuses)
+        for _ in range(args.concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+    print(f"{args.base_url}  concurrency={args.concurrency}  duration={elapsed:.1f}s")
+    print(f"  requests  {len(latencies)}  ({len(latencies) / elapsed:.0f} req/s)")
+    print(f"  latency   p50 {pct(0.50):.1f} ms   p90 {pct(0.90):.1f} ms   p99 {pct(0.99):.1f} ms")
+    print(f"  statuses  {statuses}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test GET /r/<short_code>")
+    parser.add_argument('base_url')
+    parser.add_argument('short_code')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,23 @@
+"""
+add bot_hits table
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_bot_hits'
+down_revision = '2026_10_16_add_scan_duplicate_count'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'bot_hits',
+        sa.Column('qr_code_id', sa.Integer, sa.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('category', sa.String(20), primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False, server_default='0'),
+    )
+
+def downgrade():
+    op.drop_table('bot_hits')
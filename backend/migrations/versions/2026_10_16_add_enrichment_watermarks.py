@@ -0,0 +1,27 @@
+"""
+add enrichment_watermarks for deferred scan enrichment
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_enrichment_watermarks'
+down_revision = '2026_10_16_add_qrcode_updated_at'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'enrichment_watermarks',
+        sa.Column('name', sa.String(50), primary_key=True),
+        sa.Column('last_scan_id', sa.BigInteger, nullable=False),
+        sa.Column('updated_at', sa.DateTime),
+    )
+    # Scans stored so far were enriched when they were recorded.
+    op.execute(
+        "INSERT INTO enrichment_watermarks (name, last_scan_id, updated_at) "
+        "SELECT 'scans', coalesce(max(id), 0), CURRENT_TIMESTAMP FROM scans"
+    )
+
+def downgrade():
+    op.drop_table('enrichment_watermarks')
@@ -0,0 +1,21 @@
+"""
+add updated_at to qrcodes
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_qrcode_updated_at'
+down_revision = '2026_10_16_add_scan_sampling'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('qrcodes', sa.Column('updated_at', sa.DateTime))
+    op.execute("UPDATE qrcodes SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)")
+    op.create_index('ix_qrcodes_updated_at', 'qrcodes', ['updated_at'])
+
+def downgrade():
+    op.drop_index('ix_qrcodes_updated_at', table_name='qrcodes')
+    with op.batch_alter_table('qrcodes') as batch_op:
+        batch_op.drop_column('updated_at')
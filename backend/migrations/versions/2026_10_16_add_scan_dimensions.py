@@ -0,0 +1,104 @@
+"""
+move repeated scan strings into dimension tables with integer keys on scans
+"""
+from urllib.parse import urlsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_scan_dimensions'
+down_revision = '2026_10_16_add_enrichment_watermarks'
+branch_labels = None
+depends_on = None
+
+# (table, scans id column, old scans column, value length)
+DIMENSIONS = [
+    ('user_agents', 'user_agent_id', 'user_agent', 512),
+    ('referrers', 'referrer_id', 'referrer_domain', 253),
+    ('device_types', 'device_type_id', 'device_type', 50),
+    ('os_families', 'os_family_id', 'os_family', 100),
+    ('browser_families', 'browser_family_id', 'browser_family', 100),
+]
+OLD_TYPES = {
+    'user_agent': sa.Text,
+    'referrer_domain': lambda: sa.String(200),
+    'device_type': lambda: sa.String(50),
+    'os_family': lambda: sa.String(100),
+    'browser_family': lambda: sa.String(100),
+}
+
+
+def _domain(referrer):
+    # Same as dimensions.referrer_domain() when this migration was written.
+    try:
+        host = urlsplit(referrer if '//' in referrer else '//' + referrer).hostname
+    except ValueError:
+        return None
+    return host[:253] if host else None
+
+
+def _backfill_referrers(bind):
+    referrers = sa.table('referrers', sa.column('id'), sa.column('value'))
+    raw_values = [row[0] for row in bind.execute(sa.text(
+        "SELECT DISTINCT referrer_domain FROM scans WHERE referrer_domain IS NOT NULL"))]
+    domains = {raw: _domain(raw) for raw in raw_values}
+    new_domains = sorted({domain for domain in domains.values() if domain})
+    if new_domains:
+        op.bulk_insert(referrers, [{'value': domain} for domain in new_domains])
+    ids = dict(bind.execute(sa.text("SELECT value, id FROM referrers")).all())
+    updates = [{'rid': ids[domain], 'raw': raw} for raw, domain in domains.items() if domain]
+    if updates:
+        bind.execute(sa.text("UPDATE scans SET referrer_id = :rid WHERE referrer_domain = :raw"), updates)
+
+
+def upgrade():
+    bind = op.get_bind()
+    # Batches written with COPY stored missing values as '' rather than
+    # NULL; the dimension ids below must be NULL for them.
+    for old_column in ('ip_address', 'user_agent', 'referrer_domain'):
+        op.execute(f"UPDATE scans SET {old_column} = NULL WHERE {old_column} = ''")
+    for table, _, _, length in DIMENSIONS:
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('value', sa.String(length), nullable=False, unique=True),
+        )
+    with op.batch_alter_table('scans') as batch_op:
+        for table, id_column, _, _ in DIMENSIONS:
+            batch_op.add_column(sa.Column(id_column, sa.Integer))
+            batch_op.create_foreign_key(f'fk_scans_{id_column}', table, [id_column], ['id'])
+    for table, id_column, old_column, length in DIMENSIONS:
+        if old_column == 'referrer_domain':
+            # The column held the raw referrer; the dimension keeps its host.
+            _backfill_referrers(bind)
+            continue
+        value = f"substr({old_column}, 1, {length})"
+        op.execute(
+            f"INSERT INTO {table} (value) SELECT DISTINCT {value} FROM scans "
+            f"WHERE {old_column} IS NOT NULL AND {old_column} <> ''"
+        )
+        op.execute(
+            f"UPDATE scans SET {id_column} = (SELECT d.id FROM {table} d WHERE d.value = {value}) "
+            f"WHERE {old_column} IS NOT NULL AND {old_column} <> ''"
+        )
+    with op.batch_alter_table('scans') as batch_op:
+        for _, _, old_column, _ in DIMENSIONS:
+            batch_op.drop_column(old_column)
+
+
+def downgrade():
+    with op.batch_alter_table('scans') as batch_op:
+        for _, _, old_column, _ in DIMENSIONS:
+            batch_op.add_column(sa.Column(old_column, OLD_TYPES[old_column]()))
+    for table, id_column, old_column, _ in DIMENSIONS:
+        op.execute(
+            f"UPDATE scans SET {old_column} = (SELECT d.value FROM {table} d WHERE d.id = scans.{id_column}) "
+            f"WHERE {id_column} IS NOT NULL"
+        )
+    with op.batch_alter_table('scans') as batch_op:
+        for _, id_column, _, _ in DIMENSIONS:
+            batch_op.drop_constraint(f'fk_scans_{id_column}', type_='foreignkey')
+            batch_op.drop_column(id_column)
+    for table, _, _, _ in DIMENSIONS:
+        op.drop_table(table)
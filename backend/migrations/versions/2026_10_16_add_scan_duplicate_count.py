@@ -0,0 +1,18 @@
+"""
+add duplicate_count to scans
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_scan_duplicate_count'
+down_revision = '2026_10_16_add_scan_ingest_key'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('scans', sa.Column('duplicate_count', sa.Integer, nullable=False, server_default='0'))
+
+def downgrade():
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.drop_column('duplicate_count')
@@ -0,0 +1,31 @@
+"""
+add scans.geohash and the scan_geo_counts heatmap aggregate
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_scan_geohash'
+down_revision = '2026_10_16_add_scan_dimensions'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Existing scans have no coordinates; backfill_enrichment.py fills
+    # both the column and the aggregate for them.
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.add_column(sa.Column('geohash', sa.String(6)))
+    op.create_index('ix_scans_qr_code_id_geohash', 'scans', ['qr_code_id', 'geohash'])
+    op.create_table(
+        'scan_geo_counts',
+        sa.Column('qr_code_id', sa.Integer, sa.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('geohash', sa.String(6), primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False, server_default='0'),
+    )
+
+def downgrade():
+    op.drop_table('scan_geo_counts')
+    op.drop_index('ix_scans_qr_code_id_geohash', table_name='scans')
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.drop_column('geohash')
@@ -0,0 +1,21 @@
+"""
+add ingest_key to scans
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_scan_ingest_key'
+down_revision = '2025_06_17_add_scans_table'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.add_column(sa.Column('ingest_key', sa.String(64), nullable=True))
+        batch_op.create_unique_constraint('uq_scans_ingest_key', ['ingest_key'])
+
+def downgrade():
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.drop_constraint('uq_scans_ingest_key', type_='unique')
+        batch_op.drop_column('ingest_key')
@@ -0,0 +1,30 @@
+"""
+add sample_weight to scans and the scan_counts table
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_scan_sampling'
+down_revision = '2026_10_16_add_short_code_allocator'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('scans', sa.Column('sample_weight', sa.Integer, nullable=False, server_default='1'))
+    op.create_table(
+        'scan_counts',
+        sa.Column('qr_code_id', sa.Integer, sa.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False, server_default='0'),
+    )
+    # Every scan stored so far was stored unsampled.
+    op.execute(
+        "INSERT INTO scan_counts (qr_code_id, day, count) "
+        "SELECT qr_code_id, date(timestamp), count(*) FROM scans GROUP BY qr_code_id, date(timestamp)"
+    )
+
+def downgrade():
+    op.drop_table('scan_counts')
+    with op.batch_alter_table('scans') as batch_op:
+        batch_op.drop_column('sample_weight')
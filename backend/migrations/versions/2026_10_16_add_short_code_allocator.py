@@ -0,0 +1,26 @@
+"""
+add short-code allocator sequence and counter table
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2026_10_16_add_short_code_allocator'
+down_revision = '2026_10_16_add_bot_hits'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("CREATE SEQUENCE short_code_seq")
+    counters = op.create_table(
+        'short_code_counters',
+        sa.Column('name', sa.String(50), primary_key=True),
+        sa.Column('next_id', sa.BigInteger, nullable=False),
+    )
+    op.bulk_insert(counters, [{'name': 'short_code', 'next_id': 1}])
+
+def downgrade():
+    op.drop_table('short_code_counters')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP SEQUENCE short_code_seq")
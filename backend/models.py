@@ -2,8 +2,10 @@ from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import create_access_token, get_jwt_identity
 from flask import current_app
+from sqlalchemy.orm import joinedload
 import jwt
 from extensions import db
+from geohash import GEOHASH_PRECISION
 
 class QRCode(db.Model):
     __tablename__ = 'qrcodes'
@@ -14,12 +16,24 @@ class QRCode(db.Model):
     short_code = db.Column(db.String(10), unique=True, nullable=False)
     folder = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
     # Relationships
     scans = db.relationship('Scan', backref='qrcode', lazy=True, cascade="all, delete-orphan")
     user = db.relationship('User', backref=db.backref('qrcodes', lazy=True))
 
+# Source of short-code numbers on PostgreSQL; see short_code_allocator.
+short_code_sequence = db.Sequence('short_code_seq', metadata=db.metadata)
+
+
+class ShortCodeCounter(db.Model):
+    """Next unreserved short-code number, for databases without sequences."""
+    __tablename__ = 'short_code_counters'
+
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
 class Scan(db.Model):
     __tablename__ = 'scans'
     
@@ -27,18 +41,138 @@ class Scan(db.Model):
     qr_code_id = db.Column(db.Integer, db.ForeignKey('qrcodes.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     ip_address = db.Column(db.String(50))
-    user_agent = db.Column(db.Text)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('user_agents.id'))
     country = db.Column(db.String(100), index=True)
     region = db.Column(db.String(100))
     city = db.Column(db.String(100))
     timezone = db.Column(db.String(50))
-    device_type = db.Column(db.String(50))
-    os_family = db.Column(db.String(100))
-    browser_family = db.Column(db.String(100))
-    referrer_domain = db.Column(db.String(200))
+    geohash = db.Column(db.String(GEOHASH_PRECISION))
+    # Filled in by scan_enrichment; NULL while the scan is waiting for it.
+    device_type_id = db.Column(db.Integer, db.ForeignKey('device_types.id'))
+    os_family_id = db.Column(db.Integer, db.ForeignKey('os_families.id'))
+    browser_family_id = db.Column(db.Integer, db.ForeignKey('browser_families.id'))
+    referrer_id = db.Column(db.Integer, db.ForeignKey('referrers.id'))
     time_on_page = db.Column(db.Integer)
     scrolled = db.Column(db.Boolean, default=False)
     scan_method = db.Column(db.String(50))
+    ingest_key = db.Column(db.String(64), unique=True)
+    duplicate_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # How many scans this row stands for; above 1 only for sampled codes.
+    sample_weight = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __table_args__ = (
+        db.Index('ix_scans_qr_code_id_geohash', 'qr_code_id', 'geohash'),
+    )
+
+    # The properties below give the decoded dimension values under the
+    # names the columns used to have. They are not loaded with the scan:
+    # query through with_names() where they are read.
+    agent = db.relationship('UserAgent', lazy='select')
+    device = db.relationship('DeviceType', lazy='select')
+    os = db.relationship('OsFamily', lazy='select')
+    browser = db.relationship('BrowserFamily', lazy='select')
+    referrer = db.relationship('Referrer', lazy='select')
+
+    @classmethod
+    def with_names(cls, *relationships):
+        """Scan.query with the given dimensions joined in, or all of them."""
+        relationships = relationships or (cls.agent, cls.device, cls.os, cls.browser, cls.referrer)
+        return cls.query.options(*(joinedload(relationship) for relationship in relationships))
+
+    @property
+    def user_agent(self):
+        return self.agent.value if self.agent else None
+
+    @property
+    def device_type(self):
+        return self.device.value if self.device else None
+
+    @property
+    def os_family(self):
+        return self.os.value if self.os else None
+
+    @property
+    def browser_family(self):
+        return self.browser.value if self.browser else None
+
+    @property
+    def referrer_domain(self):
+        return self.referrer.value if self.referrer else None
+
+
+# Dictionary tables for repeated scan values; see dimensions.py.
+class UserAgent(db.Model):
+    __tablename__ = 'user_agents'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(512), unique=True, nullable=False)
+
+
+class Referrer(db.Model):
+    __tablename__ = 'referrers'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(253), unique=True, nullable=False)
+
+
+class DeviceType(db.Model):
+    __tablename__ = 'device_types'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(50), unique=True, nullable=False)
+
+
+class OsFamily(db.Model):
+    __tablename__ = 'os_families'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(100), unique=True, nullable=False)
+
+
+class BrowserFamily(db.Model):
+    __tablename__ = 'browser_families'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(100), unique=True, nullable=False)
+
+
+class EnrichmentWatermark(db.Model):
+    """Highest scan id the deferred enrichment has looked at."""
+    __tablename__ = 'enrichment_watermarks'
+
+    name = db.Column(db.String(50), primary_key=True)
+    last_scan_id = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ScanCount(db.Model):
+    """Exact daily scan totals per QR code, kept even when raw scans are sampled."""
+    __tablename__ = 'scan_counts'
+
+    qr_code_id = db.Column(db.Integer, db.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ScanGeoCount(db.Model):
+    """Daily scans per QR code per geohash cell (GEOHASH_PRECISION characters),
+    kept by scan enrichment as locations are resolved."""
+    __tablename__ = 'scan_geo_counts'
+
+    qr_code_id = db.Column(db.Integer, db.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    geohash = db.Column(db.String(GEOHASH_PRECISION), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class BotHit(db.Model):
+    """Daily count of bot and link-preview hits per QR code, by category."""
+    __tablename__ = 'bot_hits'
+
+    qr_code_id = db.Column(db.Integer, db.ForeignKey('qrcodes.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 
 class User(db.Model):
@@ -0,0 +1,318 @@
+"""QR code images, rendered once and cached by content.
+
+Every endpoint that shows a QR code goes through qr_renderer.render(). An
+image is identified by a hash of everything that determines its bytes
+(payload, error correction, box size or pixel size, border and format),
+so the same code viewed again, from any endpoint, is served from the
+cache, and an edited target URL simply hashes to a new image.
+
+Formats are PNG and WebP, drawn with PIL, and SVG, written straight from
+the module matrix as one path of horizontal runs. SVG is the cheapest to
+produce and the smallest, and it scales for print. A requested pixel size
+is met with whole pixels per module for the raster formats (the largest
+crisp image that fits) and exactly for SVG.
+
+Two tiers: a per-worker LRU bounded by QR_CACHE_MEMORY_BYTES, in front of
+a directory shared by the workers on the host (QR_CACHE_DIR) bounded by
+QR_CACHE_DISK_BYTES. Disk files are written to a temporary name and
+renamed into place, so readers never see a partial image. A disk hit
+touches the file's mtime; when the directory grows past its bound the
+least recently touched files are removed until it is at 90%. Set
+QR_CACHE_DISK_BYTES=0 to keep the memory tier only.
+"""
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
+import qrcode
+from PIL import features
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_cache')
+
+ERROR_CORRECTION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+MIMETYPES = {
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+MIN_IMAGE_SIZE = 32
+MAX_IMAGE_SIZE = 4096
+
+# key is the content hash, usable as an ETag.
+RenderedImage = namedtuple('RenderedImage', ['key', 'mimetype', 'data'])
+
+
+def image_key(payload, error_correction, box_size, border, image_format, size=None):
+    material = '\0'.join([payload, error_correction, str(box_size), str(border), image_format, str(size)])
+    return hashlib.blake2b(material.encode(), digest_size=16).hexdigest()
+
+
+def data_uri(image):
+    return f"data:{image.mimetype};base64,{base64.b64encode(image.data).decode()}"
+
+
+def _pil_image(img):
+    # make_image() wraps the PIL image; which accessor exists depends on
+    # the qrcode version.
+    if hasattr(img, "get_image"):
+        return img.get_image()
+    if hasattr(img, "to_image"):
+        return img.to_image()
+    if not hasattr(img, "save"):
+        logger.error("QR make_image returned unexpected type: %s", type(img))
+        raise TypeError(f"QR make_image returned unexpected type: {type(img)}")
+    return img
+
+
+def negotiate_format(accept_mimetypes, default='png'):
+    """The format an Accept header names explicitly with the highest quality.
+
+    Wildcards alone (*/*, image/*) get the default, so clients that never
+    asked for anything else keep receiving PNG.
+    """
+    best, best_quality = default, 0
+    for image_format in RENDERERS:  # preference order on ties
+        for value, quality in accept_mimetypes:
+            if value == MIMETYPES[image_format] and quality > best_quality:
+                best, best_quality = image_format, quality
+    return best
+
+
+def _encode(payload, error_correction, border):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=ERROR_CORRECTION[error_correction],
+        border=border,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr
+
+
+def _box_size(qr, box_size, size):
+    if size is None:
+        return box_size
+    return max(1, size // (qr.modules_count + 2 * qr.border))
+
+
+def _raster(payload, error_correction, box_size, border, size):
+    qr = _encode(payload, error_correction, border)
+    qr.box_size = _box_size(qr, box_size, size)
+    return _pil_image(qr.make_image(fill_color="black", back_color="white"))
+
+
+def render_png(payload, error_correction='L', box_size=10, border=4, size=None):
+    buffered = BytesIO()
+    _raster(payload, error_correction, box_size, border, size).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def render_webp(payload, error_correction='L', box_size=10, border=4, size=None):
+    buffered = BytesIO()
+    img = _raster(payload, error_correction, box_size, border, size).convert('L')
+    img.save(buffered, format="WEBP", lossless=True)
+    return buffered.getvalue()
+
+
+def render_svg(payload, error_correction='L', box_size=10, border=4, size=None):
+    # No PIL: one unit per module in the viewBox, and each run of dark
+    # modules a one-unit-wide stroke along the middle of its row.
+    matrix = _encode(payload, error_correction, border).get_matrix()
+    modules = len(matrix)
+    path = []
+    for y, row in enumerate(matrix):
+        x = end = 0
+        first = True
+        while x < modules:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < modules and row[x]:
+                x += 1
+            if first:
+                path.append(f'M{start} {y}.5h{x - start}')
+                first = False
+            else:
+                path.append(f'm{start - end} 0h{x - start}')
+            end = x
+    pixels = size or modules * box_size
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+        f'viewBox="0 0 {modules} {modules}" shape-rendering="crispEdges">'
+        f'<rect width="{modules}" height="{modules}" fill="#fff"/>'
+        f'<path d="{"".join(path)}" stroke="#000"/></svg>'
+    ).encode()
+
+
+RENDERERS = {
+    'svg': render_svg,
+    'png': render_png,
+}
+if features.check('webp'):
+    RENDERERS['webp'] = render_webp
+
+
+class QRRenderer:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_bytes=8 * 1024 * 1024, disk_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._disk_size = None  # estimate; recounted when it passes the bound
+        self._disk_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.disk_errors = 0
+
+    def render(self, payload, error_correction='L', box_size=10, border=4, image_format='png', size=None):
+        """The image for these options, from the cache or freshly rendered.
+        size, in pixels, overrides box_size."""
+        key = image_key(payload, error_correction, box_size, border, image_format, size)
+        mimetype = MIMETYPES[image_format]
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return RenderedImage(key, mimetype, data)
+        data = self._read_disk(key, image_format)
+        if data is not None:
+            self.disk_hits += 1
+        else:
+            data = RENDERERS[image_format](payload, error_correction, box_size, border, size)
+            self.renders += 1
+            self._write_disk(key, image_format, data)
+        self._remember(key, data)
+        return RenderedImage(key, mimetype, data)
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+                self.memory_evictions += 1
+
+    def _path(self, key, image_format):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{image_format}')
+
+    def _read_disk(self, key, image_format):
+        if not self.disk_bytes:
+            return None
+        path = self._path(key, image_format)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # recently used, for eviction
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError:
+            self.disk_errors += 1
+            return None
+
+    def _write_disk(self, key, image_format, data):
+        if not self.disk_bytes:
+            return
+        path = self._path(key, image_format)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            self.disk_errors += 1
+            logger.exception("Could not write QR image cache file %s", path)
+            return
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._disk_size = self._disk_usage()[0]
+            else:
+                self._disk_size += len(data)
+            if self._disk_size > self.disk_bytes:
+                self._evict_disk()
+
+    def _disk_usage(self):
+        files = []
+        total = 0
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue  # still being written
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # removed by another worker
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return total, files
+
+    def _evict_disk(self):
+        # Other workers share the directory, so recount before deleting.
+        total, files = self._disk_usage()
+        target = self.disk_bytes * 0.9
+        files.sort()
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                self.disk_evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._disk_size = total
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._memory)
+            memory_size = self._memory_size
+        lookups = self.memory_hits + self.disk_hits + self.renders
+        return {
+            'memory_entries': entries,
+            'memory_bytes': memory_size,
+            'memory_limit_bytes': self.memory_bytes,
+            'disk_bytes': self._disk_size,
+            'disk_limit_bytes': self.disk_bytes,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'renders': self.renders,
+            'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+            'memory_evictions': self.memory_evictions,
+            'disk_evictions': self.disk_evictions,
+            'disk_errors': self.disk_errors,
+        }
+
+
+qr_renderer = QRRenderer(
+    cache_dir=os.getenv('QR_CACHE_DIR', DEFAULT_CACHE_DIR),
+    memory_bytes=int(os.getenv('QR_CACHE_MEMORY_BYTES', 8 * 1024 * 1024)),
+    disk_bytes=int(os.getenv('QR_CACHE_DISK_BYTES', 256 * 1024 * 1024)),
+)
@@ -0,0 +1,156 @@
+"""asyncio redirect server for /r/<short_code>.
+
+A plain ASGI application, run under uvicorn next to the Flask API:
+
+    uvicorn --app-dir backend --workers 4 --no-access-log redirect_asgi:app
+
+Short-code lookups that miss the in-memory caches go through SQLAlchemy's
+asyncio engine (asyncpg on PostgreSQL, aiosqlite on SQLite), so a redirect
+waiting on the database holds no thread. Scans are recorded through the
+same batched writer as the other entry points; its thread writes through a
+regular engine and never blocks the event loop, because the loop enqueues
+with block=False. With SCAN_WRITER_ASYNC=false each scan is written inside
+the request, so record_scan() then runs in a worker thread. There is no
+synchronous lookup path: without the asyncio driver the server does not
+start.
+"""
+import asyncio
+import logging
+import os
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from redirect_cache import LookupUnavailable, load_short_codes, resolve_short_code_async
+from scan_capture import client_address, record_scan, with_scan_token
+from scan_writer import scan_writer
+from standalone_db import EngineExecutor, create_standalone_engine, database_url
+
+logger = logging.getLogger(__name__)
+
+PREFIX = '/r/'
+
+_ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(db_uri):
+    scheme, sep, rest = db_uri.partition('://')
+    dialect = scheme.split('+', 1)[0]
+    if dialect not in _ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver configured for {dialect} databases")
+    return f"{_ASYNC_DRIVERS[dialect]}{sep}{rest}"
+
+
+def _async_engine_options(db_uri):
+    if not db_uri.startswith('postgresql'):
+        return {}
+    return {
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+        'pool_size': int(os.getenv('REDIRECT_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('REDIRECT_MAX_OVERFLOW', 20)),
+        'connect_args': {'timeout': 5},
+    }
+
+
+async def _send_plain(send, status, body, extra_headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'text/plain; charset=utf-8'),
+            (b'content-length', str(len(body)).encode()),
+            *extra_headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class RedirectApp:
+
+    def __init__(self):
+        self.engine = None
+        self.sync_engine = None
+
+    async def startup(self):
+        db_uri = database_url()
+        self.engine = create_async_engine(async_database_url(db_uri), **_async_engine_options(db_uri))
+        self.sync_engine = create_standalone_engine()
+        scan_writer.init_engine(self.sync_engine)
+        await asyncio.to_thread(load_short_codes, EngineExecutor(self.sync_engine))
+
+    async def shutdown(self):
+        await asyncio.to_thread(scan_writer.stop)
+        await self.engine.dispose()
+        self.sync_engine.dispose()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        if not path.startswith(PREFIX):
+            await _send_plain(send, 404, b'Not Found')
+            return
+        if scope['method'] not in ('GET', 'HEAD'):
+            await _send_plain(send, 405, b'Method Not Allowed', [(b'allow', b'GET, HEAD')])
+            return
+        short_code = path[len(PREFIX):]
+        if not short_code or '/' in short_code:
+            await _send_plain(send, 404, b'Not Found')
+            return
+
+        try:
+            entry = await resolve_short_code_async(short_code, self.engine)
+        except LookupUnavailable:
+            await _send_plain(send, 503, b'Service Unavailable', [(b'retry-after', b'5')])
+            return
+        if entry is None:
+            await _send_plain(send, 404, b'Not Found')
+            return
+
+        headers = dict(scope['headers'])
+        forwarded_for = headers.get(b'x-forwarded-for')
+        client = scope.get('client')
+        ip_address = client_address(forwarded_for.decode('latin-1') if forwarded_for else None,
+                                    client[0] if client else None)
+        user_agent = headers.get(b'user-agent', b'').decode('latin-1')
+        referrer = headers.get(b'referer')
+        scan = (entry.qr_id, ip_address, user_agent, referrer.decode('latin-1') if referrer else None, scope['method'])
+        if scan_writer.enabled:
+            token = record_scan(*scan, block=False)
+        else:
+            # SCAN_WRITER_ASYNC=false writes the scan inside the request.
+            token = await asyncio.to_thread(record_scan, *scan)
+        location = with_scan_token(entry.location, token)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 302,
+            'headers': [(b'location', location.encode('latin-1')), (b'content-length', b'0')],
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as exc:
+                    logger.exception("Redirect server failed to start")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(exc)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = RedirectApp()
@@ -0,0 +1,279 @@
+"""In-process cache for short-code redirects.
+
+Each worker keeps a bounded LRU of short_code -> (qr_id, target_url) so the
+/r/<short_code> hot path can skip the database for codes it has seen
+recently. Entries expire after a TTL, which also bounds how long another
+worker's edit can go unnoticed here. Expired entries stay in the LRU until
+they are refreshed or evicted so that, while the database circuit breaker is
+open, redirects can still be served from the last known target URL.
+
+When SHORT_CODE_INDEX_PATH is set, the node-wide memory-mapped index is
+consulted for codes this cache has no entry for, and its hits are copied
+into the cache. They are therefore trusted for one TTL like any other
+entry and then looked up again; what the database says is written back to
+the index, so an edit or deletion made on another node reaches every
+worker here within a TTL. Codes neither of them knows are checked against
+the short-code filter and negative cache, so unknown codes are rejected
+without a query.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import bindparam, select
+from werkzeug.urls import iri_to_uri
+
+from circuit_breaker import db_breaker
+from extensions import db
+from models import QRCode
+from short_code_filter import negative_cache, short_code_filter
+from short_code_index import short_code_index
+
+logger = logging.getLogger(__name__)
+
+# location is the target URL already encoded for use as a Location header.
+ShortCodeEntry = namedtuple('ShortCodeEntry', ['qr_id', 'target_url', 'location'])
+
+
+MISS = object()
+
+
+class LookupUnavailable(Exception):
+    """The database cannot be asked and no cached entry exists."""
+
+
+class ShortCodeCache:
+    """Thread-safe LRU cache with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_hits = 0
+
+    def get(self, short_code):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(short_code)
+            if item is None:
+                self.misses += 1
+                return None
+            entry, expires_at = item
+            if expires_at <= now:
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(short_code)
+            self.hits += 1
+            return entry
+
+    def get_stale(self, short_code):
+        """Return the entry for short_code even if its TTL has passed."""
+        with self._lock:
+            item = self._data.get(short_code)
+            if item is None:
+                return None
+            self.stale_hits += 1
+            return item[0]
+
+    def __contains__(self, short_code):
+        """True if short_code has an entry, expired or not."""
+        with self._lock:
+            return short_code in self._data
+
+    def put(self, short_code, entry):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[short_code] = (entry, expires_at)
+            self._data.move_to_end(short_code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, short_code):
+        with self._lock:
+            if self._data.pop(short_code, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale_hits': self.stale_hits,
+            }
+
+
+redirect_cache = ShortCodeCache(
+    maxsize=int(os.getenv('REDIRECT_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('REDIRECT_CACHE_TTL', 300)),
+)
+
+
+def _lookup_local(short_code):
+    """Answer from memory: an entry, None for a code known to be missing, or MISS."""
+    entry = redirect_cache.get(short_code)
+    if entry is not None:
+        return entry
+    # An expired entry means the index hit it came from is due for a check.
+    if short_code_index.enabled and short_code not in redirect_cache:
+        indexed = short_code_index.lookup(short_code)
+        if indexed is not None:
+            entry = ShortCodeEntry(*indexed)
+            redirect_cache.put(short_code, entry)
+            return entry
+    if short_code in negative_cache:
+        return None
+    return MISS
+
+
+# Built once against the table rather than the mapped class: executions only
+# bind :short_code, so SQLAlchemy reuses the statement's memoized cache key and
+# compiled form instead of constructing and compiling a query per request.
+_qrcodes = QRCode.__table__
+LOOKUP_STATEMENT = select(_qrcodes.c.id, _qrcodes.c.target_url).where(
+    _qrcodes.c.short_code == bindparam('short_code'))
+
+
+def _remember(short_code, row):
+    if row is None:
+        negative_cache.add(short_code)
+        if short_code_index.enabled:
+            short_code_index.reconcile(short_code)
+        return None
+    entry = ShortCodeEntry(row.id, row.target_url, iri_to_uri(row.target_url))
+    redirect_cache.put(short_code, entry)
+    if short_code_index.enabled:
+        short_code_index.reconcile(short_code, row.id, row.target_url)
+    return entry
+
+
+def resolve_short_code(short_code, executor=None):
+    """Return the ShortCodeEntry for short_code, or None if it does not exist.
+
+    Only the id and target_url columns are read; no ORM object is built.
+    Raises LookupUnavailable when the database is unreachable and the code
+    has never been cached by this worker.
+    """
+    entry = _lookup_local(short_code)
+    if entry is not MISS:
+        return entry
+    if not db_breaker.allow():
+        if not short_code_filter.might_exist(short_code):
+            return None
+        return _stale_or_unavailable(short_code)
+    executor = executor if executor is not None else db.session
+    start = time.monotonic()
+    try:
+        if not short_code_filter.might_exist(short_code, executor):
+            db_breaker.record_success(time.monotonic() - start)
+            return None
+        row = executor.execute(LOOKUP_STATEMENT, {'short_code': short_code}).first()
+    except Exception as exc:
+        db_breaker.record_failure(reason=str(exc).splitlines()[0])
+        try:
+            executor.rollback()
+        except Exception:
+            pass
+        return _stale_or_unavailable(short_code)
+    db_breaker.record_success(time.monotonic() - start)
+    return _remember(short_code, row)
+
+
+async def resolve_short_code_async(short_code, engine):
+    """resolve_short_code() for asyncio callers, querying through an AsyncEngine."""
+    entry = _lookup_local(short_code)
+    if entry is not MISS:
+        return entry
+    in_filter = short_code in short_code_filter
+    if not in_filter and not short_code_filter.catch_up_due():
+        short_code_filter.rejections += 1
+        return None
+    if not db_breaker.allow():
+        if not in_filter:
+            return None
+        return _stale_or_unavailable(short_code)
+    start = time.monotonic()
+    try:
+        async with engine.connect() as conn:
+            if not in_filter:
+                rows = (await conn.execute(*short_code_filter.catch_up_query())).all()
+                short_code_filter.apply_catch_up(rows)
+                if short_code not in short_code_filter:
+                    short_code_filter.rejections += 1
+                    db_breaker.record_success(time.monotonic() - start)
+                    return None
+            row = (await conn.execute(LOOKUP_STATEMENT, {'short_code': short_code})).first()
+    except Exception as exc:
+        db_breaker.record_failure(reason=str(exc).splitlines()[0])
+        return _stale_or_unavailable(short_code)
+    db_breaker.record_success(time.monotonic() - start)
+    return _remember(short_code, row)
+
+
+def _stale_or_unavailable(short_code):
+    entry = redirect_cache.get_stale(short_code)
+    if entry is None:
+        raise LookupUnavailable(short_code)
+    return entry
+
+
+def load_short_codes(executor=None):
+    """Build this worker's short-code filter, and the shared index if missing."""
+    executor = executor if executor is not None else db.session
+    try:
+        short_code_filter.load(executor)
+    except Exception:
+        logger.exception("Could not load the short-code filter; unknown codes will hit the database")
+    if short_code_index.enabled and not os.path.exists(short_code_index.path):
+        try:
+            short_code_index.ensure_built(
+                executor.execute(select(QRCode.short_code, QRCode.id, QRCode.target_url)).all()
+            )
+        except Exception:
+            logger.exception("Could not build the short-code index at %s", short_code_index.path)
+
+
+def register_short_code(short_code, qr_id, target_url):
+    """Record a QRCode just created by this worker."""
+    short_code_filter.add(short_code)
+    negative_cache.discard(short_code)
+    if short_code_index.enabled:
+        short_code_index.upsert(short_code, qr_id, target_url)
+
+
+def invalidate_short_code(short_code, qr_id, target_url):
+    """Refresh short_code after its target URL changed."""
+    redirect_cache.invalidate(short_code)
+    if short_code_index.enabled:
+        short_code_index.upsert(short_code, qr_id, target_url)
+
+
+def remove_short_code(short_code):
+    """Forget a QRCode just deleted by this worker."""
+    redirect_cache.invalidate(short_code)
+    short_code_filter.remove(short_code)
+    if short_code_index.enabled:
+        short_code_index.delete(short_code)
@@ -0,0 +1,76 @@
+"""Minimal WSGI application serving only /r/<short_code> redirects.
+
+This skips everything create_app() puts in front of the redirect route:
+ProxyFix, the before_request logging hook, Flask-CORS, the blueprint URL map
+and Werkzeug's HTML redirect body. It shares the short-code cache, circuit
+breaker and batched scan writer with the full app, so scans are recorded
+the same way.
+
+Run it as its own service next to the API, for example:
+
+    gunicorn --chdir backend --workers=4 --threads=4 --worker-class=gthread redirect_wsgi:application
+
+and route /r/ to it at the proxy.
+"""
+import os
+
+from redirect_cache import LookupUnavailable, load_short_codes, resolve_short_code
+from scan_capture import client_address, record_scan, with_scan_token
+from scan_writer import scan_writer
+from standalone_db import EngineExecutor, create_standalone_engine
+
+PREFIX = '/r/'
+
+_NOT_FOUND = b'Not Found'
+_UNAVAILABLE = b'Service Unavailable'
+
+
+def _plain(start_response, status, body, extra_headers=()):
+    start_response(status, [
+        ('Content-Type', 'text/plain; charset=utf-8'),
+        ('Content-Length', str(len(body))),
+        *extra_headers,
+    ])
+    return [body]
+
+
+def create_redirect_app(engine=None):
+    """Build the redirect WSGI callable, writing scans through engine."""
+    if engine is None:
+        engine = create_standalone_engine(
+            pool_size=int(os.getenv('REDIRECT_POOL_SIZE', 5)),
+            max_overflow=int(os.getenv('REDIRECT_MAX_OVERFLOW', 10)),
+        )
+    scan_writer.init_engine(engine)
+    executor = EngineExecutor(engine)
+    load_short_codes(executor)
+
+    def application(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(PREFIX):
+            return _plain(start_response, '404 Not Found', _NOT_FOUND)
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return _plain(start_response, '405 Method Not Allowed', b'Method Not Allowed',
+                          [('Allow', 'GET, HEAD')])
+        short_code = path[len(PREFIX):]
+        if not short_code or '/' in short_code:
+            return _plain(start_response, '404 Not Found', _NOT_FOUND)
+
+        try:
+            entry = resolve_short_code(short_code, executor)
+        except LookupUnavailable:
+            return _plain(start_response, '503 Service Unavailable', _UNAVAILABLE,
+                          [('Retry-After', '5')])
+        if entry is None:
+            return _plain(start_response, '404 Not Found', _NOT_FOUND)
+
+        ip_address = client_address(environ.get('HTTP_X_FORWARDED_FOR'), environ.get('REMOTE_ADDR'))
+        token = record_scan(entry.qr_id, ip_address, environ.get('HTTP_USER_AGENT'), environ.get('HTTP_REFERER'),
+                            environ['REQUEST_METHOD'])
+        start_response('302 Found', [('Location', with_scan_token(entry.location, token)), ('Content-Length', '0')])
+        return [b'']
+
+    return application
+
+
+application = create_redirect_app()
@@ -0,0 +1,87 @@
+"""Engagement beacon for landing pages reached through a QR redirect.
+
+With SCAN_TOKEN_PARAM set, every redirect adds the scan token to the
+target URL. The landing page sends it back with navigator.sendBeacon,
+for example on visibilitychange:
+
+    navigator.sendBeacon('https://api.example.com/api/beacon',
+        JSON.stringify({token: token, time_on_page: seconds, scrolled: scrolled}));
+
+A string body is sent as text/plain, which needs no CORS preflight. The
+body may be one report or an array of them; form-encoded bodies with the
+same fields are accepted too. Reports are only buffered here (see
+engagement.py), so the endpoint does no database work. At most
+BEACON_MAX_BYTES of a body are read, with or without a Content-Length.
+"""
+import io
+import json
+import math
+import os
+
+from flask import Blueprint, jsonify, request
+from werkzeug.formparser import FormDataParser
+
+from engagement import engagement_buffer
+from scan_writer import scan_writer
+
+bp = Blueprint('beacon', __name__, url_prefix='/api')
+
+BEACON_MAX_BYTES = int(os.getenv('BEACON_MAX_BYTES', 16384))
+BEACON_MAX_REPORTS = 100
+
+
+def _read_body():
+    """The request body, or None if it is longer than BEACON_MAX_BYTES.
+
+    A chunked body has no Content-Length, so the read itself is capped.
+    """
+    data = request.stream.read(BEACON_MAX_BYTES + 1)
+    return None if len(data) > BEACON_MAX_BYTES else data
+
+
+def _reports(body):
+    if request.mimetype in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+        _, form, _ = FormDataParser().parse(io.BytesIO(body), request.mimetype, len(body), request.mimetype_params)
+        return [form.to_dict()]
+    payload = json.loads(body.decode('utf-8') or 'null')
+    return payload if isinstance(payload, list) else [payload]
+
+
+def _seconds(value):
+    """Whole seconds from a number or numeric string, None if absent; ValueError
+    for anything else, including infinities and NaN."""
+    if value is None or value == '':
+        return None
+    seconds = float(value)
+    if not math.isfinite(seconds):
+        raise ValueError(f"time_on_page is not finite: {value!r}")
+    return int(seconds)
+
+
+@bp.route('/beacon', methods=['POST'])
+def engagement_beacon():
+    if request.content_length is not None and request.content_length > BEACON_MAX_BYTES:
+        return jsonify({"msg": "Beacon too large"}), 413
+    body = _read_body()
+    if body is None:
+        return jsonify({"msg": "Beacon too large"}), 413
+    try:
+        reports = _reports(body)
+    except ValueError:
+        return jsonify({"msg": "Beacon body must be JSON"}), 400
+    accepted = 0
+    for report in reports[:BEACON_MAX_REPORTS]:
+        if not isinstance(report, dict):
+            continue
+        scrolled = report.get('scrolled', False)
+        if isinstance(scrolled, str):
+            scrolled = scrolled.lower() in ('1', 'true', 'yes', 'on')
+        try:
+            time_on_page = _seconds(report.get('time_on_page'))
+        except (TypeError, ValueError):
+            continue
+        if engagement_buffer.add(report.get('token'), time_on_page, scrolled):
+            accepted += 1
+    if accepted:
+        scan_writer.ensure_running()
+    return '', 204
@@ -2,6 +2,8 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import QRCode
 from extensions import db
+from redirect_cache import register_short_code
+from short_code_allocator import short_code_allocator
 
 bp = Blueprint('folders', __name__, url_prefix='/api/folders')
 
@@ -35,7 +37,7 @@ def create_folder():
     dummy_qr = QRCode(
         name=f"Folder: {name} (placeholder)",
         target_url="https://example.com/folder-placeholder",
-        short_code="folder" + name.replace(" ", "").lower()[:6],
+        short_code=short_code_allocator.allocate(),
         folder=name,
         user_id=current_user_id
     )
@@ -46,5 +48,6 @@ def create_folder():
         db.session.rollback()
         logger.error(f"Failed to create dummy QR for folder '{name}': {e}")
         return jsonify({'msg': 'Failed to create folder', 'error': str(e)}), 500
+    register_short_code(dummy_qr.short_code, dummy_qr.id, dummy_qr.target_url)
     logger.info(f"Folder '{name}' created successfully with dummy QR id {dummy_qr.id}")
     return jsonify({'msg': 'Folder created', 'name': name, 'dummy_qrcode_id': dummy_qr.id}), 201
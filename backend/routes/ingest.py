@@ -0,0 +1,293 @@
+"""Bulk upload of scans recorded elsewhere (NFC kiosks, partner apps).
+
+POST /api/scans/ingest takes either NDJSON (Content-Type
+application/x-ndjson, one event per line) or a JSON array of events. Both
+are read and validated incrementally from the request stream and written
+in chunks of INGEST_CHUNK_SIZE rows, each chunk in its own transaction.
+An event looks like:
+
+    {"id": "kiosk-7-000123", "short_code": "3xY9", "timestamp": "2026-10-16T09:30:00Z",
+     "scan_method": "nfc", "ip_address": "...", "user_agent": "...", "referrer": "...",
+     "time_on_page": 42, "scrolled": true}
+
+qr_code_id may be given instead of short_code; either must name one of
+the uploading user's QR codes. The event id is the idempotency key: it is
+stored (namespaced by the uploading user) as the scan's ingest_key, so a
+retried upload inserts nothing twice. Events without an id get a key from
+the upload's Idempotency-Key header and their position; with neither they
+are rejected, since two genuine scans can look exactly alike.
+"""
+import codecs
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import select
+
+from counters import upsert_counts
+from dimensions import encode_scan_rows
+from extensions import db
+from models import QRCode, Scan, ScanCount
+from scan_writer import SCAN_COLUMNS, insert_scans_statement
+
+bp = Blueprint('ingest', __name__, url_prefix='/api/scans')
+
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 500))
+INGEST_MAX_EVENTS = int(os.getenv('INGEST_MAX_EVENTS', 100000))
+MAX_REPORTED_ERRORS = 100
+
+_READ_SIZE = 64 * 1024
+_qrcodes = QRCode.__table__
+_scans = Scan.__table__
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def _iter_ndjson(stream):
+    buffered = b''
+    while True:
+        chunk = stream.read(_READ_SIZE)
+        if not chunk:
+            break
+        buffered += chunk
+        *lines, buffered = buffered.split(b'\n')
+        for line in lines:
+            yield line
+    yield buffered
+
+
+def _iter_json_array(stream):
+    """Yield the raw elements of a top-level JSON array without reading it whole."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    text = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        while pos < len(text) and text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(text):
+            if not started:
+                if text[pos] != '[':
+                    raise InvalidEvent("Expected a JSON array of scan events")
+                started = True
+                pos += 1
+                continue
+            if text[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                if eof:
+                    raise InvalidEvent("Malformed JSON array")
+            else:
+                # A number is only complete once a delimiter follows it:
+                # "12" or "1e" may continue in the next chunk.
+                if eof or not isinstance(value, (int, float)) or (end < len(text) and text[end] in ' \t\r\n,]'):
+                    yield value
+                    pos = end
+                    continue
+                if end < len(text) and text[end] not in '0123456789.eE+-':
+                    raise InvalidEvent("Malformed JSON array")
+        elif eof:
+            raise InvalidEvent("Unterminated JSON array")
+        chunk = stream.read(_READ_SIZE)
+        if not chunk:
+            eof = True
+        text = text[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+
+
+def _iter_events(stream, ndjson):
+    if ndjson:
+        for line in _iter_ndjson(stream):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield InvalidEvent("Malformed JSON line")
+    else:
+        yield from _iter_json_array(stream)
+
+
+def _parse_timestamp(value):
+    if value is None:
+        return datetime.utcnow()
+    if not isinstance(value, str):
+        raise InvalidEvent("timestamp must be an ISO 8601 string")
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidEvent(f"Invalid timestamp: {value!r}")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _text(event, field, limit):
+    value = event.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise InvalidEvent(f"{field} must be a string")
+    return value[:limit]
+
+
+def _ingest_key(user_id, event, upload_key, index):
+    event_id = event.get('id')
+    if event_id is not None:
+        if not isinstance(event_id, (str, int)) or len(str(event_id)) > 200:
+            raise InvalidEvent("id must be a string of at most 200 characters")
+        source = f"id:{event_id}"
+    elif upload_key:
+        source = f"upload:{upload_key}:{index}"
+    else:
+        raise InvalidEvent("id is required when the upload has no Idempotency-Key header")
+    return hashlib.blake2b(f"{user_id}\0{source}".encode(), digest_size=16).hexdigest()
+
+
+def validate_event(event, user_id, upload_key, index):
+    """Return (qr reference, scan row) for one event; the reference is resolved per chunk."""
+    if not isinstance(event, dict):
+        raise InvalidEvent("Each scan event must be a JSON object")
+    short_code = event.get('short_code')
+    qr_code_id = event.get('qr_code_id')
+    if short_code is not None and isinstance(short_code, str):
+        reference = ('short_code', short_code)
+    elif isinstance(qr_code_id, int) and not isinstance(qr_code_id, bool):
+        reference = ('id', qr_code_id)
+    else:
+        raise InvalidEvent("short_code or qr_code_id is required")
+    time_on_page = event.get('time_on_page')
+    if time_on_page is not None and (not isinstance(time_on_page, int) or isinstance(time_on_page, bool)
+                                     or time_on_page < 0):
+        raise InvalidEvent("time_on_page must be a non-negative integer")
+    scrolled = event.get('scrolled', False)
+    if not isinstance(scrolled, bool):
+        raise InvalidEvent("scrolled must be true or false")
+    user_agent = _text(event, 'user_agent', 2000) or ''
+    row = dict.fromkeys(SCAN_COLUMNS)
+    row.update({
+        'timestamp': _parse_timestamp(event.get('timestamp')),
+        'ip_address': _text(event, 'ip_address', 50),
+        'user_agent': user_agent,
+        'referrer_domain': _text(event, 'referrer', 200),
+        'scan_method': _text(event, 'scan_method', 50) or 'api',
+        'scrolled': scrolled,
+        'ingest_key': _ingest_key(user_id, event, upload_key, index),
+        'duplicate_count': 0,
+        'sample_weight': 1,
+    })
+    row['time_on_page'] = time_on_page
+    return reference, row
+
+
+class _Upload:
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.received = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, index, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'index': index, 'error': message})
+
+    def write(self, chunk):
+        """Resolve the chunk's QR references and insert its rows; chunk is [(index, reference, row)]."""
+        short_codes = {ref for _, (kind, ref), _ in chunk if kind == 'short_code'}
+        ids = {ref for _, (kind, ref), _ in chunk if kind == 'id'}
+        by_code, known_ids = {}, set()
+        if short_codes:
+            by_code = dict(db.session.execute(
+                select(_qrcodes.c.short_code, _qrcodes.c.id).where(
+                    _qrcodes.c.short_code.in_(short_codes), _qrcodes.c.user_id == self.user_id)).all())
+        if ids:
+            known_ids = set(db.session.execute(select(_qrcodes.c.id).where(
+                _qrcodes.c.id.in_(ids), _qrcodes.c.user_id == self.user_id)).scalars())
+
+        rows = []
+        for index, (kind, ref), row in chunk:
+            qr_id = by_code.get(ref) if kind == 'short_code' else (ref if ref in known_ids else None)
+            if qr_id is None:
+                self.reject(index, f"Unknown QR code {ref!r}")
+                continue
+            row['qr_code_id'] = qr_id
+            rows.append(row)
+        if not rows:
+            return
+
+        conn = db.session.connection()
+        insert = insert_scans_statement(conn.dialect.name).returning(_scans.c.ingest_key)
+        stored = set(conn.execute(insert, encode_scan_rows(conn, rows)).scalars())
+        counts = {}
+        for row in rows:
+            # The same id twice in one chunk is stored, and counted, once.
+            if row['ingest_key'] in stored:
+                stored.discard(row['ingest_key'])
+                key = (row['qr_code_id'], row['timestamp'].date())
+                counts[key] = counts.get(key, 0) + 1
+                self.inserted += 1
+            else:
+                self.duplicates += 1
+        if counts:
+            upsert_counts(conn, ScanCount.__table__, counts)
+        db.session.commit()
+
+    def summary(self):
+        return {
+            'received': self.received,
+            'inserted': self.inserted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+
+@bp.route('/ingest', methods=['POST'])
+@jwt_required()
+def ingest_scans():
+    user_id = get_jwt_identity()
+    upload_key = request.headers.get('Idempotency-Key')
+    ndjson = request.mimetype in ('application/x-ndjson', 'application/jsonl', 'application/ndjson')
+    if not ndjson and request.mimetype != 'application/json':
+        return jsonify({"msg": "Send application/json (an array of scan events) or application/x-ndjson"}), 415
+
+    upload = _Upload(int(user_id))
+    chunk = []
+    try:
+        for index, event in enumerate(_iter_events(request.stream, ndjson)):
+            if index >= INGEST_MAX_EVENTS:
+                upload.reject(index, f"At most {INGEST_MAX_EVENTS} events are accepted per upload")
+                break
+            upload.received += 1
+            try:
+                if isinstance(event, InvalidEvent):
+                    raise event
+                reference, row = validate_event(event, user_id, upload_key, index)
+            except InvalidEvent as exc:
+                upload.reject(index, str(exc))
+                continue
+            chunk.append((index, reference, row))
+            if len(chunk) >= INGEST_CHUNK_SIZE:
+                upload.write(chunk)
+                chunk = []
+    except (InvalidEvent, UnicodeDecodeError) as exc:
+        upload.write(chunk)
+        summary = upload.summary()
+        summary['msg'] = str(exc)
+        return jsonify(summary), 400
+    upload.write(chunk)
+    return jsonify(upload.summary()), 200
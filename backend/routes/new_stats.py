@@ -1,6 +1,6 @@
 from flask import Blueprint, jsonify, request, Response
 from flask_jwt_extended import jwt_required
-from models import db, QRCode, Scan
+from models import db, DeviceType, QRCode, Scan
 from datetime import datetime, timedelta
 import csv
 
@@ -10,7 +10,7 @@ bp = Blueprint('new_stats', __name__, url_prefix='/api/newstats')
 @jwt_required()
 def quick_qrcode_stats(qrcode_id):
     qrcode = QRCode.query.get_or_404(qrcode_id)
-    scans = Scan.query.filter_by(qr_code_id=qrcode_id).order_by(Scan.timestamp.desc()).all()
+    scans = Scan.with_names(Scan.device).filter_by(qr_code_id=qrcode_id).order_by(Scan.timestamp.desc()).all()
     scan_data = [
         {
             'scan_id': scan.id,
@@ -44,9 +44,11 @@ def export_all_scans_new():
         Scan.ip_address,
         Scan.country,
         Scan.city,
-        Scan.device_type,
+        DeviceType.value.label('device_type'),
         Scan.scan_method
-    ).join(QRCode, QRCode.id == Scan.qr_code_id).order_by(Scan.timestamp.desc()).all()
+    ).join(QRCode, QRCode.id == Scan.qr_code_id).outerjoin(
+        DeviceType, DeviceType.id == Scan.device_type_id
+    ).order_by(Scan.timestamp.desc()).all()
 
     def generate():
         header = ['scan_id', 'qr_code_id', 'qr_name', 'timestamp', 'ip_address', 'country', 'city', 'device_type', 'scan_method']
@@ -1,14 +1,33 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import db, QRCode, Scan
+from qr_render import MAX_IMAGE_SIZE, MIN_IMAGE_SIZE, RENDERERS, data_uri, negotiate_format, qr_renderer
+from redirect_cache import invalidate_short_code, register_short_code
+from short_code_allocator import short_code_allocator
 from datetime import datetime, timedelta
 from sqlalchemy import func, and_
-import uuid
+import os
 
 bp = Blueprint('qrcodes', __name__, url_prefix='/api/qrcodes')
 
 # No user-specific filtering
 
+def _image_options(negotiate=False):
+    """format= and size= query parameters for a QR image, and an error
+    message if they are invalid. Without format= the image endpoint goes by
+    the Accept header; the JSON endpoints default to PNG."""
+    image_format = request.args.get('format')
+    if image_format is None:
+        image_format = negotiate_format(request.accept_mimetypes) if negotiate else 'png'
+    if image_format not in RENDERERS:
+        return None, f"format must be one of {', '.join(sorted(RENDERERS))}"
+    size = request.args.get('size')
+    if size is not None:
+        if not size.isdigit() or not MIN_IMAGE_SIZE <= int(size) <= MAX_IMAGE_SIZE:
+            return None, f"size must be an integer between {MIN_IMAGE_SIZE} and {MAX_IMAGE_SIZE}"
+        size = int(size)
+    return {'image_format': image_format, 'size': size}, None
+
 @bp.route('', methods=['GET'])
 @jwt_required()
 def get_qrcodes():
@@ -50,7 +69,7 @@ def get_qrcode(qrcode_id):
             'time_on_page': scan.time_on_page,
             'scrolled': scan.scrolled,
             'scan_method': scan.scan_method
-        } for scan in qrcode.scans],
+        } for scan in Scan.with_names().filter_by(qr_code_id=qrcode.id)],
         'short_url': f"{request.host_url}r/{qrcode.short_code}"
     })
 
@@ -70,33 +89,13 @@ def get_qrcode_flexible(identifier):
             return jsonify({'msg': 'QR code not found'}), 404
 
         logging.info(f"[flex] Found QR code: id={qrcode.id}, short_code={qrcode.short_code}, name={qrcode.name}")
-        # Generate QR code image as base64
-        from io import BytesIO
-        import qrcode as qrcode_lib
-        import base64
-        qr = qrcode_lib.QRCode(
-            version=1,
-            error_correction=qrcode_lib.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qrcode.target_url)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffered = BytesIO()
-        # Robustly ensure img is a true PIL Image before saving
-        if hasattr(img, "get_image"):
-            img = img.get_image()
-        elif hasattr(img, "to_image"):
-            img = img.to_image()
-        elif not hasattr(img, "save"):
-            logging.error(f"QR make_image returned unexpected type: {type(img)}")
-            raise TypeError(f"QR make_image returned unexpected type: {type(img)}")
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        options, error = _image_options()
+        if error:
+            return jsonify({'msg': error}), 400
+        image = qr_renderer.render(qrcode.target_url, **options)
 
         scan_dicts = []
-        for scan in qrcode.scans:
+        for scan in Scan.with_names().filter_by(qr_code_id=qrcode.id):
             try:
                 scan_info = {
                     'id': scan.id,
@@ -123,7 +122,7 @@ def get_qrcode_flexible(identifier):
             'id': qrcode.id,
             'name': qrcode.name,
             'short_code': qrcode.short_code,
-            'qr_code_image': f"data:image/png;base64,{img_str}",
+            'qr_code_image': data_uri(image),
 
             'target_url': qrcode.target_url,
             'created_at': qrcode.created_at.isoformat() if qrcode.created_at else None,
@@ -138,32 +137,11 @@ def get_qrcode_flexible(identifier):
 @bp.route('/shortcode/<short_code>', methods=['GET'])
 @jwt_required()
 def get_qrcode_by_short_code(short_code):
-    from io import BytesIO
-    import qrcode as qrcode_lib
-    import base64
+    options, error = _image_options()
+    if error:
+        return jsonify({'msg': error}), 400
     qrcode = QRCode.query.filter_by(short_code=short_code).first_or_404()
-    # Generate QR code image
-    qr = qrcode_lib.QRCode(
-        version=1,
-        error_correction=qrcode_lib.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(qrcode.target_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffered = BytesIO()
-    # Robustly ensure img is a true PIL Image before saving
-    if hasattr(img, "get_image"):
-        img = img.get_image()
-    elif hasattr(img, "to_image"):
-        img = img.to_image()
-    elif not hasattr(img, "save"):
-        import logging
-        logging.error(f"QR make_image returned unexpected type: {type(img)}")
-        raise TypeError(f"QR make_image returned unexpected type: {type(img)}")
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    image = qr_renderer.render(qrcode.target_url, **options)
     return jsonify({
         "id": qrcode.id,
         "name": qrcode.name,
@@ -171,7 +149,7 @@ def get_qrcode_by_short_code(short_code):
         "target_url": qrcode.target_url,
         "folder": qrcode.folder,
         "created_at": qrcode.created_at.isoformat(),
-        "qr_code_image": f"data:image/png;base64,{img_str}",
+        "qr_code_image": data_uri(image),
         "short_url": f"{request.host_url}r/{short_code}"
     })
 
@@ -181,7 +159,7 @@ def download_scans_csv_by_short_code(short_code):
     from io import StringIO
     from flask import Response
     qrcode = QRCode.query.filter_by(short_code=short_code).first_or_404()
-    scans = qrcode.scans
+    scans = Scan.with_names().filter_by(qr_code_id=qrcode.id)
     output = StringIO()
     writer = csv.writer(output)
     # Write header
@@ -218,31 +196,17 @@ def download_scans_csv_by_short_code(short_code):
 @bp.route('/image-by-shortcode/<short_code>', methods=['GET'])
 def get_qr_image_by_short_code(short_code):
     from io import BytesIO
-    import qrcode as qrcode_lib
     from flask import send_file
+    options, error = _image_options(negotiate=True)
+    if error:
+        return jsonify({'msg': error}), 400
     qrcode = QRCode.query.filter_by(short_code=short_code).first_or_404()
-    qr = qrcode_lib.QRCode(
-        version=1,
-        error_correction=qrcode_lib.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(qrcode.target_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    # Robust PIL Image conversion
-    if hasattr(img, "get_image"):
-        img = img.get_image()
-    elif hasattr(img, "to_image"):
-        img = img.to_image()
-    elif not hasattr(img, "save"):
-        import logging
-        logging.error(f"QR make_image returned unexpected type: {type(img)}")
-        raise TypeError(f"QR make_image returned unexpected type: {type(img)}")
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    buffered.seek(0)
-    return send_file(buffered, mimetype='image/png')
+    image = qr_renderer.render(qrcode.target_url, **options)
+    # The content hash is the ETag, so a browser's revalidation gets a 304.
+    response = send_file(BytesIO(image.data), mimetype=image.mimetype, etag=image.key)
+    if 'format' not in request.args:
+        response.vary.add('Accept')
+    return response
 
 @bp.route('/<int:qrcode_id>', methods=['PUT'])
 @jwt_required()
@@ -250,14 +214,18 @@ def update_qrcode(qrcode_id):
     data = request.get_json()
     qrcode = QRCode.query.get_or_404(qrcode_id)
     
+    target_changed = False
     if 'name' in data:
         qrcode.name = data['name']
     if 'target_url' in data:
+        target_changed = data['target_url'] != qrcode.target_url
         qrcode.target_url = data['target_url']
     if 'folder' in data:
         qrcode.folder = data['folder']
     
     db.session.commit()
+    if target_changed:
+        invalidate_short_code(qrcode.short_code, qrcode.id, qrcode.target_url)
     
     return jsonify({
         'id': qrcode.id,
@@ -280,12 +248,13 @@ def create_qrcode():
     qrcode = QRCode(
         name=data.get('name', 'Untitled QR Code'),
         target_url=data['target_url'],
-        short_code=str(uuid.uuid4())[:8],
+        short_code=short_code_allocator.allocate(),
         folder=data.get('folder')
     )
     
     db.session.add(qrcode)
     db.session.commit()
+    register_short_code(qrcode.short_code, qrcode.id, qrcode.target_url)
     
     return jsonify({
         'id': qrcode.id,
@@ -295,3 +264,46 @@ def create_qrcode():
         'created_at': qrcode.created_at.isoformat(),
         'folder': qrcode.folder
     }), 201
+
+QR_BATCH_MAX = int(os.getenv('QR_BATCH_MAX', 1000))
+
+@bp.route('/batch', methods=['POST'])
+@jwt_required()
+def create_qrcodes_batch():
+    """Create many QR codes at once; their short codes are reserved in one block."""
+    data = request.get_json()
+    items = data.get('qrcodes') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"msg": "A non-empty list of QR codes is required"}), 400
+    if len(items) > QR_BATCH_MAX:
+        return jsonify({"msg": f"At most {QR_BATCH_MAX} QR codes can be created per request"}), 400
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('target_url'):
+            return jsonify({"msg": f"Target URL is required (item {i})"}), 400
+
+    user_id = get_jwt_identity()
+    short_codes = short_code_allocator.allocate_many(len(items))
+    qrcodes = [
+        QRCode(
+            name=item.get('name', 'Untitled QR Code'),
+            target_url=item['target_url'],
+            short_code=short_code,
+            folder=item.get('folder'),
+            user_id=user_id
+        )
+        for item, short_code in zip(items, short_codes)
+    ]
+    db.session.add_all(qrcodes)
+    db.session.commit()
+    for qrcode in qrcodes:
+        register_short_code(qrcode.short_code, qrcode.id, qrcode.target_url)
+
+    return jsonify([{
+        'id': qrcode.id,
+        'name': qrcode.name,
+        'short_code': qrcode.short_code,
+        'target_url': qrcode.target_url,
+        'created_at': qrcode.created_at.isoformat(),
+        'folder': qrcode.folder,
+        'short_url': f"{request.host_url}r/{qrcode.short_code}"
+    } for qrcode in qrcodes]), 201
@@ -1,101 +1,168 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, abort, jsonify, request
 from flask_jwt_extended import jwt_required
-from models import db, QRCode, Scan
-from sqlalchemy import func
-from datetime import datetime
+from models import db, BotHit, BrowserFamily, DeviceType, OsFamily, QRCode, Referrer, Scan, ScanCount, ScanGeoCount
+from sqlalchemy import bindparam, func, select
+from datetime import date, datetime
+from geohash import GEOHASH_PRECISION, decode as geohash_decode
+from server_timing import stage, timed
 
 bp = Blueprint('qrcodes_stats', __name__, url_prefix='/api/qrcodes')
 
+# One round trip for the summary: the code's own columns plus the scan
+# aggregates, built once and executed with a bound qrcode_id. The total
+# comes from scan_counts, which stays exact when raw scans are sampled.
+_qrcodes = QRCode.__table__
+_scans = Scan.__table__
+_scan_counts = ScanCount.__table__
+QRCODE_STATS_STATEMENT = select(
+    _qrcodes.c.id,
+    _qrcodes.c.name,
+    _qrcodes.c.short_code,
+    select(func.coalesce(func.sum(_scan_counts.c.count), 0)).where(
+        _scan_counts.c.qr_code_id == _qrcodes.c.id
+    ).scalar_subquery().label('total_scans'),
+    func.max(_scans.c.timestamp).label('last_scan_time'),
+    func.count(func.distinct(_scans.c.city)).label('unique_cities'),
+    func.count(func.distinct(_scans.c.country)).label('unique_countries'),
+).select_from(
+    _qrcodes.outerjoin(_scans, _scans.c.qr_code_id == _qrcodes.c.id)
+).where(
+    _qrcodes.c.id == bindparam('qrcode_id')
+).group_by(_qrcodes.c.id, _qrcodes.c.name, _qrcodes.c.short_code)
+
+
+def _breakdown_statement(id_column, dimension):
+    """Weighted scans of one code per dimension value, grouped by the integer id."""
+    return select(dimension.c.value, func.sum(_scans.c.sample_weight)).select_from(
+        _scans.outerjoin(dimension, dimension.c.id == id_column)
+    ).where(
+        _scans.c.qr_code_id == bindparam('qrcode_id')
+    ).group_by(id_column, dimension.c.value)
+
+
+# response key -> (statement, label for scans without a value)
+BREAKDOWN_STATEMENTS = {
+    'scans_by_device': (_breakdown_statement(_scans.c.device_type_id, DeviceType.__table__), 'Unknown'),
+    'scans_by_os': (_breakdown_statement(_scans.c.os_family_id, OsFamily.__table__), 'Unknown'),
+    'scans_by_browser': (_breakdown_statement(_scans.c.browser_family_id, BrowserFamily.__table__), 'Unknown'),
+    'top_referrers': (_breakdown_statement(_scans.c.referrer_id, Referrer.__table__), ''),
+}
+
+
+# Heatmap cells come from scan_geo_counts, so their cost depends on the
+# number of days and cells a code has, not on how many scans it has. One
+# statement per precision: the prefix length has to be a literal for the
+# GROUP BY to match the selected expression.
+_geo_counts = ScanGeoCount.__table__
+HEATMAP_STATEMENTS = {}
+for _precision in range(1, GEOHASH_PRECISION + 1):
+    _cell = func.substr(_geo_counts.c.geohash, 1, _precision)
+    HEATMAP_STATEMENTS[_precision] = select(
+        _cell.label('cell'), func.sum(_geo_counts.c.count).label('count')
+    ).where(
+        _geo_counts.c.qr_code_id == bindparam('qrcode_id'),
+        _geo_counts.c.day.between(bindparam('start_day'), bindparam('end_day')),
+    ).group_by(_cell).having(func.sum(_geo_counts.c.count) > 0)
+
 @bp.route('/<int:qrcode_id>/stats', methods=['GET'])
 @jwt_required()
 def qrcode_stats(qrcode_id):
-    qrcode = QRCode.query.get_or_404(qrcode_id)
-    total_scans = db.session.query(func.count(Scan.id)).filter(Scan.qr_code_id == qrcode_id).scalar() or 0
-    last_scan = db.session.query(Scan).filter(Scan.qr_code_id == qrcode_id).order_by(Scan.timestamp.desc()).first()
-    last_scan_time = last_scan.timestamp.isoformat() if last_scan else None
-    unique_cities = db.session.query(func.count(func.distinct(Scan.city))).filter(Scan.qr_code_id == qrcode_id).scalar() or 0
-    unique_countries = db.session.query(func.count(func.distinct(Scan.country))).filter(Scan.qr_code_id == qrcode_id).scalar() or 0
+    row = db.session.execute(QRCODE_STATS_STATEMENT, {'qrcode_id': qrcode_id}).first()
+    if row is None:
+        abort(404)
     return jsonify({
-        'id': qrcode.id,
-        'name': qrcode.name,
-        'short_code': qrcode.short_code,
-        'total_scans': total_scans,
-        'last_scan_time': last_scan_time,
-        'unique_cities': unique_cities,
-        'unique_countries': unique_countries
+        'id': row.id,
+        'name': row.name,
+        'short_code': row.short_code,
+        'total_scans': row.total_scans,
+        'last_scan_time': row.last_scan_time.isoformat() if row.last_scan_time else None,
+        'unique_cities': row.unique_cities,
+        'unique_countries': row.unique_countries
     })
 
 @bp.route('/<int:qrcode_id>/enhanced-stats', methods=['GET'])
+@timed
 @jwt_required()
 def qrcode_enhanced_stats(qrcode_id):
-    qrcode = QRCode.query.get_or_404(qrcode_id)
-    # Daily scans for all time
-    daily_scans = db.session.query(
-        func.date(Scan.timestamp).label('date'),
-        func.count(Scan.id).label('count')
-    ).filter(
-        Scan.qr_code_id == qrcode_id
-    ).group_by(
-        func.date(Scan.timestamp)
-    ).order_by(
-        func.date(Scan.timestamp)
-    ).all()
+    with stage('lookup'):
+        qrcode = QRCode.query.get_or_404(qrcode_id)
+    # Daily scans for all time, exact even for sampled codes
+    with stage('daily'):
+        daily_scans = db.session.query(
+            ScanCount.day, ScanCount.count
+        ).filter(
+            ScanCount.qr_code_id == qrcode_id
+        ).order_by(ScanCount.day).all()
     formatted_daily_scans = [{'date': date.isoformat(), 'count': count} for date, count in daily_scans]
 
     # All-time scan list and aggregated stats
-    scans = Scan.query.filter_by(qr_code_id=qrcode_id).all()
+    with stage('scans'):
+        scans = Scan.with_names().filter_by(qr_code_id=qrcode_id).all()
     scan_list = []
     from collections import defaultdict
     scans_by_country = defaultdict(int)
-    scans_by_device = defaultdict(int)
-    scans_by_os = defaultdict(int)
-    scans_by_browser = defaultdict(int)
     scans_by_hour = defaultdict(int)
     scans_by_weekday = defaultdict(int)
-    top_referrers = defaultdict(int)
     total_time = 0
     scroll_count = 0
+    # Sampled rows stand for sample_weight scans each.
+    sampled_total = 0
 
-    for scan in scans:
-        # Raw scan data
-        scan_list.append({
-            'id': scan.id,
-            'timestamp': scan.timestamp.isoformat() if scan.timestamp else None,
-            'ip_address': scan.ip_address,
-            'user_agent': scan.user_agent,
-            'country': scan.country,
-            'region': scan.region,
-            'city': scan.city,
-            'device_type': scan.device_type,
-            'os_family': scan.os_family,
-            'browser_family': scan.browser_family,
-            'referrer_domain': scan.referrer_domain,
-            'time_on_page': scan.time_on_page,
-            'scrolled': scan.scrolled,
-            'scan_method': scan.scan_method
-        })
-
-        # Aggregations
-        scans_by_country[scan.country or 'Unknown'] += 1
-        scans_by_device[scan.device_type or 'Unknown'] += 1
-        scans_by_os[scan.os_family or 'Unknown'] += 1
-        scans_by_browser[scan.browser_family or 'Unknown'] += 1
-
-        if scan.timestamp:
-            scans_by_hour[scan.timestamp.hour] += 1
-            weekday = scan.timestamp.isoweekday() % 7
-            scans_by_weekday[weekday] += 1
-
-        if scan.time_on_page is not None:
-            total_time += scan.time_on_page
-        if scan.scrolled:
-            scroll_count += 1
-
-        top_referrers[scan.referrer_domain or ''] += 1
-
-    total_scans = len(scans)
-    avg_time_on_page = round(total_time / total_scans, 2) if total_scans else 0
-    scroll_rate = round((scroll_count / total_scans) * 100, 0) if total_scans else 0
+    with stage('aggregate'):
+        for scan in scans:
+            # Raw scan data
+            scan_list.append({
+                'id': scan.id,
+                'timestamp': scan.timestamp.isoformat() if scan.timestamp else None,
+                'ip_address': scan.ip_address,
+                'user_agent': scan.user_agent,
+                'country': scan.country,
+                'region': scan.region,
+                'city': scan.city,
+                'device_type': scan.device_type,
+                'os_family': scan.os_family,
+                'browser_family': scan.browser_family,
+                'referrer_domain': scan.referrer_domain,
+                'time_on_page': scan.time_on_page,
+                'scrolled': scan.scrolled,
+                'scan_method': scan.scan_method,
+                'sample_weight': scan.sample_weight
+            })
+
+            # Aggregations
+            weight = scan.sample_weight or 1
+            sampled_total += weight
+            scans_by_country[scan.country or 'Unknown'] += weight
+
+            if scan.timestamp:
+                scans_by_hour[scan.timestamp.hour] += weight
+                weekday = scan.timestamp.isoweekday() % 7
+                scans_by_weekday[weekday] += weight
+
+            if scan.time_on_page is not None:
+                total_time += scan.time_on_page * weight
+            if scan.scrolled:
+                scroll_count += weight
+
+    # Device, OS, browser and referrer totals are grouped by dimension id.
+    with stage('breakdowns'):
+        breakdowns = {}
+        for key, (statement, missing) in BREAKDOWN_STATEMENTS.items():
+            totals = defaultdict(int)
+            for value, count in db.session.execute(statement, {'qrcode_id': qrcode_id}):
+                totals[value or missing] += count
+            breakdowns[key] = dict(totals)
+
+    with stage('bot_hits'):
+        bot_hits = dict(db.session.query(
+            BotHit.category, func.sum(BotHit.count)
+        ).filter(
+            BotHit.qr_code_id == qrcode_id
+        ).group_by(BotHit.category).all())
+
+    total_scans = sum(count for _, count in daily_scans)
+    avg_time_on_page = round(total_time / sampled_total, 2) if sampled_total else 0
+    scroll_rate = round((scroll_count / sampled_total) * 100, 0) if sampled_total else 0
 
     return jsonify({
         'id': qrcode.id,
@@ -104,14 +171,46 @@ def qrcode_enhanced_stats(qrcode_id):
         'total_scans': total_scans,
         'daily_scans': formatted_daily_scans,
         'scans_by_country': dict(scans_by_country),
-        'scans_by_device': dict(scans_by_device),
-        'scans_by_os': dict(scans_by_os),
-        'scans_by_browser': dict(scans_by_browser),
+        'scans_by_device': breakdowns['scans_by_device'],
+        'scans_by_os': breakdowns['scans_by_os'],
+        'scans_by_browser': breakdowns['scans_by_browser'],
         'scans_by_hour': dict(scans_by_hour),
         'scans_by_weekday': dict(scans_by_weekday),
         'avg_time_on_page': avg_time_on_page,
         'scroll_rate': scroll_rate,
-        'top_referrers': dict(top_referrers),
+        'top_referrers': breakdowns['top_referrers'],
+        'bot_hits': bot_hits,
         'scans': scan_list,
         
     })
+
+@bp.route('/<int:qrcode_id>/heatmap', methods=['GET'])
+@timed
+@jwt_required()
+def qrcode_heatmap(qrcode_id):
+    """Scans per geohash cell: ?precision=1..6 (default 4), optional
+    start_date/end_date as YYYY-MM-DD."""
+    try:
+        precision = int(request.args.get('precision', 4))
+        start_day = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else date.min
+        end_day = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else date.max
+    except ValueError:
+        return jsonify({'error': 'precision must be an integer and dates YYYY-MM-DD'}), 400
+    if precision not in HEATMAP_STATEMENTS:
+        return jsonify({'error': f'precision must be between 1 and {GEOHASH_PRECISION}'}), 400
+    with stage('lookup'):
+        qrcode = QRCode.query.get_or_404(qrcode_id)
+    with stage('cells'):
+        rows = db.session.execute(HEATMAP_STATEMENTS[precision], {
+            'qrcode_id': qrcode_id, 'start_day': start_day, 'end_day': end_day,
+        }).all()
+    cells = []
+    for cell, count in rows:
+        latitude, longitude = geohash_decode(cell)
+        cells.append({'geohash': cell, 'latitude': latitude, 'longitude': longitude, 'count': count})
+    return jsonify({
+        'id': qrcode.id,
+        'precision': precision,
+        'total_located_scans': sum(cell['count'] for cell in cells),
+        'cells': cells,
+    })
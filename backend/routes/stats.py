@@ -1,14 +1,16 @@
 from flask import Blueprint, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, QRCode, Scan, User
+from models import db, QRCode, Scan, ScanCount, User
 from datetime import datetime, timedelta
 from sqlalchemy import func, and_, extract
 from collections import defaultdict
 import csv
+from server_timing import stage, timed
 
 bp = Blueprint('stats', __name__, url_prefix='/api/stats')
 
 @bp.route('/dashboard', methods=['GET'])
+@timed
 @jwt_required()
 def dashboard_stats():
     from flask import request
@@ -29,30 +31,19 @@ def dashboard_stats():
 
     folder = request.args.get('folder')
 
-    # Get daily scan counts (filtered by folder)
+    # Daily and total scans come from scan_counts, which stays exact when
+    # raw scans of busy codes are sampled.
+    start_day, end_day = start_date.date(), end_date.date()
+    daily_query = db.session.query(
+        ScanCount.day,
+        func.sum(ScanCount.count).label('count')
+    ).filter(
+        ScanCount.day.between(start_day, end_day)
+    )
     if folder:
-        daily_scans = db.session.query(
-            func.date(Scan.timestamp).label('date'),
-            func.count(Scan.id).label('count')
-        ).join(QRCode, QRCode.id == Scan.qr_code_id).filter(
-            QRCode.folder == folder,
-            Scan.timestamp.between(start_date, end_date)
-        ).group_by(
-            func.date(Scan.timestamp)
-        ).order_by(
-            func.date(Scan.timestamp)
-        ).all()
-    else:
-        daily_scans = db.session.query(
-            func.date(Scan.timestamp).label('date'),
-            func.count(Scan.id).label('count')
-        ).filter(
-            Scan.timestamp.between(start_date, end_date)
-        ).group_by(
-            func.date(Scan.timestamp)
-        ).order_by(
-            func.date(Scan.timestamp)
-        ).all()
+        daily_query = daily_query.join(QRCode, QRCode.id == ScanCount.qr_code_id).filter(QRCode.folder == folder)
+    with stage('daily'):
+        daily_scans = daily_query.group_by(ScanCount.day).order_by(ScanCount.day).all()
 
     # Format daily scans for the frontend
     formatted_daily_scans = [
@@ -61,44 +52,27 @@ def dashboard_stats():
     ]
 
     # Get total scans (within range, optionally filtered by folder)
-    if folder:
-        total_scans = db.session.query(func.count(Scan.id)).join(QRCode, QRCode.id == Scan.qr_code_id).filter(
-            QRCode.folder == folder,
-            Scan.timestamp.between(start_date, end_date)
-        ).scalar() or 0
-    else:
-        total_scans = db.session.query(func.count(Scan.id)).filter(
-            Scan.timestamp.between(start_date, end_date)
-        ).scalar() or 0
+    total_scans = sum(count for _, count in daily_scans)
 
     # Get total QR codes (all time, optionally filtered by folder)
-    if folder:
-        total_qrcodes = db.session.query(func.count(QRCode.id)).filter(
-            QRCode.folder == folder
-        ).scalar() or 0
-    else:
-        total_qrcodes = db.session.query(func.count(QRCode.id)).scalar() or 0
+    with stage('qrcodes'):
+        if folder:
+            total_qrcodes = db.session.query(func.count(QRCode.id)).filter(
+                QRCode.folder == folder
+            ).scalar() or 0
+        else:
+            total_qrcodes = db.session.query(func.count(QRCode.id)).scalar() or 0
 
     # Get top 5 most scanned QR codes (within range, optionally filtered by folder)
+    scan_total = func.coalesce(func.sum(ScanCount.count), 0).label('scan_count')
+    top_query = (
+        db.session.query(QRCode, scan_total)
+        .outerjoin(ScanCount, and_(QRCode.id == ScanCount.qr_code_id, ScanCount.day.between(start_day, end_day)))
+    )
     if folder:
-        top_qrcodes = (
-            db.session.query(QRCode, func.count(Scan.id).label('scan_count'))
-            .outerjoin(Scan, and_(QRCode.id == Scan.qr_code_id, Scan.timestamp.between(start_date, end_date)))
-            .filter(QRCode.folder == folder)
-            .group_by(QRCode.id)
-            .order_by(func.count(Scan.id).desc())
-            .limit(5)
-            .all()
-        )
-    else:
-        top_qrcodes = (
-            db.session.query(QRCode, func.count(Scan.id).label('scan_count'))
-            .outerjoin(Scan, and_(QRCode.id == Scan.qr_code_id, Scan.timestamp.between(start_date, end_date)))
-            .group_by(QRCode.id)
-            .order_by(func.count(Scan.id).desc())
-            .limit(5)
-            .all()
-        )
+        top_query = top_query.filter(QRCode.folder == folder)
+    with stage('top'):
+        top_qrcodes = top_query.group_by(QRCode.id).order_by(scan_total.desc()).limit(5).all()
 
     formatted_top_qrcodes = [
         {
@@ -122,3 +96,44 @@ def dashboard_stats():
             'date_format': 'YYYY-MM-DD'
         }
     })
+
+@bp.route('/redirect-cache', methods=['GET'])
+@jwt_required()
+def redirect_cache_stats():
+    from redirect_cache import redirect_cache
+    from short_code_filter import negative_cache, short_code_filter
+    from short_code_index import short_code_index
+    stats = redirect_cache.stats()
+    stats['filter'] = short_code_filter.stats()
+    stats['negative_cache'] = negative_cache.stats()
+    stats['index'] = short_code_index.stats()
+    return jsonify(stats)
+
+@bp.route('/scan-writer', methods=['GET'])
+@jwt_required()
+def scan_writer_stats():
+    from bot_filter import bot_classifier
+    from counters import aggregate_counters
+    import dimensions
+    from engagement import engagement_buffer
+    from scan_dedup import scan_dedup
+    from scan_enrichment import scan_enricher
+    from scan_sampling import scan_sampler
+    from scan_writer import scan_writer
+    from user_agent_cache import user_agent_parser
+    stats = scan_writer.stats()
+    stats['dedup'] = scan_dedup.stats()
+    stats['sampling'] = scan_sampler.stats()
+    stats['engagement'] = engagement_buffer.stats()
+    stats['bots'] = bot_classifier.stats()
+    stats['user_agents'] = user_agent_parser.stats()
+    stats['enrichment'] = scan_enricher.stats()
+    stats['dimensions'] = dimensions.stats()
+    stats['pending_counters'] = aggregate_counters.pending()
+    return jsonify(stats)
+
+@bp.route('/qr-image-cache', methods=['GET'])
+@jwt_required()
+def qr_image_cache_stats():
+    from qr_render import qr_renderer
+    return jsonify(qr_renderer.stats())
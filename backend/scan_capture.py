@@ -0,0 +1,95 @@
+"""Turn a redirect request into a queued scan record.
+
+Shared by the Flask route and the standalone redirect WSGI app so both
+record scans the same way. Only the raw facts of a scan are queued; the
+device, OS, browser and location columns are filled in later by
+scan_enrichment.
+"""
+import os
+import uuid
+from datetime import datetime, timezone
+
+from bot_filter import bot_classifier
+from counters import aggregate_counters
+from models import BotHit, ScanCount
+from scan_dedup import DROP, scan_dedup
+from scan_sampling import scan_sampler
+from scan_writer import scan_writer
+from server_timing import stage
+
+LOCAL_ADDRESSES = frozenset(['127.0.0.1', '::1'])
+# Same meaning as ProxyFix(x_for=1) in create_app(): trust this many proxies.
+TRUSTED_PROXIES = int(os.getenv('REDIRECT_TRUSTED_PROXIES', 1))
+# What to do with bot and link-preview hits: count (daily totals in
+# bot_hits), drop, or record (store them as ordinary scans).
+BOT_SCAN_MODE = os.getenv('BOT_SCAN_MODE', 'count')
+# Query parameter that carries the scan token to the landing page, for
+# engagement beacons (see routes/beacon.py). Empty leaves target URLs as is.
+SCAN_TOKEN_PARAM = os.getenv('SCAN_TOKEN_PARAM', '')
+
+
+def client_address(forwarded_for, remote_addr):
+    """The client IP for servers that do not run behind ProxyFix."""
+    if forwarded_for and TRUSTED_PROXIES:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= TRUSTED_PROXIES:
+            return hops[-TRUSTED_PROXIES]
+    return remote_addr
+
+
+def with_scan_token(location, token):
+    """Add the scan token to a redirect Location, before any fragment."""
+    if not SCAN_TOKEN_PARAM or not token:
+        return location
+    base, sep, fragment = location.partition('#')
+    return f"{base}{'&' if '?' in base else '?'}{SCAN_TOKEN_PARAM}={token}{sep}{fragment}"
+
+
+def record_scan(qr_id, ip_address, user_agent, referrer, method='GET', block=True,
+                timestamp=None, ingest_key=None):
+    """Queue a scan of qr_id. Scans from localhost are not recorded.
+
+    Returns the scan token (its ingest_key) when a row was queued for the
+    scan, otherwise None. timestamp and ingest_key are given when scans are
+    replayed from elsewhere, such as a proxy access log; a repeated
+    ingest_key is stored only once, and de-duplication and sampling go by
+    the timestamp instead of the time of replay.
+    """
+    if ip_address in LOCAL_ADDRESSES:
+        return None
+    user_agent = user_agent or ''
+    now = timestamp or datetime.utcnow()
+    if BOT_SCAN_MODE != 'record':
+        with stage('bot_check'):
+            category = bot_classifier.classify(user_agent, method)
+        if category is not None:
+            if BOT_SCAN_MODE == 'count':
+                aggregate_counters.add(BotHit.__table__, (qr_id, now.date(), category))
+            return None
+    ingest_key = ingest_key or uuid.uuid4().hex
+    clock = now.replace(tzinfo=timezone.utc).timestamp() if timestamp else None
+    if scan_dedup.enabled:
+        first = scan_dedup.seen(qr_id, ip_address, user_agent, ingest_key, now=clock)
+        if first is not None:
+            if scan_dedup.mode != DROP:
+                scan_writer.fold(first)
+            return None
+    sample_weight = scan_sampler.weight(qr_id, now=clock)
+    if not sample_weight:
+        aggregate_counters.add(ScanCount.__table__, (qr_id, now.date()))
+        return None
+    with stage('scan_write'):
+        queued = scan_writer.enqueue({
+            'qr_code_id': qr_id,
+            'timestamp': now,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'referrer_domain': referrer,
+            'ingest_key': ingest_key,
+            'sample_weight': sample_weight,
+        }, block=block)
+    if not queued:
+        # A stored row counts itself (see scan_writer); a dropped one does not.
+        aggregate_counters.add(ScanCount.__table__, (qr_id, now.date()))
+        return None
+    return ingest_key
@@ -0,0 +1,93 @@
+"""Suppression of repeated scans from the same device.
+
+A phone often hits /r/<code> several times within seconds (camera preview,
+link unfurl, then the real open). Scans are keyed by (qr_code_id,
+ip_address, hash of the user agent) and remembered in a ring of time
+buckets covering SCAN_DEDUP_WINDOW seconds. A repeat inside the window is
+either dropped (SCAN_DEDUP_MODE=drop) or added to duplicate_count on the
+first scan's row (SCAN_DEDUP_MODE=fold) instead of becoming a new row.
+Scans replayed from a log pass their own time, so the window is measured
+between the scans rather than between their processing.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+
+OFF = 'off'
+DROP = 'drop'
+FOLD = 'fold'
+
+BUCKETS = 4
+
+
+class ScanDeduplicator:
+
+    def __init__(self, mode=OFF, window=10.0, max_keys=200000):
+        if mode not in (OFF, DROP, FOLD):
+            raise ValueError(f"Unknown scan de-duplication mode: {mode}")
+        self.mode = mode
+        self.window = window
+        self.max_keys = max_keys
+        self.bucket_seconds = window / BUCKETS
+        # (bucket number, {key: ingest_key of the first scan})
+        self._buckets = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    @property
+    def enabled(self):
+        return self.mode != OFF
+
+    @staticmethod
+    def _key(qr_id, ip_address, user_agent):
+        ua_hash = hashlib.blake2b((user_agent or '').encode(), digest_size=8).digest()
+        return (qr_id, ip_address, ua_hash)
+
+    def _expire(self, current):
+        # Buckets entirely older than the window are dropped wholesale.
+        oldest = current - BUCKETS
+        while self._buckets and (self._buckets[0][0] <= oldest or self._size > self.max_keys):
+            _, keys = self._buckets.popleft()
+            self._size -= len(keys)
+
+    def seen(self, qr_id, ip_address, user_agent, ingest_key, now=None):
+        """Return the first scan's ingest_key if this scan repeats it, else remember it.
+
+        now is the scan's time in seconds (default: the monotonic clock); a
+        caller must use one clock for every call.
+        """
+        key = self._key(qr_id, ip_address, user_agent)
+        current = int((time.monotonic() if now is None else now) / self.bucket_seconds)
+        with self._lock:
+            if self._buckets and current < self._buckets[-1][0]:
+                current = self._buckets[-1][0]  # log lines slightly out of order
+            self._expire(current)
+            for _, keys in self._buckets:
+                first = keys.get(key)
+                if first is not None:
+                    self.duplicates += 1
+                    return first
+            if not self._buckets or self._buckets[-1][0] != current:
+                self._buckets.append((current, {}))
+            self._buckets[-1][1][key] = ingest_key
+            self._size += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'window': self.window,
+                'keys': self._size,
+                'duplicates': self.duplicates,
+            }
+
+
+scan_dedup = ScanDeduplicator(
+    mode=os.getenv('SCAN_DEDUP_MODE', OFF),
+    window=float(os.getenv('SCAN_DEDUP_WINDOW', 10)),
+    max_keys=int(os.getenv('SCAN_DEDUP_MAX_KEYS', 200000)),
+)
@@ -0,0 +1,224 @@
+"""Deferred enrichment of stored scans.
+
+The redirect stores only the raw facts of a scan: time, IP, User-Agent and
+referrer. The scan writer thread then fills the device, OS and browser
+(as dimension ids, see dimensions.py) and, when a GeoLite2 City database
+is present (see geoip_lookup.py), country, region, city and timezone,
+SCAN_ENRICH_BATCH rows at a time. Each distinct User-Agent and IP address in a batch is looked up
+once. The location's geohash goes on the scan, and scan_geo_counts (the
+heatmap's daily per-cell totals) is adjusted in the same transaction.
+
+Progress is kept in the 'scans' row of enrichment_watermarks: the highest
+scan id looked at so far, so enrichment resumes where it stopped after a
+restart. Each batch also re-checks the SCAN_ENRICH_LOOKBACK ids below the
+watermark for rows that are still waiting (device_type_id IS NULL), which
+catches inserts that committed after a later one. The watermark row is
+locked with SKIP LOCKED, so on PostgreSQL one worker enriches at a time
+and the others skip their turn.
+"""
+import os
+
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from counters import upsert_counts
+from dimensions import browser_families, device_types, os_families
+from geohash import encode as geohash_encode
+from geoip_lookup import geo_locator
+from models import EnrichmentWatermark, Scan, ScanGeoCount, UserAgent
+from user_agent_cache import user_agent_parser
+
+WATERMARK = 'scans'
+
+_scans = Scan.__table__
+_user_agents = UserAgent.__table__
+_watermarks = EnrichmentWatermark.__table__
+_geo_counts = ScanGeoCount.__table__
+
+_LOCK_WATERMARK = (
+    select(_watermarks.c.last_scan_id)
+    .where(_watermarks.c.name == WATERMARK)
+    .with_for_update(skip_locked=True)
+)
+_ADVANCE_WATERMARK = (
+    update(_watermarks)
+    .where(_watermarks.c.name == WATERMARK)
+    .values(last_scan_id=bindparam('last_scan_id'), updated_at=func.now())
+)
+_SCAN_FACTS = (
+    select(
+        _scans.c.id, _scans.c.qr_code_id, _scans.c.timestamp, _scans.c.sample_weight, _scans.c.ip_address,
+        _user_agents.c.value.label('user_agent'), _scans.c.device_type_id, _scans.c.geohash,
+    )
+    .select_from(_scans.outerjoin(_user_agents, _user_agents.c.id == _scans.c.user_agent_id))
+)
+_NEW_SCANS = (
+    _SCAN_FACTS
+    .where(_scans.c.id > bindparam('after'))
+    .order_by(_scans.c.id)
+    .limit(bindparam('limit'))
+)
+_LATE_SCANS = (
+    _SCAN_FACTS
+    .where(_scans.c.id > bindparam('low'), _scans.c.id <= bindparam('after'), _scans.c.device_type_id.is_(None))
+    .limit(bindparam('limit'))
+)
+_RANGE_SCANS = (
+    _SCAN_FACTS
+    .where(_scans.c.id > bindparam('low'), _scans.c.id <= bindparam('high'))
+    .order_by(_scans.c.id)
+)
+_ENRICH = (
+    update(_scans)
+    .where(_scans.c.id == bindparam('scan_id'))
+    .values(
+        device_type_id=bindparam('device'),
+        os_family_id=bindparam('os'),
+        browser_family_id=bindparam('browser'),
+        country=bindparam('geo_country'),
+        region=bindparam('geo_region'),
+        city=bindparam('geo_city'),
+        timezone=bindparam('geo_timezone'),
+        geohash=bindparam('geo_hash'),
+    )
+)
+
+
+class ScanEnricher:
+
+    def __init__(self, batch_size=1000, max_batches=10, lookback=1000, locator=geo_locator):
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.lookback = lookback
+        self.locator = locator
+        self._watermark_ready = False
+        self.watermark = None
+        self.batches = 0
+        self.enriched = 0
+        self.user_agents = 0
+        self.addresses = 0
+        self.skipped = 0
+
+    def enrich_pending(self, engine):
+        """Run batches until caught up or max_batches have run."""
+        for _ in range(self.max_batches):
+            seen = self.run_batch(engine)
+            if seen is None or seen < self.batch_size:
+                return
+
+    def run_batch(self, engine):
+        """Enrich one batch. Returns how many new scans it covered, or None
+        if another worker holds the watermark."""
+        if not self._watermark_ready:
+            self._ensure_watermark(engine)
+        with engine.begin() as conn:
+            after = conn.execute(_LOCK_WATERMARK).scalar()
+            if after is None:
+                self.skipped += 1
+                return None
+            late = conn.execute(_LATE_SCANS, {
+                'low': after - self.lookback, 'after': after, 'limit': self.batch_size,
+            }).all()
+            new = conn.execute(_NEW_SCANS, {'after': after, 'limit': self.batch_size}).all()
+            waiting = late + [row for row in new if row.device_type_id is None]
+            if waiting:
+                self._write(conn, waiting)
+            if new:
+                after = new[-1].id
+                conn.execute(_ADVANCE_WATERMARK, {'last_scan_id': after})
+        self.watermark = after
+        self.batches += 1
+        self.enriched += len(waiting)
+        return len(new)
+
+    def enrich_range(self, engine, low, high, chunk_size=500):
+        """Re-enrich every scan with low < id <= high, whether or not it has
+        been enriched before, committing chunk_size rows at a time. Used by
+        backfill_enrichment.py; returns the number of scans updated."""
+        with engine.connect() as conn:
+            rows = conn.execute(_RANGE_SCANS, {'low': low, 'high': high}).all()
+        for start in range(0, len(rows), chunk_size):
+            with engine.begin() as conn:
+                self._write(conn, rows[start:start + chunk_size])
+        self.enriched += len(rows)
+        return len(rows)
+
+    def _ensure_watermark(self, engine):
+        # Scans stored before deferred enrichment were enriched inline, so a
+        # new watermark starts at the current end of the table.
+        with engine.connect() as conn:
+            exists = conn.execute(
+                select(_watermarks.c.name).where(_watermarks.c.name == WATERMARK)
+            ).first() is not None
+        if not exists:
+            try:
+                with engine.begin() as conn:
+                    last = conn.execute(select(func.coalesce(func.max(_scans.c.id), 0))).scalar()
+                    conn.execute(insert(_watermarks).values(name=WATERMARK, last_scan_id=last))
+            except IntegrityError:
+                pass  # another worker created it first
+        self._watermark_ready = True
+
+    def _write(self, conn, rows):
+        params = self._enriched(conn, rows)
+        conn.execute(_ENRICH, params)
+        # Move each scan's weight from the cell it was counted in (if any,
+        # e.g. when the backfill re-enriches it) to its new one.
+        cells = {}
+        for row, values in zip(rows, params):
+            if row.geohash == values['geo_hash'] or row.timestamp is None:
+                continue
+            weight = row.sample_weight or 1
+            day = row.timestamp.date()
+            if row.geohash:
+                key = (row.qr_code_id, day, row.geohash)
+                cells[key] = cells.get(key, 0) - weight
+            if values['geo_hash']:
+                key = (row.qr_code_id, day, values['geo_hash'])
+                cells[key] = cells.get(key, 0) + weight
+        cells = {key: n for key, n in cells.items() if n}
+        if cells:
+            upsert_counts(conn, _geo_counts, cells)
+
+    def _enriched(self, conn, rows):
+        families = {ua: user_agent_parser.families(ua) for ua in {row.user_agent or '' for row in rows}}
+        places = {ip: self.locator.locate(ip) for ip in {row.ip_address for row in rows}}
+        self.user_agents += len(families)
+        self.addresses += len(places)
+        devices = device_types.ids(conn, {device_types.normalize(f.device_type) for f in families.values()})
+        systems = os_families.ids(conn, {os_families.normalize(f.os_family) for f in families.values()})
+        browsers = browser_families.ids(conn, {browser_families.normalize(f.browser_family) for f in families.values()})
+        params = []
+        for row in rows:
+            agent = families[row.user_agent or '']
+            place = places[row.ip_address]
+            params.append({
+                'scan_id': row.id,
+                'device': devices.get(device_types.normalize(agent.device_type)),
+                'os': systems.get(os_families.normalize(agent.os_family)),
+                'browser': browsers.get(browser_families.normalize(agent.browser_family)),
+                'geo_country': place.country,
+                'geo_region': place.region,
+                'geo_city': place.city,
+                'geo_timezone': place.timezone,
+                'geo_hash': geohash_encode(place.latitude, place.longitude),
+            })
+        return params
+
+    def stats(self):
+        return {
+            'watermark': self.watermark,
+            'batches': self.batches,
+            'enriched': self.enriched,
+            'user_agents_parsed': self.user_agents,
+            'addresses_located': self.addresses,
+            'skipped_batches': self.skipped,
+            'geoip': self.locator.stats(),
+        }
+
+
+scan_enricher = ScanEnricher(
+    batch_size=int(os.getenv('SCAN_ENRICH_BATCH', 1000)),
+    max_batches=int(os.getenv('SCAN_ENRICH_MAX_BATCHES', 10)),
+    lookback=int(os.getenv('SCAN_ENRICH_LOOKBACK', 1000)),
+)
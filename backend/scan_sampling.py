@@ -0,0 +1,81 @@
+"""Adaptive sampling of raw scan rows for codes scanned at very high rates.
+
+Every scan is counted exactly in scan_counts. Raw rows are only needed for
+distributions (country, device, hour, ...), so once a code passes
+SCAN_SAMPLE_THRESHOLD scans per SCAN_SAMPLE_WINDOW seconds in this worker,
+its scans are stored with probability 1/N, where N is how many times over
+the threshold it runs. Each stored row carries sample_weight = N and the
+stats endpoints sum weights instead of counting rows, which keeps the
+distributions unbiased however N changes over time. Scans replayed from a
+log pass their own time, so rates are those of the scans, not of replay.
+"""
+import math
+import os
+import random
+import threading
+import time
+
+
+class AdaptiveSampler:
+
+    def __init__(self, threshold=0, window=60.0, max_weight=1000):
+        self.threshold = threshold
+        self.window = window
+        self.max_weight = max(int(max_weight), 1)
+        self._window_number = None
+        self._current = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+        self.sampled_out = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def weight(self, qr_id, now=None):
+        """Return the sample_weight to store this scan with, or 0 to skip its row.
+
+        now is the scan's time in seconds, as for ScanDeduplicator.seen().
+        """
+        if not self.enabled:
+            return 1
+        window_number = int((time.monotonic() if now is None else now) / self.window)
+        with self._lock:
+            if self._window_number is not None and window_number < self._window_number:
+                window_number = self._window_number
+            if window_number != self._window_number:
+                consecutive = self._window_number is not None and window_number == self._window_number + 1
+                self._previous = self._current if consecutive else {}
+                self._current = {}
+                self._window_number = window_number
+            seen = self._current.get(qr_id, 0) + 1
+            self._current[qr_id] = seen
+            rate = max(seen, self._previous.get(qr_id, 0))
+        if rate <= self.threshold:
+            return 1
+        n = min(math.ceil(rate / self.threshold), self.max_weight)
+        if random.randrange(n):
+            self.sampled_out += 1
+            return 0
+        return n
+
+    def stats(self):
+        with self._lock:
+            rates = dict(self._previous)
+            for qr_id, seen in self._current.items():
+                rates[qr_id] = max(seen, rates.get(qr_id, 0))
+        return {
+            'enabled': self.enabled,
+            'threshold': self.threshold,
+            'window': self.window,
+            'sampled_codes': sorted(qr_id for qr_id, rate in rates.items()
+                                    if self.enabled and rate > self.threshold),
+            'sampled_out': self.sampled_out,
+        }
+
+
+scan_sampler = AdaptiveSampler(
+    threshold=int(os.getenv('SCAN_SAMPLE_THRESHOLD', 0)),
+    window=float(os.getenv('SCAN_SAMPLE_WINDOW', 60)),
+    max_weight=int(os.getenv('SCAN_SAMPLE_MAX_WEIGHT', 1000)),
+)
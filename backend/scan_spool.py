@@ -0,0 +1,243 @@
+"""Append-only on-disk spool for scans that could not be written to the database.
+
+Scans are appended to segment files in SCAN_SPOOL_DIR, one record per line
+as ``<crc32 hex> <json>``. Each worker writes its own ``.open`` segment and
+seals it (renames it to ``.seg``) once it is full or the database is back.
+The replayer claims sealed segments by renaming them, re-inserts the
+records and deletes the segment. Every record carries the scan's
+ingest_key, and replays insert with ON CONFLICT DO NOTHING, so a segment
+replayed twice after a crash still yields each scan exactly once. A
+segment the database refuses outright is set aside as ``.rejected`` for an
+operator to look at, so it cannot hold up the segments behind it.
+
+Aggregate counter deltas that could not be written are saved next to the
+segments as ``counts-*.json`` files and claimed the same way.
+"""
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def encode_record(record):
+    payload = json.dumps(
+        {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in record.items()},
+        separators=(',', ':'),
+    )
+    return f"{zlib.crc32(payload.encode()):08x} {payload}\n"
+
+
+def decode_record(line):
+    """Return the record stored on line, or None if the checksum does not match."""
+    checksum, _, payload = line.rstrip('\n').partition(' ')
+    if not payload or f"{zlib.crc32(payload.encode()):08x}" != checksum:
+        return None
+    record = json.loads(payload)
+    if record.get('timestamp'):
+        record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    return record
+
+
+class ScanSpool:
+
+    def __init__(self, directory=DEFAULT_SPOOL_DIR, segment_bytes=16 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._pid = None
+        self._seq = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.corrupt = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            directory=os.getenv('SCAN_SPOOL_DIR', DEFAULT_SPOOL_DIR),
+            segment_bytes=int(os.getenv('SCAN_SPOOL_SEGMENT_BYTES', 16 * 1024 * 1024)),
+            fsync=os.getenv('SCAN_SPOOL_FSYNC', 'true').lower() in ('1', 'true', 'yes', 'on'),
+        )
+
+    def append(self, records):
+        """Durably append records to this process's open segment."""
+        data = ''.join(encode_record(record) for record in records)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Never append to a segment inherited across a fork.
+                self._file = None
+                self._pid = os.getpid()
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.spooled += len(records)
+            if self._file.tell() >= self.segment_bytes:
+                self._seal_locked()
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        self._path = os.path.join(self.directory, f"scans-{stamp}-{self._pid}-{self._seq}.open")
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def _seal_locked(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.replace(self._path, self._path[:-len('.open')] + '.seg')
+        self._file = None
+        self._path = None
+
+    def seal(self):
+        """Make this process's open segment available to the replayer."""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._seal_locked()
+
+    def recover_orphans(self):
+        """Release segments left open or claimed by processes that have exited."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.open'):
+                pid = int(name.rsplit('-', 2)[1])
+                if not _pid_alive(pid):
+                    os.replace(path, path[:-len('.open')] + '.seg')
+            elif '.claim.' in name:
+                base, _, pid = name.rpartition('.claim.')
+                if not _pid_alive(int(pid)):
+                    os.replace(path, os.path.join(self.directory, base))
+
+    def pending(self):
+        """Sealed segments waiting to be replayed, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def pending_counts(self):
+        """Saved counter files waiting to be loaded, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('counts-') and name.endswith('.json'))
+
+    def save_counts(self, items):
+        """Durably write a list of counter deltas to a new counts file."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        path = os.path.join(self.directory, f"counts-{stamp}-{os.getpid()}-{seq}.json")
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(items, f, separators=(',', ':'))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def take_counts(self):
+        """Claim, read and delete every saved counts file; returns their items.
+
+        The caller owns the counts from then on.
+        """
+        items = []
+        for name in self.pending_counts():
+            path = os.path.join(self.directory, name)
+            claimed = f"{path}.claim.{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue  # another worker claimed it first
+            try:
+                with open(claimed, encoding='utf-8') as f:
+                    items.extend(json.load(f))
+            except ValueError:
+                self.corrupt += 1
+                logger.error("Skipping corrupt counts file %s", name)
+            os.remove(claimed)
+        return items
+
+    def has_open_segment(self):
+        return self._file is not None and self._pid == os.getpid()
+
+    def rejected(self):
+        """Segments set aside because the database refused them."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.rejected'))
+
+    def replay(self, write, chunk_size=500, rejected_errors=()):
+        """Feed sealed segments to write(records) and delete them once written.
+
+        A segment whose write raises one of rejected_errors can never be
+        written, so it is renamed to .rejected and replay moves on. Any other
+        error stops the replay at that segment, leaving it in place for the
+        next attempt. Returns the number of records replayed.
+        """
+        total = 0
+        for name in self.pending():
+            path = os.path.join(self.directory, name)
+            claimed = f"{path}.claim.{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue  # another worker claimed it first
+            records = []
+            with open(claimed, encoding='utf-8') as f:
+                for line in f:
+                    record = decode_record(line)
+                    if record is None:
+                        self.corrupt += 1
+                        logger.error("Skipping corrupt record in spool segment %s", name)
+                        continue
+                    records.append(record)
+            try:
+                for start in range(0, len(records), chunk_size):
+                    write(records[start:start + chunk_size])
+            except rejected_errors:
+                os.replace(claimed, path[:-len('.seg')] + '.rejected')
+                logger.exception("Spool segment %s was refused by the database; set it aside", name)
+                continue
+            except Exception:
+                os.replace(claimed, path)
+                raise
+            os.remove(claimed)
+            total += len(records)
+            self.replayed += len(records)
+            logger.info("Replayed %d spooled scans from %s", len(records), name)
+        return total
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'pending_segments': len(self.pending()),
+            'pending_counts': len(self.pending_counts()),
+            'rejected_segments': len(self.rejected()),
+            'spooled': self.spooled,
+            'replayed': self.replayed,
+            'corrupt': self.corrupt,
+        }
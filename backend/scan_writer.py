@@ -0,0 +1,504 @@
+"""Background batched writer for scan records.
+
+The redirect route only enqueues a plain dict per scan; a daemon thread in
+each worker drains the queue and writes the rows in bulk, either as a
+multi-row INSERT or, on PostgreSQL, through COPY. A batch is flushed when
+it reaches SCAN_BATCH_SIZE rows or SCAN_FLUSH_INTERVAL seconds after its
+first row arrived, and whatever is left is flushed when the process exits.
+
+When the database is failing or slower than its latency budget the shared
+circuit breaker opens and batches go to the local scan spool instead; the
+writer replays the spool once the database is healthy again. A batch the
+database refuses because of its rows (say, a scan for a QR code deleted
+while the scan was queued) is not an outage: it is retried row by row, and
+the refused rows are logged, counted and dropped.
+
+A stored row adds its scan to scan_counts in the transaction that inserts
+it, and a replayed row only if the insert returned it as new, so spooled
+scans are counted exactly once however often a segment is replayed. The
+other counters (scans sampled out, bot hits) are kept in memory; while
+the database is unavailable, and at shutdown, they are saved to the spool
+and loaded back once it recovers.
+
+Between batches the same thread applies folded repeats, counters and
+engagement reports, and fills in the derived columns of new scans (see
+scan_enrichment.py). With SCAN_WRITER_ASYNC=false each scan is written
+inside the request, and the thread only does this periodic work.
+"""
+import atexit
+import io
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from circuit_breaker import CLOSED, db_breaker
+from counters import aggregate_counters, dump_counts, load_counts, upsert_counts
+from engagement import engagement_buffer
+from dimensions import encode_scan_rows
+from extensions import db
+from models import Scan, ScanCount
+from scan_enrichment import scan_enricher
+from scan_spool import ScanSpool
+
+logger = logging.getLogger(__name__)
+
+# Fields of a queued (and spooled) scan record. user_agent and
+# referrer_domain hold the raw strings; they are stored as dimension ids.
+SCAN_COLUMNS = (
+    'qr_code_id', 'timestamp', 'ip_address', 'user_agent', 'referrer_domain',
+    'scan_method', 'scrolled', 'ingest_key', 'duplicate_count', 'sample_weight',
+)
+STORED_COLUMNS = (
+    'qr_code_id', 'timestamp', 'ip_address', 'user_agent_id', 'referrer_id',
+    'scan_method', 'scrolled', 'ingest_key', 'duplicate_count', 'sample_weight',
+)
+
+# Adds repeats folded by scan_dedup onto the first scan's row.
+_FOLD_DUPLICATES = (
+    update(Scan.__table__)
+    .where(Scan.__table__.c.ingest_key == bindparam('key'))
+    .values(duplicate_count=Scan.__table__.c.duplicate_count + bindparam('repeats'))
+)
+
+# Errors that mean the database refused a row rather than that it is
+# unavailable; retrying the same row can never succeed.
+ROW_ERRORS = (IntegrityError, DataError)
+
+_STOP = object()
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_text_line(values):
+    """One row in COPY's text format: NULL as \\N, so it stays distinct from
+    an empty string, and the delimiter and line breaks escaped."""
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, bool):
+            fields.append('t' if value else 'f')
+        elif isinstance(value, datetime):
+            fields.append(value.isoformat(sep=' '))
+        else:
+            fields.append(str(value).translate(_COPY_ESCAPES))
+    return '\t'.join(fields) + '\n'
+
+
+def insert_scans_statement(dialect_name):
+    """INSERT into scans that skips rows whose ingest_key is already stored."""
+    if dialect_name == 'postgresql':
+        return postgresql.insert(Scan.__table__).on_conflict_do_nothing(index_elements=['ingest_key'])
+    if dialect_name == 'sqlite':
+        return sqlite.insert(Scan.__table__).on_conflict_do_nothing(index_elements=['ingest_key'])
+    return insert(Scan.__table__)
+
+
+def count_rows(conn, rows, stored_keys=None):
+    """Add rows to scan_counts; with stored_keys, only the rows whose ingest_key is in it."""
+    stored_keys = set(stored_keys) if stored_keys is not None else None
+    counts = {}
+    for row in rows:
+        if stored_keys is not None:
+            # The same key twice in one batch is stored, and counted, once.
+            if row['ingest_key'] not in stored_keys:
+                continue
+            stored_keys.discard(row['ingest_key'])
+        key = (row['qr_code_id'], row['timestamp'].date())
+        counts[key] = counts.get(key, 0) + 1
+    if counts:
+        upsert_counts(conn, ScanCount.__table__, counts)
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+class ScanWriter:
+    """Queue of pending scan rows plus the thread that writes them."""
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue=10000,
+                 overflow='block', put_timeout=0.05, use_copy=True, enabled=True,
+                 spool=None, breaker=db_breaker, replay_interval=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.use_copy = use_copy
+        self.enabled = enabled
+        self.spool = spool if spool is not None else ScanSpool()
+        self.breaker = breaker
+        self.replay_interval = replay_interval
+        self.engine = None
+        self._insert = None
+        self._last_replay = 0.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._folds = {}
+        self._folds_lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rejected = 0
+        self.spooled = 0
+        self.batches = 0
+        self.folded = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            batch_size=int(os.getenv('SCAN_BATCH_SIZE', 500)),
+            flush_interval=float(os.getenv('SCAN_FLUSH_INTERVAL', 1.0)),
+            max_queue=int(os.getenv('SCAN_QUEUE_MAX', 10000)),
+            overflow=os.getenv('SCAN_QUEUE_OVERFLOW', 'block'),
+            put_timeout=float(os.getenv('SCAN_QUEUE_PUT_TIMEOUT', 0.05)),
+            use_copy=_env_flag('SCAN_WRITER_USE_COPY', 'true'),
+            enabled=_env_flag('SCAN_WRITER_ASYNC', 'true'),
+            spool=ScanSpool.from_env(),
+            replay_interval=float(os.getenv('SCAN_SPOOL_REPLAY_INTERVAL', 5.0)),
+        )
+
+    def init_app(self, app):
+        with app.app_context():
+            self.init_engine(db.engine)
+
+    def init_engine(self, engine):
+        self.engine = engine
+        self._insert = insert_scans_statement(engine.dialect.name)
+        if engine.dialect.insert_executemany_returning:
+            self._insert = self._insert.returning(Scan.__table__.c.ingest_key)
+        self.spool.recover_orphans()
+        atexit.register(self.stop)
+
+    def enqueue(self, record, block=True):
+        """Queue one scan for writing. Returns False if it had to be dropped.
+
+        Pass block=False from an event loop: a full queue then drops the scan
+        at once instead of waiting up to put_timeout.
+        """
+        record.setdefault('timestamp', datetime.utcnow())
+        record.setdefault('ingest_key', uuid.uuid4().hex)
+        if not self.enabled:
+            self._write([record])
+            # Enrichment and the other periodic work stay on the thread.
+            self._ensure_started()
+            return True
+        self._ensure_started()
+        try:
+            if self.overflow == 'drop' or not block:
+                self._queue.put_nowait(record)
+            else:
+                self._queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Scan queue full (%d); dropping scan for qr_code_id=%s",
+                           self.max_queue, record.get('qr_code_id'))
+            return False
+        self.enqueued += 1
+        return True
+
+    def fold(self, ingest_key):
+        """Count a repeat of the scan stored under ingest_key."""
+        with self._folds_lock:
+            self._folds[ingest_key] = self._folds.get(ingest_key, 0) + 1
+
+    def ensure_running(self):
+        """Make sure periodic work (counters, engagement, enrichment) runs
+        even without scans.
+
+        Starts this process's writer thread. In synchronous mode the thread
+        only does the periodic work, and pending counters and engagement are
+        also written at once.
+        """
+        self._ensure_started()
+        if not self.enabled:
+            self._write_counters()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so a gunicorn worker that inherited
+        # this object from the master starts its own writer on first use.
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue(maxsize=self.max_queue)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='scan-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            stop = False
+            try:
+                item = self._queue.get(timeout=self.replay_interval)
+            except queue.Empty:
+                self.maintain()
+                continue
+            if item is _STOP:
+                break
+            batch.append(item)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            self._write_folds()
+            self._write_counters()
+            if stop:
+                break
+            if time.monotonic() - self._last_replay >= self.replay_interval:
+                self.maintain()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch
+            if item is not _STOP:
+                batch.append(item)
+
+    def flush(self):
+        """Synchronously write everything currently queued."""
+        batch = self._drain()
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start + self.batch_size])
+
+    def stop(self, timeout=10):
+        """Stop the writer thread after it has written the queued scans."""
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        self._thread = None
+        self.flush()
+        self._write_folds()
+        self._write_counters()
+        self._save_counters()
+
+    def maintain(self):
+        """Periodic work: folds, counters, scan enrichment, and replaying
+        spooled scans once the database is accepting writes again."""
+        self._last_replay = time.monotonic()
+        self._write_folds()
+        self._write_counters()
+        self._enrich()
+        if self.breaker.state != CLOSED:
+            self._save_counters()
+            # Let a trial write through the breaker, then replay on a later tick.
+            if self.spool.pending() or self.spool.has_open_segment():
+                if self.breaker.allow():
+                    self._probe()
+            return
+        if self.spool.pending_counts():
+            aggregate_counters.merge(load_counts(self.spool.take_counts(), db.metadata))
+            self._write_counters()
+        self.spool.seal()
+        if not self.spool.pending():
+            return
+        try:
+            self.spool.replay(self._insert_rows, chunk_size=self.batch_size, rejected_errors=ROW_ERRORS)
+        except Exception:
+            logger.exception("Replaying scan spool failed")
+
+    def _probe(self):
+        start = time.monotonic()
+        try:
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
+        except Exception:
+            self.breaker.record_failure(reason='probe failed')
+            return
+        self.breaker.record_success(time.monotonic() - start)
+
+    def _rows(self, records):
+        rows = [{column: record.get(column) for column in SCAN_COLUMNS} for record in records]
+        for row in rows:
+            if row['scrolled'] is None:
+                row['scrolled'] = False
+            if row['duplicate_count'] is None:
+                row['duplicate_count'] = 0
+            if row['sample_weight'] is None:
+                row['sample_weight'] = 1
+        return rows
+
+    def _insert_rows(self, records):
+        rows = self._rows(records)
+        try:
+            with self.engine.begin() as conn:
+                self._insert_and_count(conn, rows)
+        except ROW_ERRORS:
+            self._insert_singly(rows)
+
+    def _insert_and_count(self, conn, rows):
+        result = conn.execute(self._insert, encode_scan_rows(conn, rows))
+        count_rows(conn, rows, result.scalars().all() if result.returns_rows else None)
+
+    def _insert_singly(self, rows):
+        """Insert rows one at a time, each under a savepoint, dropping the
+        ones the database refuses. Returns the number dropped."""
+        rejected = 0
+        with self.engine.begin() as conn:
+            for row in rows:
+                try:
+                    with conn.begin_nested():
+                        self._insert_and_count(conn, [row])
+                except ROW_ERRORS as exc:
+                    rejected += 1
+                    logger.warning("Dropping scan %s for qr_code_id=%s refused by the database: %s",
+                                   row['ingest_key'], row['qr_code_id'], str(exc.orig).splitlines()[0])
+        self.rejected += rejected
+        return rejected
+
+    def _write(self, records):
+        if not records:
+            return
+        rows = self._rows(records)
+        if self.breaker.allow():
+            start = time.monotonic()
+            rejected = 0
+            try:
+                try:
+                    if self.use_copy and self.engine.dialect.name == 'postgresql':
+                        self._copy(rows)
+                    else:
+                        with self.engine.begin() as conn:
+                            self._insert_and_count(conn, rows)
+                except ROW_ERRORS:
+                    # The database is up but refused a row; store the others.
+                    rejected = self._insert_singly(rows)
+            except Exception as exc:
+                self.breaker.record_failure(reason=str(exc).splitlines()[0])
+                logger.warning("Failed to write batch of %d scans, spooling them", len(rows))
+            else:
+                self.breaker.record_success(time.monotonic() - start)
+                self.written += len(rows) - rejected
+                self.batches += 1
+                return
+        try:
+            self.spool.append(rows)
+        except Exception:
+            self.failed += len(rows)
+            logger.exception("Failed to spool batch of %d scans", len(rows))
+            return
+        self.spooled += len(rows)
+
+    def _write_folds(self):
+        # Runs after the batch holding the first scans has been written.
+        if not self._folds or self.breaker.state != CLOSED:
+            return
+        with self._folds_lock:
+            folds, self._folds = self._folds, {}
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(_FOLD_DUPLICATES, [
+                    {'key': key, 'repeats': repeats} for key, repeats in folds.items()
+                ])
+        except Exception:
+            logger.exception("Failed to fold %d repeated scans", sum(folds.values()))
+            with self._folds_lock:
+                for key, repeats in folds.items():
+                    self._folds[key] = self._folds.get(key, 0) + repeats
+            return
+        self.folded += sum(folds.values())
+
+    def _write_counters(self):
+        if self.breaker.state != CLOSED:
+            return
+        if aggregate_counters.pending():
+            try:
+                aggregate_counters.flush(self.engine)
+            except Exception:
+                logger.exception("Failed to write aggregate scan counters")
+        if engagement_buffer.pending():
+            try:
+                engagement_buffer.flush(self.engine)
+            except Exception:
+                logger.exception("Failed to apply engagement beacons")
+
+    def _save_counters(self):
+        # Counters the database could not take go to the spool rather than
+        # being lost with the process.
+        pending = aggregate_counters.take()
+        if not pending:
+            return
+        try:
+            self.spool.save_counts(dump_counts(pending))
+        except Exception:
+            aggregate_counters.merge(pending)
+            logger.exception("Failed to save aggregate scan counters to the spool")
+
+    def _enrich(self):
+        if self.breaker.state != CLOSED:
+            return
+        try:
+            scan_enricher.enrich_pending(self.engine)
+        except Exception:
+            logger.exception("Failed to enrich scans")
+
+    def _copy(self, rows):
+        # COPY stores every row or fails, so all of them are counted, in the
+        # same transaction.
+        with self.engine.begin() as conn:
+            stored = encode_scan_rows(conn, rows)
+            buf = io.StringIO()
+            for row in stored:
+                buf.write(copy_text_line([row[column] for column in STORED_COLUMNS]))
+            buf.seek(0)
+            statement = f"COPY scans ({', '.join(STORED_COLUMNS)}) FROM STDIN WITH (FORMAT text)"
+            dbapi = conn.dialect.dbapi
+            with conn.connection.dbapi_connection.cursor() as cursor:
+                try:
+                    cursor.copy_expert(statement, buf)
+                except dbapi.Error as exc:
+                    # Raw driver cursor: wrap its error the way SQLAlchemy
+                    # would, so a refused row is told apart from an outage.
+                    raise DBAPIError.instance(statement, None, exc, dbapi.Error) from exc
+            count_rows(conn, rows)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queued': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'overflow': self.overflow,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'spooled': self.spooled,
+            'batches': self.batches,
+            'folded': self.folded,
+            'breaker': self.breaker.stats(),
+            'spool': self.spool.stats(),
+        }
+
+
+scan_writer = ScanWriter.from_env()
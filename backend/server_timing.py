@@ -0,0 +1,128 @@
+"""Opt-in per-stage timers, reported in a Server-Timing header and the log.
+
+Views decorated with @timed collect the time spent in each
+`with stage('name'):` block on their request path, including blocks in
+shared helpers such as scan_capture.record_scan. The response gets a
+header like
+
+    Server-Timing: queue;dur=3.10, lookup;dur=0.04, bot_check;dur=0.01, scan_write;dur=0.02, total;dur=0.41
+
+and the same durations are logged with the endpoint, as text and as the
+`server_timing` attribute of the log record. queue is the time between the
+proxy stamping X-Request-Start and the view starting, i.e. time spent
+waiting for a gunicorn worker.
+
+Set SERVER_TIMING=true to enable. Disabled, @timed returns the view
+unchanged and stage() costs one ContextVar lookup.
+"""
+import contextvars
+import functools
+import logging
+import os
+import time
+
+from flask import make_response, request
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes', 'on')
+
+_current = contextvars.ContextVar('server_timing', default=None)
+
+
+class Timings:
+    """Stage durations of one request, in seconds, in the order first seen."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.stages['total'] = time.perf_counter() - self.start
+        return self.stages
+
+    def header(self):
+        return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items())
+
+
+class _Stage:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """Context manager timing one stage of the current timed request."""
+    timings = _current.get()
+    if timings is None:
+        return _NULL_STAGE
+    return _Stage(timings, name)
+
+
+def queue_time(request_start, now=None):
+    """Seconds since an X-Request-Start stamp ("t=" plus s, ms or us since the epoch)."""
+    if not request_start:
+        return None
+    try:
+        stamp = float(request_start.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    # nginx's ${msec} is seconds; Heroku sends ms and Apache's %D us.
+    if stamp > 1e14:
+        stamp /= 1e6
+    elif stamp > 1e11:
+        stamp /= 1e3
+    return max(0.0, (now or time.time()) - stamp)
+
+
+def timed(view):
+    """Report the stage timings of a Flask view when SERVER_TIMING is on."""
+    if not SERVER_TIMING:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        timings = Timings()
+        waited = queue_time(request.headers.get('X-Request-Start'))
+        if waited is not None:
+            timings.add('queue', waited)
+        token = _current.set(timings)
+        try:
+            response = make_response(view(*args, **kwargs))
+        finally:
+            _current.reset(token)
+        stages = timings.finish()
+        response.headers['Server-Timing'] = timings.header()
+        logger.info("%s %s", request.endpoint,
+                    ' '.join(f'{name}={seconds * 1000:.2f}ms' for name, seconds in stages.items()),
+                    extra={'server_timing': {name: round(seconds * 1000, 3) for name, seconds in stages.items()},
+                           'endpoint': request.endpoint})
+        return response
+
+    return wrapper
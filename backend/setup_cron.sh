@@ -9,9 +9,9 @@ LOG_PATH="$SCRIPT_PATH/../logs/geolite_update.log"
 mkdir -p "$(dirname "$LOG_PATH")"
 
 # Add the cron job
-(crontab -l 2>/dev/null; echo "0 0 1 * * cd $SCRIPT_PATH && $PYTHON_PATH $SCRIPT_PATH >> $LOG_PATH 2>&1") | crontab -
+(crontab -l 2>/dev/null; echo "0 0 * * 2,5 cd $SCRIPT_PATH && $PYTHON_PATH $SCRIPT_PATH >> $LOG_PATH 2>&1") | crontab -
 
-echo "Cron job has been set up to run update_geolite.py on the 1st of every month"
+echo "Cron job has been set up to run update_geolite.py every Tuesday and Friday (unchanged releases are skipped)"
 echo "Logs will be written to: $LOG_PATH"
 echo "Current crontab:"
 crontab -l
@@ -0,0 +1,173 @@
+"""Allocation of short codes without collisions.
+
+Every short code is the base62 encoding of a number that only this
+allocator hands out, so no two QR codes can ever be given the same code
+and creation never has to retry on the unique constraint. Each worker
+reserves numbers in blocks of SHORT_CODE_BLOCK_SIZE: from the
+short_code_seq sequence on PostgreSQL, or by advancing the row in
+short_code_counters on other databases. Reservations commit on their own,
+so numbers are never handed out twice even if the request that used them
+rolls back; unused numbers in a block are simply skipped.
+
+By default the codes are the plain base62 numbers, as short as possible.
+With SHORT_CODE_KEY set, each number is first passed through a keyed
+Feistel permutation of [0, 62 ** SHORT_CODE_LENGTH), so codes are a fixed
+length and consecutive codes look unrelated. The permutation is a
+bijection, so scrambled codes are just as collision free. Choose the key
+and length once: changing either can map new numbers onto codes already
+issued.
+"""
+import hashlib
+import os
+import threading
+from collections import deque
+
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from models import ShortCodeCounter
+
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(ALPHABET)
+
+COUNTER_NAME = 'short_code'
+_RESERVE_FROM_SEQUENCE = text("SELECT nextval('short_code_seq') FROM generate_series(1, :n)")
+
+
+def base62_encode(number, length=0):
+    """Encode a non-negative integer, left-padded to length characters."""
+    if number < 0:
+        raise ValueError("Cannot encode a negative number")
+    chars = []
+    while number:
+        number, digit = divmod(number, BASE)
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars)).rjust(max(length, 1), ALPHABET[0])
+
+
+def base62_decode(code):
+    number = 0
+    for char in code:
+        number = number * BASE + ALPHABET.index(char)
+    return number
+
+
+class FeistelPermutation:
+    """Keyed bijection of [0, domain), by a balanced Feistel network and cycle walking."""
+
+    ROUNDS = 6
+
+    def __init__(self, key, domain):
+        self.domain = domain
+        bits = max((domain - 1).bit_length(), 2)
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.key = hashlib.blake2b(key.encode(), digest_size=32).digest()
+
+    def _round(self, i, value):
+        digest = hashlib.blake2b(bytes([i]) + value.to_bytes(8, 'little'), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, 'little') & self.mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for i in range(self.ROUNDS):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value):
+        if not 0 <= value < self.domain:
+            raise ValueError(f"{value} is outside the permutation's domain")
+        # The network permutes [0, 2 ** bits); walking the cycle until the
+        # result lands back inside the domain keeps it a bijection there.
+        value = self._encrypt(value)
+        while value >= self.domain:
+            value = self._encrypt(value)
+        return value
+
+
+class ShortCodeAllocator:
+
+    def __init__(self, block_size=100, key=None, length=6):
+        self.block_size = max(int(block_size), 1)
+        self.length = length if key else 0
+        self._scramble = FeistelPermutation(key, BASE ** length) if key else None
+        self._numbers = deque()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.reservations = 0
+        self.allocated = 0
+
+    def encode(self, number):
+        if self._scramble is not None:
+            number = self._scramble(number)
+        return base62_encode(number, self.length)
+
+    def allocate(self, engine=None):
+        """Return one new short code."""
+        return self.allocate_many(1, engine)[0]
+
+    def allocate_many(self, count, engine=None):
+        """Return count new short codes, reserving at most one block from the database."""
+        if engine is None:
+            from extensions import db
+            engine = db.engine
+        with self._lock:
+            if self._pid != os.getpid():
+                # Numbers reserved before a fork are shared with the parent.
+                self._numbers.clear()
+                self._pid = os.getpid()
+            missing = count - len(self._numbers)
+            if missing > 0:
+                self._numbers.extend(self._reserve(engine, missing + self.block_size))
+                self.reservations += 1
+            numbers = [self._numbers.popleft() for _ in range(count)]
+            self.allocated += count
+        return [self.encode(number) for number in numbers]
+
+    def _reserve(self, engine, n):
+        if engine.dialect.name == 'postgresql':
+            with engine.begin() as conn:
+                return [row[0] for row in conn.execute(_RESERVE_FROM_SEQUENCE, {'n': n})]
+        end = self._advance_counter(engine, n)
+        return range(end - n, end)
+
+    def _advance_counter(self, engine, n):
+        """Add n to the counter row and return its new value."""
+        counter = ShortCodeCounter.__table__
+        advance = update(counter).where(counter.c.name == COUNTER_NAME).values(next_id=counter.c.next_id + n)
+        for _ in range(2):
+            with engine.begin() as conn:
+                if engine.dialect.update_returning:
+                    end = conn.execute(advance.returning(counter.c.next_id)).scalar()
+                elif conn.execute(advance).rowcount:
+                    # The row stays locked until this transaction ends.
+                    end = conn.execute(select(counter.c.next_id).where(counter.c.name == COUNTER_NAME)).scalar()
+                else:
+                    end = None
+                if end is not None:
+                    return end
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(counter).values(name=COUNTER_NAME, next_id=1 + n))
+                return 1 + n
+            except IntegrityError:
+                continue  # another worker created the row first
+        raise RuntimeError("Could not reserve short codes")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'scrambled': self._scramble is not None,
+                'length': self.length or None,
+                'block_size': self.block_size,
+                'reserved': len(self._numbers),
+                'reservations': self.reservations,
+                'allocated': self.allocated,
+            }
+
+
+short_code_allocator = ShortCodeAllocator(
+    block_size=int(os.getenv('SHORT_CODE_BLOCK_SIZE', 100)),
+    key=os.getenv('SHORT_CODE_KEY') or None,
+    length=int(os.getenv('SHORT_CODE_LENGTH', 6)),
+)
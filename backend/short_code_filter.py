@@ -0,0 +1,251 @@
+"""Per-worker membership filter for short codes.
+
+A counting Bloom filter holds every valid short code so that requests for
+garbage codes (scanners, crawlers, typos) can be answered with a 404
+without a database query. It is loaded at startup, updated when this
+worker creates or deletes a code, and catches up on codes created by
+other workers at most once per SHORT_CODE_FILTER_CATCH_UP seconds.
+
+The catch-up cannot use "id greater than the last id seen": ids are handed
+out when a row is inserted, not when it commits, so a transaction that
+takes id 41 and commits after id 42 has been seen would be skipped for
+good. Instead it reads the codes touched since the newest creation time
+seen, minus SHORT_CODE_FILTER_COMMIT_LAG seconds (an upper bound on how long
+an insert stays uncommitted, plus clock skew between hosts), through the
+updated_at index. Codes re-read inside that window are remembered by id so
+they are only counted once. Codes that did reach the database and were not
+found go into a small TTL negative cache.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, select
+
+from models import QRCode
+
+logger = logging.getLogger(__name__)
+
+_qrcodes = QRCode.__table__
+# Codes created or edited by other workers since the last catch-up, less the commit lag.
+CATCH_UP_STATEMENT = select(_qrcodes.c.id, _qrcodes.c.short_code, _qrcodes.c.created_at).where(
+    _qrcodes.c.updated_at >= bindparam('since')
+)
+
+
+class CountingBloomFilter:
+    """Bloom filter with 8-bit saturating counters, so codes can be removed."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self._counters = bytearray(self.size)
+        self.count = 0
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        counters = self._counters
+        for index in self._indexes(key):
+            if counters[index] < 255:
+                counters[index] += 1
+        self.count += 1
+
+    def remove(self, key):
+        indexes = self._indexes(key)
+        counters = self._counters
+        if not all(counters[index] for index in indexes):
+            return
+        for index in indexes:
+            # A saturated counter no longer knows how many keys share it.
+            if counters[index] < 255:
+                counters[index] -= 1
+        self.count -= 1
+
+    def __contains__(self, key):
+        counters = self._counters
+        return all(counters[index] for index in self._indexes(key))
+
+    def estimated_error_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class NegativeCache:
+    """Bounded TTL set of short codes recently confirmed missing."""
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def __contains__(self, short_code):
+        with self._lock:
+            expires_at = self._data.get(short_code)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._data[short_code]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, short_code):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[short_code] = time.monotonic() + self.ttl
+            self._data.move_to_end(short_code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, short_code):
+        with self._lock:
+            self._data.pop(short_code, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits}
+
+
+class ShortCodeFilter:
+    """Answers "definitely not a short code" without touching the database."""
+
+    def __init__(self, capacity=200000, error_rate=0.01, catch_up_interval=1.0, commit_lag=60.0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.catch_up_interval = catch_up_interval
+        self.commit_lag = timedelta(seconds=commit_lag)
+        self._bloom = None
+        self._newest = None  # latest created_at seen
+        self._recent = {}  # id -> created_at of codes added within the commit lag of _newest
+        self._last_catch_up = 0.0
+        self._lock = threading.Lock()
+        self.rejections = 0
+        self.catch_ups = 0
+
+    @property
+    def loaded(self):
+        return self._bloom is not None
+
+    def load(self, executor):
+        """Build the filter from every short code in the database."""
+        rows = executor.execute(select(QRCode.id, QRCode.short_code, QRCode.created_at)).all()
+        bloom = CountingBloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+        for row in rows:
+            bloom.add(row.short_code)
+        newest = max((row.created_at for row in rows if row.created_at is not None), default=None)
+        recent = {}
+        if newest is not None:
+            cutoff = newest - self.commit_lag
+            recent = {row.id: row.created_at for row in rows
+                      if row.created_at is not None and row.created_at >= cutoff}
+        with self._lock:
+            self._bloom = bloom
+            self._newest = newest
+            self._recent = recent
+            self._last_catch_up = time.monotonic()
+        logger.info("Loaded %d short codes into the short-code filter (%d counters, %d hashes)",
+                    len(rows), bloom.size, bloom.hash_count)
+
+    def __contains__(self, short_code):
+        bloom = self._bloom
+        return bloom is None or short_code in bloom
+
+    def might_exist(self, short_code, executor=None):
+        """False only if short_code is certainly not in the qrcodes table.
+
+        Without an executor the filter is consulted as loaded, with no
+        catch-up query.
+        """
+        if short_code in self:
+            return True
+        if executor is not None and self.catch_up_due():
+            rows = executor.execute(*self.catch_up_query()).all()
+            if self.apply_catch_up(rows) and short_code in self:
+                return True
+        self.rejections += 1
+        return False
+
+    def catch_up_due(self):
+        """True at most once per catch_up_interval; the caller then runs the catch-up."""
+        now = time.monotonic()
+        with self._lock:
+            if self._bloom is None or now - self._last_catch_up < self.catch_up_interval:
+                return False
+            self._last_catch_up = now
+            return True
+
+    def _cutoff(self):
+        return datetime.min if self._newest is None else self._newest - self.commit_lag
+
+    def catch_up_query(self):
+        """(statement, parameters) selecting codes that may have committed since the last catch-up."""
+        return CATCH_UP_STATEMENT, {'since': self._cutoff()}
+
+    def apply_catch_up(self, rows):
+        """Add the new codes among rows; True if there were any."""
+        added = 0
+        with self._lock:
+            cutoff = self._cutoff()
+            for row in rows:
+                # Older codes here were edited, not created: already loaded.
+                if row.created_at is None or row.created_at < cutoff or row.id in self._recent:
+                    continue
+                self._bloom.add(row.short_code)
+                self._recent[row.id] = row.created_at
+                if self._newest is None or row.created_at > self._newest:
+                    self._newest = row.created_at
+                added += 1
+            cutoff = self._cutoff()
+            self._recent = {id_: created_at for id_, created_at in self._recent.items() if created_at >= cutoff}
+            self.catch_ups += 1
+        return bool(added)
+
+    def add(self, short_code):
+        if self._bloom is not None:
+            with self._lock:
+                self._bloom.add(short_code)
+
+    def remove(self, short_code):
+        if self._bloom is not None:
+            with self._lock:
+                self._bloom.remove(short_code)
+
+    def stats(self):
+        bloom = self._bloom
+        if bloom is None:
+            return {'loaded': False}
+        return {
+            'loaded': True,
+            'codes': bloom.count,
+            'counters': bloom.size,
+            'hashes': bloom.hash_count,
+            'estimated_error_rate': round(bloom.estimated_error_rate(), 6),
+            'rejections': self.rejections,
+            'catch_ups': self.catch_ups,
+        }
+
+
+short_code_filter = ShortCodeFilter(
+    capacity=int(os.getenv('SHORT_CODE_FILTER_CAPACITY', 200000)),
+    error_rate=float(os.getenv('SHORT_CODE_FILTER_ERROR_RATE', 0.01)),
+    catch_up_interval=float(os.getenv('SHORT_CODE_FILTER_CATCH_UP', 1.0)),
+    commit_lag=float(os.getenv('SHORT_CODE_FILTER_COMMIT_LAG', 60)),
+)
+negative_cache = NegativeCache(
+    maxsize=int(os.getenv('NEGATIVE_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('NEGATIVE_CACHE_TTL', 30)),
+)
@@ -0,0 +1,336 @@
+"""Memory-mapped short-code index shared by all workers on a node.
+
+The index is a single file holding fixed-width records sorted by short
+code, followed by a blob of target URLs:
+
+    header   magic, version, key width, record count
+    records  short_code (null padded), qr_id, url offset, url length, location length
+    blob     target_url, then its encoded Location header if that differs
+
+Every worker maps the file read-only and binary-searches it, so the OS page
+cache holds one copy per node and a freshly started worker is warm
+immediately. Changes are merged into a new file that replaces the old one
+with os.replace(); readers notice the new inode and remap it. Codes longer
+than KEY_WIDTH bytes, or with a URL longer than a record can describe
+(64 KiB), are left out and looked up in the database.
+
+Other nodes' edits reach the index only through the redirect cache, which
+treats index hits like its own entries: they are checked against the
+database once their TTL has passed, and the answer is merged back here.
+
+Enable it by pointing SHORT_CODE_INDEX_PATH at a file on local disk, for
+example /dev/shm/accelqr/short_codes.idx. Rebuild it from the database with:
+
+    python short_code_index.py --rebuild
+"""
+import atexit
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from werkzeug.urls import iri_to_uri
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'QRIX'
+VERSION = 1
+KEY_WIDTH = 16
+HEADER = struct.Struct('<4sHHQ')
+RECORD = struct.Struct(f'<{KEY_WIDTH}sQIHH')
+MAX_URL_BYTES = 0xFFFF
+
+
+def indexable(short_code, target_url):
+    """True if a record can hold this code and target URL."""
+    if len(short_code.encode()) > KEY_WIDTH:
+        return False
+    url = target_url.encode()
+    return len(url) <= MAX_URL_BYTES and len(iri_to_uri(target_url).encode()) <= MAX_URL_BYTES
+
+
+def _read_entries(path):
+    """Return {short_code: (qr_id, target_url)} from an existing index file."""
+    entries = {}
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return entries
+    magic, version, key_width, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or key_width != KEY_WIDTH:
+        raise ValueError(f"{path} is not a short-code index")
+    blob = HEADER.size + count * RECORD.size
+    for i in range(count):
+        key, qr_id, offset, url_len, _ = RECORD.unpack_from(data, HEADER.size + i * RECORD.size)
+        start = blob + offset
+        entries[key.rstrip(b'\0').decode()] = (qr_id, data[start:start + url_len].decode())
+    return entries
+
+
+def write_index(path, entries):
+    """Atomically replace the index at path with entries {short_code: (qr_id, target_url)}."""
+    records = []
+    blob = bytearray()
+    for short_code in sorted(entries, key=str.encode):
+        qr_id, target_url = entries[short_code]
+        if not indexable(short_code, target_url):
+            continue  # looked up in the database instead
+        key = short_code.encode()
+        url = target_url.encode()
+        location = iri_to_uri(target_url).encode()
+        location_len = 0 if location == url else len(location)
+        records.append(RECORD.pack(key, qr_id, len(blob), len(url), location_len))
+        blob += url
+        if location_len:
+            blob += location
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.short_codes.', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, KEY_WIDTH, len(records)))
+            f.writelines(records)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(records)
+
+
+class _IndexLock:
+    """Serialises writers on the index across processes."""
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, 'w')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class _Mapping:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, key_width, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION or key_width != KEY_WIDTH:
+            raise ValueError(f"{path} is not a short-code index")
+        self.blob = HEADER.size + self.count * RECORD.size
+
+    def lookup(self, key):
+        data = self.data
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * RECORD.size
+            probe = data[start:start + KEY_WIDTH]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                _, qr_id, offset, url_len, location_len = RECORD.unpack_from(data, start)
+                url_start = self.blob + offset
+                target_url = data[url_start:url_start + url_len].decode()
+                if location_len:
+                    location_start = url_start + url_len
+                    location = data[location_start:location_start + location_len].decode()
+                else:
+                    location = target_url
+                return qr_id, target_url, location
+        return None
+
+
+class ShortCodeIndex:
+    """Reader and incremental writer for the shared index file."""
+
+    def __init__(self, path, check_interval=1.0, flush_delay=0.5):
+        self.path = path
+        self.check_interval = check_interval
+        self.flush_delay = flush_delay
+        self._mapping = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.rebuilds = 0
+        atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return self._mapping
+        self._last_check = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._mapping = None
+            return None
+        mapping = self._mapping
+        if mapping is None or mapping.identity != (stat.st_ino, stat.st_mtime_ns):
+            try:
+                # The old mapping is closed by the garbage collector once
+                # no lookup still holds it.
+                self._mapping = _Mapping(self.path)
+                self.reloads += 1
+            except (OSError, ValueError):
+                logger.exception("Could not map short-code index %s", self.path)
+        return self._mapping
+
+    def lookup(self, short_code):
+        """Return (qr_id, target_url, location) or None if the code is not indexed."""
+        result = self._find(short_code)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _find(self, short_code):
+        # This worker's own changes count before they are flushed.
+        with self._lock:
+            if short_code in self._pending:
+                value = self._pending[short_code]
+                if value is None:
+                    return None
+                return value[0], value[1], iri_to_uri(value[1])
+        mapping = self._current()
+        if mapping is None:
+            return None
+        key = short_code.encode()
+        if len(key) > KEY_WIDTH:
+            return None
+        return mapping.lookup(key.ljust(KEY_WIDTH, b'\0'))
+
+    def reconcile(self, short_code, qr_id=None, target_url=None):
+        """Bring the entry for short_code in line with the database row
+        (qr_id, target_url), or remove it when qr_id is None."""
+        current = self._find(short_code)
+        if qr_id is None:
+            if current is not None:
+                self.delete(short_code)
+        elif indexable(short_code, target_url) and (current is None or current[:2] != (qr_id, target_url)):
+            self.upsert(short_code, qr_id, target_url)
+
+    def rebuild(self, rows):
+        """Write a fresh index from (short_code, qr_id, target_url) rows."""
+        with _IndexLock(self.path):
+            count = write_index(self.path, {code: (qr_id, url) for code, qr_id, url in rows})
+        self.rebuilds += 1
+        self._last_check = 0.0
+        return count
+
+    def ensure_built(self, rows):
+        """Build the index from rows unless another process already has."""
+        if os.path.exists(self.path):
+            return
+        with _IndexLock(self.path):
+            if os.path.exists(self.path):
+                return
+            write_index(self.path, {code: (qr_id, url) for code, qr_id, url in rows})
+        self.rebuilds += 1
+
+    def upsert(self, short_code, qr_id, target_url):
+        self._schedule(short_code, (qr_id, target_url))
+
+    def delete(self, short_code):
+        self._schedule(short_code, None)
+
+    def _schedule(self, short_code, value):
+        # Changes made within flush_delay of each other share one rewrite.
+        with self._lock:
+            self._pending[short_code] = value
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Timer(self.flush_delay, self.flush)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def flush(self):
+        """Merge pending changes into the index file."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flusher = None
+        if not pending:
+            return
+        try:
+            with _IndexLock(self.path):
+                entries = _read_entries(self.path)
+                for short_code, value in pending.items():
+                    if value is None:
+                        entries.pop(short_code, None)
+                    else:
+                        entries[short_code] = value
+                write_index(self.path, entries)
+        except Exception:
+            logger.exception("Could not update short-code index %s", self.path)
+            return
+        self._last_check = 0.0
+
+    def stats(self):
+        mapping = self._mapping
+        return {
+            'enabled': self.enabled,
+            'path': self.path,
+            'codes': mapping.count if mapping is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'rebuilds': self.rebuilds,
+        }
+
+
+short_code_index = ShortCodeIndex(
+    os.getenv('SHORT_CODE_INDEX_PATH', ''),
+    check_interval=float(os.getenv('SHORT_CODE_INDEX_CHECK_INTERVAL', 1.0)),
+)
+
+
+def _rebuild_from_database():
+    from sqlalchemy import select
+    from app import create_app
+    from extensions import db
+    from models import QRCode
+
+    if not short_code_index.enabled:
+        raise SystemExit("Set SHORT_CODE_INDEX_PATH to the index file to build")
+    app = create_app()
+    with app.app_context():
+        rows = db.session.execute(select(QRCode.short_code, QRCode.id, QRCode.target_url)).all()
+    count = short_code_index.rebuild(rows)
+    print(f"Wrote {count} short codes to {short_code_index.path}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the shared short-code index")
+    parser.add_argument('--rebuild', action='store_true', help="rebuild the index from the database")
+    if parser.parse_args().rebuild:
+        _rebuild_from_database()
+    else:
+        parser.print_help()
@@ -0,0 +1,54 @@
+"""Database access for entry points that run without create_app().
+
+The redirect-only servers and the command-line tools build their own
+engines from DATABASE_URL with the same pool settings as the Flask app.
+"""
+import os
+
+from sqlalchemy import create_engine
+
+
+def database_url():
+    db_uri = os.getenv('DATABASE_URL')
+    if not db_uri:
+        raise ValueError("No DATABASE_URL environment variable set. Please configure your database.")
+    if db_uri.startswith('postgres://'):
+        db_uri = db_uri.replace('postgres://', 'postgresql://', 1)
+    return db_uri
+
+
+def engine_options(db_uri, pool_size=5, max_overflow=10):
+    if 'postgresql' not in db_uri:
+        return {}
+    return {
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'connect_args': {
+            'connect_timeout': 5,
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 5
+        }
+    }
+
+
+def create_standalone_engine(pool_size=5, max_overflow=10):
+    db_uri = database_url()
+    return create_engine(db_uri, **engine_options(db_uri, pool_size, max_overflow))
+
+
+class EngineExecutor:
+    """Session-like execute() that checks out a connection per statement."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def execute(self, statement, parameters=None):
+        with self.engine.connect() as conn:
+            return conn.execute(statement, parameters).freeze()()
+
+    def rollback(self):
+        pass
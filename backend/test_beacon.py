@@ -0,0 +1,54 @@
+import io
+import json
+
+import pytest
+
+from engagement import engagement_buffer
+from routes.beacon import BEACON_MAX_BYTES
+
+TOKEN = '0123456789abcdef0123456789abcdef'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    from app import app
+    from scan_writer import scan_writer
+
+    monkeypatch.setattr(scan_writer, 'ensure_running', lambda: None)
+    monkeypatch.setattr(engagement_buffer, '_pending', {})
+    return app.test_client()
+
+
+@pytest.mark.parametrize('body', [
+    '{"token": "%s", "time_on_page": 1e999}' % TOKEN,
+    '{"token": "%s", "time_on_page": "Infinity"}' % TOKEN,
+    '{"token": "%s", "time_on_page": "-inf"}' % TOKEN,
+    '{"token": "%s", "time_on_page": NaN}' % TOKEN,
+])
+def test_non_finite_times_are_ignored(client, body):
+    response = client.post('/api/beacon', data=body, content_type='text/plain')
+    assert response.status_code == 204
+    assert engagement_buffer.pending() == 0
+
+
+def test_form_beacons_with_non_finite_times_are_ignored(client):
+    response = client.post('/api/beacon', data={'token': TOKEN, 'time_on_page': '1e999'})
+    assert response.status_code == 204
+    assert engagement_buffer.pending() == 0
+    response = client.post('/api/beacon', data={'token': TOKEN, 'time_on_page': '12.5', 'scrolled': 'true'})
+    assert response.status_code == 204
+    assert engagement_buffer._pending == {TOKEN: (12, True)}
+
+
+def _chunked(client, body):
+    # No Content-Length: the server only learns the size by reading.
+    return client.post('/api/beacon', input_stream=io.BytesIO(body), content_type='text/plain',
+                       headers={'Transfer-Encoding': 'chunked'}, environ_base={'wsgi.input_terminated': True})
+
+
+def test_chunked_bodies_are_read_up_to_the_limit(client):
+    report = json.dumps({'token': TOKEN, 'time_on_page': 30}).encode()
+    assert _chunked(client, report).status_code == 204
+    assert engagement_buffer.pending() == 1
+    padded = report + b' ' * BEACON_MAX_BYTES
+    assert _chunked(client, padded).status_code == 413
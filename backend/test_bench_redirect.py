@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_benchmark_redirects_the_seeded_code():
+    # The benchmark asserts every response is a 302 to its seeded code.
+    env = {k: v for k, v in os.environ.items() if k != 'DATABASE_URL'}
+    result = subprocess.run([sys.executable, os.path.join(BACKEND, 'bench_redirect.py'), '--requests', '50'],
+                            cwd=BACKEND, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert 'redirect_wsgi' in result.stdout
@@ -0,0 +1,38 @@
+import pytest
+
+from bot_filter import BotClassifier
+
+IPHONE = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'
+ANDROID = ('Mozilla/5.0 (Linux; Android 14; SM-S918B Build/UP1A.231005.007; wv) AppleWebKit/537.36 '
+           '(KHTML, like Gecko) Version/4.0 Chrome/120.0.6099.144 Mobile Safari/537.36')
+
+
+@pytest.fixture(scope='module')
+def classifier():
+    return BotClassifier(check_interval=0)
+
+
+@pytest.mark.parametrize('user_agent', [
+    IPHONE + ' Snapchat/12.61.0.39 (like Safari/8617.2.4.10.7, panda)',
+    ANDROID + ' Snapchat/12.63.0.56',
+    ANDROID + ' Viber/21.5.0.3',
+    IPHONE + ' Viber/21.5.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Mobile/15E148 Microsoft Office/2.79 (iOS/17.1; Phone; en-US; AppStore; Apple/iPhone15,2)',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 '
+    'Safari/537.36 Edg/120.0.0.0 OneOutlook/1.2023.1214.100',
+])
+def test_in_app_browsers_are_people(classifier, user_agent):
+    assert classifier.classify(user_agent) is None
+
+
+@pytest.mark.parametrize('user_agent', [
+    'Mozilla/5.0 (Linux; Android 10) Snapchat/10.65.5.0 (Bot)',
+    'SnapchatAds/1.0',
+    'Mozilla/5.0 (compatible; Snap URL Preview Service; +https://developers.snap.com/robots)',
+    'Mozilla/5.0 (Linux; Android 13) AppleWebKit/537.36 Viber/20.6.0.1 (preview)',
+    'Mozilla/4.0 (compatible; ms-office; MSOffice 16)',
+    'Microsoft Office Existence Discovery',
+])
+def test_app_link_fetchers_are_previews(classifier, user_agent):
+    assert classifier.classify(user_agent) == 'preview'
@@ -0,0 +1,25 @@
+from export_redirect_map import render_nginx_map
+
+
+def _codes(*short_codes):
+    return {c: {'id': i, 'target_url': f'https://example.com/{c}', 'location': f'https://example.com/{c}'}
+            for i, c in enumerate(short_codes)}
+
+
+def test_codes_differing_only_in_case_get_case_sensitive_keys():
+    body, skipped = render_nginx_map(_codes('aB3', 'Ab3', 'zz9'))
+    assert skipped == 0
+    assert body.splitlines() == [
+        'default "";',
+        '"~^Ab3$" "https://example.com/Ab3";',
+        '"~^aB3$" "https://example.com/aB3";',
+        '"zz9" "https://example.com/zz9";',
+    ]
+
+
+def test_unsafe_codes_and_targets_are_left_to_the_redirect_service():
+    codes = _codes('ok1', 'bad code')
+    codes['ok1']['location'] = 'https://example.com/$uri'
+    body, skipped = render_nginx_map(codes)
+    assert skipped == 2
+    assert body == 'default "";\n'
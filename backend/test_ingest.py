@@ -0,0 +1,94 @@
+import io
+import json
+
+import pytest
+
+from routes import ingest
+from routes.ingest import InvalidEvent, _iter_json_array
+
+DOCUMENT = json.dumps([
+    {"id": "kiosk-1", "short_code": "aB3", "user_agent": "Café ☃ [v1], {x}"},
+    12345.678,
+    -42,
+    [1, [2, "]"]],
+    "\U0001F600,\"quoted\"",
+    None,
+    True,
+    {"nested": {"time_on_page": 1e3}},
+], ensure_ascii=False, indent=1).encode()
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 5, 7, 64, 64 * 1024])
+def test_elements_survive_any_chunk_boundary(monkeypatch, read_size):
+    # Small reads split numbers, strings and multi-byte characters.
+    monkeypatch.setattr(ingest, '_READ_SIZE', read_size)
+    assert list(_iter_json_array(io.BytesIO(DOCUMENT))) == json.loads(DOCUMENT)
+
+
+@pytest.mark.parametrize('body', [b'[]', b'  [ ]  ', b'[\n]'])
+def test_empty_arrays(body):
+    assert list(_iter_json_array(io.BytesIO(body))) == []
+
+
+@pytest.mark.parametrize('body, message', [
+    (b'{"id": 1}', "Expected a JSON array"),
+    (b'[{"id": 1}, {"id": ', "Malformed JSON array"),
+    (b'[1, 2', "Unterminated JSON array"),
+    (b'[12x, 3]', "Malformed JSON array"),
+])
+def test_invalid_documents(monkeypatch, body, message):
+    monkeypatch.setattr(ingest, '_READ_SIZE', 3)
+    with pytest.raises(InvalidEvent, match=message):
+        list(_iter_json_array(io.BytesIO(body)))
+
+
+@pytest.fixture(scope='module')
+def client():
+    from flask_jwt_extended import create_access_token
+
+    from app import app
+    from models import QRCode, User, db
+
+    with app.app_context():
+        owners = {}
+        for email, short_code in (('owner@example.com', 'mine1'), ('other@example.com', 'theirs1')):
+            user = User(email=email)
+            user.set_password('x')
+            db.session.add(user)
+            db.session.flush()
+            qr = QRCode(name=short_code, target_url='https://example.com/', short_code=short_code, user_id=user.id)
+            db.session.add(qr)
+            db.session.flush()
+            owners[short_code] = (user.id, qr.id)
+        db.session.commit()
+        token = create_access_token(identity=str(owners['mine1'][0]))
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    client.owners = owners
+    return client
+
+
+def test_other_users_codes_are_rejected(client):
+    events = [
+        {'id': 'e1', 'short_code': 'theirs1'},
+        {'id': 'e2', 'qr_code_id': client.owners['theirs1'][1]},
+        {'id': 'e3', 'short_code': 'mine1'},
+    ]
+    response = client.post('/api/scans/ingest', json=events)
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert (summary['inserted'], summary['rejected']) == (1, 2)
+    assert [error['index'] for error in summary['errors']] == [0, 1]
+
+
+def test_events_without_an_id_need_an_idempotency_key(client):
+    event = {'short_code': 'mine1', 'timestamp': '2026-10-16T09:30:00Z', 'scan_method': 'nfc'}
+    summary = client.post('/api/scans/ingest', json=[event, event]).get_json()
+    assert (summary['inserted'], summary['rejected']) == (0, 2)
+    assert 'id is required' in summary['errors'][0]['error']
+
+    # With a key, identical events are told apart by their position.
+    response = client.post('/api/scans/ingest', json=[event, event], headers={'Idempotency-Key': 'batch-1'})
+    assert response.get_json()['inserted'] == 2
+    response = client.post('/api/scans/ingest', json=[event, event], headers={'Idempotency-Key': 'batch-1'})
+    assert response.get_json()['duplicates'] == 2
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from ingest_access_log import AccessLogIngester, Checkpoint
+
+
+def _line(second, code='abc'):
+    return json.dumps({'time': f'2026-10-16T12:00:{second:02d}+00:00', 'ip': '203.0.113.7', 'method': 'GET',
+                       'uri': f'/r/{code}', 'status': '302', 'ua': 'test', 'referer': '', 'target': 'x'}) + '\n'
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch):
+    log = tmp_path / 'qr_scans.log'
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    keys = []
+    monkeypatch.setattr(AccessLogIngester, 'handle', lambda self, fields, key: keys.append(key))
+
+    def run():
+        keys.clear()
+        AccessLogIngester(str(log), executor=None, checkpoint=checkpoint).run(once=True)
+        return list(keys)
+
+    return log, checkpoint, run
+
+
+def test_lines_after_copytruncate_get_new_keys(ingest):
+    log, _, run = ingest
+    log.write_text(_line(1) + _line(2))
+    first = run()
+    assert len(first) == 2
+    assert run() == []
+
+    # copytruncate: same inode, offsets start over with different lines.
+    log.write_text(_line(3) + _line(4) + _line(5))
+    second = run()
+    assert len(second) == 3
+    assert not set(first) & set(second)
+
+
+def test_truncation_to_the_same_length_is_noticed(ingest):
+    log, _, run = ingest
+    log.write_text(_line(1))
+    first = run()
+    log.write_text(_line(2))
+    second = run()
+    assert len(second) == 1
+    assert second != first
+
+
+def test_re_reading_after_a_lost_checkpoint_repeats_the_keys(ingest):
+    log, checkpoint, run = ingest
+    log.write_text(_line(1))
+    run()
+    saved = checkpoint.load()
+    with open(log, 'a') as f:
+        f.write(_line(2) + _line(3))
+    after = run()
+    checkpoint.save(*saved)  # as if the process died before saving
+    assert run() == after
@@ -0,0 +1,49 @@
+import importlib.util
+import os
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+VERSIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations', 'versions')
+
+
+def _migration(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(VERSIONS, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run(engine, step):
+    with engine.begin() as conn:
+        with Operations.context(MigrationContext.configure(conn)):
+            step()
+
+
+def test_scan_dimensions_turn_empty_strings_into_null(tmp_path):
+    engine = sa.create_engine(f'sqlite:///{tmp_path}/m.db')
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            "CREATE TABLE scans (id INTEGER PRIMARY KEY, qr_code_id INTEGER, ip_address VARCHAR(50), "
+            "user_agent TEXT, referrer_domain VARCHAR(200), device_type VARCHAR(50), "
+            "os_family VARCHAR(100), browser_family VARCHAR(100))"))
+        conn.execute(sa.text(
+            "INSERT INTO scans VALUES (1, 1, '', '', '', 'mobile', 'iOS', 'Safari'), "
+            "(2, 1, '8.8.8.8', 'curl/8', 'https://news.example.com/a', NULL, NULL, NULL)"))
+    migration = _migration('2026_10_16_add_scan_dimensions')
+    _run(engine, migration.upgrade)
+
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text(
+            "SELECT s.id, s.ip_address, s.user_agent_id, r.value, d.value FROM scans s "
+            "LEFT JOIN referrers r ON r.id = s.referrer_id "
+            "LEFT JOIN device_types d ON d.id = s.device_type_id ORDER BY s.id")).all()
+    assert rows[0] == (1, None, None, None, 'mobile')
+    assert rows[1][1:4] == ('8.8.8.8', rows[1][2], 'news.example.com')
+    assert rows[1][2] is not None
+
+    _run(engine, migration.downgrade)
+    with engine.connect() as conn:
+        assert conn.execute(sa.text("SELECT user_agent, referrer_domain FROM scans WHERE id = 2")).one() == (
+            'curl/8', 'news.example.com')
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import pytest
+
+import redirect_asgi
+from redirect_cache import ShortCodeEntry
+from scan_writer import scan_writer
+
+
+def _get(app, path):
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': path, 'client': ('203.0.113.7', 50000),
+        'headers': [(b'user-agent', b'TestAgent/1.0')],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await app(scope, receive, send)
+        return threading.get_ident()
+
+    return asyncio.run(run()), messages
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    async def resolve(short_code, engine):
+        return ShortCodeEntry(1, 'https://example.com/', 'https://example.com/')
+
+    calls = []
+
+    def record_scan(*args, block=True):
+        calls.append((threading.get_ident(), block))
+        return None
+
+    monkeypatch.setattr(redirect_asgi, 'resolve_short_code_async', resolve)
+    monkeypatch.setattr(redirect_asgi, 'record_scan', record_scan)
+    return calls
+
+
+def test_queued_scans_are_recorded_on_the_loop(monkeypatch, recorded):
+    monkeypatch.setattr(scan_writer, 'enabled', True)
+    loop_thread, messages = _get(redirect_asgi.RedirectApp(), '/r/abc')
+    assert messages[0]['status'] == 302
+    assert recorded == [(loop_thread, False)]
+
+
+def test_synchronous_scan_writes_leave_the_loop(monkeypatch, recorded):
+    monkeypatch.setattr(scan_writer, 'enabled', False)
+    loop_thread, messages = _get(redirect_asgi.RedirectApp(), '/r/abc')
+    assert messages[0]['status'] == 302
+    [(thread, _)] = recorded
+    assert thread != loop_thread
@@ -0,0 +1,25 @@
+from scan_dedup import DROP, ScanDeduplicator
+from scan_sampling import AdaptiveSampler
+
+T0 = 1_792_152_000.0  # 2026-10-16 12:00:00 UTC
+
+
+def test_replayed_scans_are_deduplicated_by_their_own_time():
+    dedup = ScanDeduplicator(mode=DROP, window=10)
+    # Replayed within a millisecond of each other, but a minute apart when scanned.
+    assert dedup.seen(1, '203.0.113.7', 'ua', 'first', now=T0) is None
+    assert dedup.seen(1, '203.0.113.7', 'ua', 'second', now=T0 + 60) is None
+    assert dedup.seen(1, '203.0.113.7', 'ua', 'third', now=T0 + 62) == 'second'
+
+
+def test_slightly_out_of_order_lines_stay_in_the_window():
+    dedup = ScanDeduplicator(mode=DROP, window=10)
+    assert dedup.seen(1, '203.0.113.7', 'ua', 'first', now=T0 + 5) is None
+    assert dedup.seen(1, '203.0.113.7', 'ua', 'second', now=T0 + 4) == 'first'
+
+
+def test_replayed_scans_are_sampled_at_their_own_rate():
+    sampler = AdaptiveSampler(threshold=2, window=60)
+    # One scan a minute for ten minutes is under the threshold however fast it is replayed.
+    assert [sampler.weight(1, now=T0 + 60 * i) for i in range(10)] == [1] * 10
+    assert sampler.sampled_out == 0
@@ -0,0 +1,64 @@
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture(scope='module')
+def client():
+    from app import app
+    from models import BrowserFamily, DeviceType, OsFamily, QRCode, Referrer, Scan, User, UserAgent, db
+
+    with app.app_context():
+        user = User(email='names@example.com')
+        user.set_password('x')
+        db.session.add(user)
+        db.session.flush()
+        qr = QRCode(name='names', target_url='https://example.com/', short_code='names1', user_id=user.id)
+        dimensions = [UserAgent(value='TestAgent/1.0'), DeviceType(value='iPhone'), OsFamily(value='iOS'),
+                      BrowserFamily(value='Mobile Safari'), Referrer(value='example.org')]
+        db.session.add_all([qr, *dimensions])
+        db.session.flush()
+        agent, device, os_family, browser, referrer = dimensions
+        for _ in range(3):
+            db.session.add(Scan(qr_code_id=qr.id, user_agent_id=agent.id, device_type_id=device.id,
+                                os_family_id=os_family.id, browser_family_id=browser.id, referrer_id=referrer.id))
+        db.session.commit()
+        client = app.test_client()
+        client.qr_id = qr.id
+        yield client
+
+
+@pytest.fixture
+def statements(client):
+    from models import db
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    yield captured
+    event.remove(engine, 'before_cursor_execute', capture)
+
+
+def test_scans_load_without_their_dimensions(client, statements):
+    from models import Scan
+
+    with client.application.app_context():
+        scans = Scan.query.filter_by(qr_code_id=client.qr_id).all()
+    assert len(scans) == 3
+    assert len(statements) == 1
+    assert 'JOIN' not in statements[0]
+
+
+def test_csv_export_joins_the_names_in_one_query(client, statements):
+    response = client.get('/api/qrcodes/scans-csv/names1')
+    assert response.status_code == 200
+    rows = response.get_data(as_text=True).splitlines()
+    assert len(rows) == 4
+    assert 'TestAgent/1.0,' in rows[1] and 'iPhone,iOS,Mobile Safari,example.org' in rows[1]
+    scan_selects = [statement for statement in statements if 'FROM scans' in statement]
+    assert len(scan_selects) == 1
+    assert not [statement for statement in statements if 'FROM user_agents' in statement]
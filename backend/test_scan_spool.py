@@ -0,0 +1,107 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from scan_spool import ScanSpool
+
+
+def _records(n, start=0):
+    return [{'qr_code_id': 1, 'timestamp': datetime(2026, 10, 16, 9, 0, i), 'ingest_key': f'k{i}'}
+            for i in range(start, start + n)]
+
+
+class _Table:
+    """Stands in for scans: a unique ingest_key, inserts that skip repeats."""
+
+    def __init__(self, fail_after=None):
+        self.rows = {}
+        self.calls = 0
+        self.fail_after = fail_after
+
+    def write(self, records):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise ConnectionError("database went away")
+        for record in records:
+            self.rows.setdefault(record['ingest_key'], record)
+
+
+def test_replaying_a_segment_twice_stores_each_scan_once(tmp_path):
+    spool = ScanSpool(str(tmp_path))
+    spool.append(_records(5))
+    spool.seal()
+    [name] = spool.pending()
+    kept = (tmp_path / name).read_bytes()
+    table = _Table()
+    assert spool.replay(table.write, chunk_size=2) == 5
+    # A crash before the segment was removed brings it back.
+    (tmp_path / name).write_bytes(kept)
+    spool.replay(table.write, chunk_size=2)
+    assert sorted(table.rows) == [f'k{i}' for i in range(5)]
+    assert table.rows['k3']['timestamp'] == datetime(2026, 10, 16, 9, 0, 3)
+    assert spool.pending() == []
+
+
+def test_a_failed_replay_keeps_the_segment_for_the_next_one(tmp_path):
+    spool = ScanSpool(str(tmp_path))
+    spool.append(_records(5))
+    spool.seal()
+    table = _Table(fail_after=1)
+    with pytest.raises(ConnectionError):
+        spool.replay(table.write, chunk_size=2)
+    assert len(spool.pending()) == 1
+    table.fail_after = None
+    spool.replay(table.write, chunk_size=2)
+    assert len(table.rows) == 5
+    assert spool.pending() == []
+
+
+def test_segments_claimed_by_a_dead_worker_are_released(tmp_path):
+    spool = ScanSpool(str(tmp_path))
+    spool.append(_records(2))
+    spool.seal()
+    [name] = spool.pending()
+    dead_pid = 2 ** 22 + 1  # above the default pid_max
+    os.replace(tmp_path / name, tmp_path / f'{name}.claim.{dead_pid}')
+    assert spool.pending() == []
+    spool.recover_orphans()
+    assert spool.pending() == [name]
+
+
+def test_corrupt_records_are_skipped(tmp_path):
+    spool = ScanSpool(str(tmp_path))
+    spool.append(_records(3))
+    spool.seal()
+    [name] = spool.pending()
+    lines = (tmp_path / name).read_text().splitlines(keepends=True)
+    lines[1] = lines[1].replace('k1', 'kX')
+    (tmp_path / name).write_text(''.join(lines))
+    table = _Table()
+    spool.replay(table.write)
+    assert sorted(table.rows) == ['k0', 'k2']
+    assert spool.corrupt == 1
+
+
+def test_a_refused_segment_is_set_aside(tmp_path):
+    from sqlalchemy.exc import IntegrityError
+
+    spool = ScanSpool(str(tmp_path))
+    for start in (0, 3, 6):
+        spool.append(_records(3, start))
+        spool.seal()
+    table = _Table()
+    write = table.write
+
+    def refuse_first_segment(records):
+        if records[0]['ingest_key'] == 'k0':
+            raise IntegrityError('INSERT INTO scans', {}, Exception('foreign key violation'))
+        write(records)
+
+    assert spool.replay(refuse_first_segment, rejected_errors=(IntegrityError,)) == 6
+    assert sorted(table.rows) == [f'k{i}' for i in range(3, 9)]
+    assert spool.pending() == []
+    assert len(spool.rejected()) == 1
+    assert spool.stats()['rejected_segments'] == 1
+    # Set aside for good: later replays leave it alone.
+    assert spool.replay(refuse_first_segment, rejected_errors=(IntegrityError,)) == 0
@@ -0,0 +1,176 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import insert, select
+
+from circuit_breaker import CircuitBreaker
+from scan_spool import ScanSpool
+from scan_writer import ScanWriter, copy_text_line
+
+
+def test_copy_text_line_keeps_null_apart_from_empty_string():
+    line = copy_text_line([7, None, '', 'a\tb\\c\nd', True, datetime(2026, 10, 16, 12, 30, 1)])
+    assert line == '7\t\\N\t\t' + 'a\\tb\\\\c\\nd' + '\tt\t2026-10-16 12:30:01\n'
+
+
+def test_copy_stores_missing_fields_as_null(postgres_engine, tmp_path):
+    from models import QRCode, Scan, User
+
+    with postgres_engine.begin() as conn:
+        user_id = conn.execute(insert(User.__table__).values(
+            email='copy@example.com', password_hash='x').returning(User.__table__.c.id)).scalar()
+        qr_id = conn.execute(insert(QRCode.__table__).values(
+            name='n', target_url='https://example.com/', short_code='copy1', user_id=user_id,
+        ).returning(QRCode.__table__.c.id)).scalar()
+    writer = ScanWriter(enabled=False, spool=ScanSpool(str(tmp_path)))
+    writer.init_engine(postgres_engine)
+    rows = writer._rows([
+        {'qr_code_id': qr_id, 'timestamp': datetime(2026, 10, 16), 'ip_address': None,
+         'user_agent': None, 'referrer_domain': None, 'scan_method': ''},
+    ])
+    writer._copy(rows)
+
+    scans = Scan.__table__
+    with postgres_engine.connect() as conn:
+        row = conn.execute(select(scans.c.ip_address, scans.c.user_agent_id, scans.c.referrer_id,
+                                  scans.c.scan_method, scans.c.scrolled)).one()
+    assert row == (None, None, None, '', False)
+    assert _scan_counts(postgres_engine) == [(date(2026, 10, 16), 1)]
+
+
+@pytest.fixture
+def sqlite_writer(tmp_path):
+    from sqlalchemy import create_engine
+
+    from extensions import db
+    from models import QRCode, User
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'scans.db'}")
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__).values(id=1, email='w@example.com', password_hash='x'))
+        conn.execute(insert(QRCode.__table__).values(
+            id=1, name='n', target_url='https://example.com/', short_code='w1', user_id=1))
+    writer = ScanWriter(enabled=False, spool=ScanSpool(str(tmp_path / 'spool')),
+                        breaker=CircuitBreaker(failure_threshold=1, reset_timeout=3600))
+    writer.init_engine(engine)
+    yield writer, engine
+    engine.dispose()
+
+
+def _scan_counts(engine):
+    from models import ScanCount
+
+    with engine.connect() as conn:
+        return conn.execute(select(ScanCount.__table__.c.day, ScanCount.__table__.c.count)).all()
+
+
+def test_replayed_scans_are_counted_once(sqlite_writer):
+    writer, engine = sqlite_writer
+    records = writer._rows([
+        {'qr_code_id': 1, 'timestamp': datetime(2026, 10, 16, 9), 'ingest_key': f'k{i}', 'scan_method': 'GET'}
+        for i in range(3)
+    ])
+    # The same segment twice, as after a crash between its insert and its removal.
+    for _ in range(2):
+        writer.spool.append(records)
+        writer.spool.seal()
+        writer.maintain()
+    assert writer.spool.pending() == []
+    assert _scan_counts(engine) == [(date(2026, 10, 16), 3)]
+
+
+def test_counters_outlive_a_stop_while_the_database_is_down(sqlite_writer):
+    from counters import aggregate_counters
+    from models import BotHit
+
+    writer, engine = sqlite_writer
+    writer.breaker.record_failure(reason='down')
+    aggregate_counters.add(BotHit.__table__, (1, date(2026, 10, 16), 'preview'), 2)
+    writer.stop()
+    assert aggregate_counters.pending() == 0
+    assert len(writer.spool.pending_counts()) == 1
+
+    writer.breaker = CircuitBreaker()
+    writer.maintain()
+    assert writer.spool.pending_counts() == []
+    with engine.connect() as conn:
+        assert conn.execute(select(BotHit.__table__.c.category, BotHit.__table__.c.count)).all() == [('preview', 2)]
+
+
+def test_a_refused_row_does_not_count_as_an_outage(sqlite_writer):
+    from circuit_breaker import CLOSED
+    from models import Scan
+
+    writer, engine = sqlite_writer
+    # qr_code_id is NOT NULL, so the database refuses the middle row.
+    writer._write([
+        {'qr_code_id': qr_id, 'timestamp': datetime(2026, 10, 16, 9), 'ingest_key': f'r{i}'}
+        for i, qr_id in enumerate([1, None, 1])
+    ])
+    assert writer.breaker.state == CLOSED
+    assert (writer.written, writer.rejected, writer.spooled) == (2, 1, 0)
+    assert writer.spool.pending() == [] and not writer.spool.has_open_segment()
+    with engine.connect() as conn:
+        assert conn.execute(select(Scan.__table__.c.ingest_key).order_by('ingest_key')).scalars().all() == ['r0', 'r2']
+    assert _scan_counts(engine) == [(date(2026, 10, 16), 2)]
+
+
+@pytest.mark.parametrize('use_copy', [True, False])
+def test_scans_of_a_deleted_code_are_dropped(postgres_engine, tmp_path, use_copy):
+    from circuit_breaker import CLOSED
+    from models import QRCode, Scan, User
+
+    with postgres_engine.begin() as conn:
+        user_id = conn.execute(insert(User.__table__).values(
+            email=f'deleted{use_copy}@example.com', password_hash='x').returning(User.__table__.c.id)).scalar()
+        qr_id = conn.execute(insert(QRCode.__table__).values(
+            name='n', target_url='https://example.com/', short_code=f'del{use_copy:d}', user_id=user_id,
+        ).returning(QRCode.__table__.c.id)).scalar()
+    writer = ScanWriter(enabled=False, use_copy=use_copy, spool=ScanSpool(str(tmp_path)),
+                        breaker=CircuitBreaker(failure_threshold=1, reset_timeout=3600))
+    writer.init_engine(postgres_engine)
+    writer._write([
+        {'qr_code_id': qr_id, 'timestamp': datetime(2026, 10, 16), 'user_agent': 'A', 'ingest_key': f'ok{use_copy}'},
+        {'qr_code_id': qr_id + 1000, 'timestamp': datetime(2026, 10, 16), 'ingest_key': f'gone{use_copy}'},
+    ])
+    assert writer.breaker.state == CLOSED
+    assert (writer.written, writer.rejected, writer.spooled) == (1, 1, 0)
+    with postgres_engine.connect() as conn:
+        keys = conn.execute(select(Scan.__table__.c.ingest_key).where(Scan.__table__.c.qr_code_id == qr_id)).scalars()
+        assert keys.all() == [f'ok{use_copy}']
+
+
+def test_a_refused_spooled_row_does_not_block_the_spool(sqlite_writer):
+    writer, engine = sqlite_writer
+    bad = writer._rows([{'qr_code_id': None, 'timestamp': datetime(2026, 10, 16, 9), 'ingest_key': 'bad'},
+                        {'qr_code_id': 1, 'timestamp': datetime(2026, 10, 16, 9), 'ingest_key': 'good1'}])
+    good = writer._rows([{'qr_code_id': 1, 'timestamp': datetime(2026, 10, 16, 9), 'ingest_key': 'good2'}])
+    for rows in (bad, good):
+        writer.spool.append(rows)
+        writer.spool.seal()
+    writer.maintain()
+    assert writer.spool.pending() == []
+    assert writer.rejected == 1
+    assert _scan_counts(engine) == [(date(2026, 10, 16), 2)]
+
+
+def test_synchronous_writes_leave_enrichment_to_the_thread(sqlite_writer, monkeypatch):
+    import threading
+    import time
+
+    import scan_writer
+
+    writer, engine = sqlite_writer
+    writer.replay_interval = 0.01
+    threads = []
+    monkeypatch.setattr(scan_writer.scan_enricher, 'enrich_pending',
+                        lambda engine: threads.append(threading.current_thread().name))
+    for i in range(3):
+        assert writer.enqueue({'qr_code_id': 1, 'ingest_key': f's{i}'})
+    assert writer.written == 3
+    deadline = time.monotonic() + 5
+    while not threads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.stop()
+    assert threads and set(threads) == {'scan-writer'}
@@ -0,0 +1,61 @@
+import pytest
+from sqlalchemy import create_engine, select
+
+from short_code_allocator import BASE, FeistelPermutation, ShortCodeAllocator, base62_decode, base62_encode
+
+
+@pytest.fixture
+def engine(tmp_path):
+    from extensions import db
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocator.db'}")
+    db.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def _counter(engine):
+    from models import ShortCodeCounter
+
+    with engine.connect() as conn:
+        return conn.execute(select(ShortCodeCounter.__table__.c.next_id)).scalar()
+
+
+def test_codes_come_from_one_reserved_block(engine):
+    allocator = ShortCodeAllocator(block_size=10)
+    codes = [allocator.allocate(engine) for _ in range(11)]
+    # The first call reserves 1 + block_size numbers; the 12th would need another.
+    assert allocator.reservations == 1
+    assert [base62_decode(code) for code in codes] == list(range(1, 12))
+    assert _counter(engine) == 12
+    allocator.allocate(engine)
+    assert allocator.reservations == 2
+    assert _counter(engine) == 23
+
+
+def test_workers_never_share_a_number(engine):
+    first, second = ShortCodeAllocator(block_size=5), ShortCodeAllocator(block_size=5)
+    codes = []
+    for _ in range(8):
+        codes += first.allocate_many(3, engine) + second.allocate_many(2, engine)
+    assert len(codes) == len(set(codes)) == 40
+
+
+def test_large_requests_reserve_what_they_need(engine):
+    allocator = ShortCodeAllocator(block_size=4)
+    assert len(set(allocator.allocate_many(25, engine))) == 25
+    assert allocator.reservations == 1
+    assert allocator.stats()['reserved'] == 4
+
+
+def test_scrambled_codes_are_fixed_length_and_distinct(engine):
+    allocator = ShortCodeAllocator(block_size=50, key='secret', length=4)
+    codes = allocator.allocate_many(50, engine)
+    assert {len(code) for code in codes} == {4}
+    assert len(set(codes)) == 50
+
+
+def test_permutation_is_a_bijection():
+    permute = FeistelPermutation('secret', 1000)
+    assert sorted(permute(value) for value in range(1000)) == list(range(1000))
+    assert base62_encode(BASE ** 2) == '100'
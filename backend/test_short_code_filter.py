@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert, update
+
+from short_code_filter import ShortCodeFilter
+from standalone_db import EngineExecutor
+
+T0 = datetime(2026, 10, 16, 12, 0, 0)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    from extensions import db
+    from models import User
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'filter.db'}")
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__).values(id=1, email='f@example.com', password_hash='x'))
+    yield engine
+    engine.dispose()
+
+
+def _add_code(engine, id_, short_code, created_at):
+    from models import QRCode
+
+    with engine.begin() as conn:
+        conn.execute(insert(QRCode.__table__).values(
+            id=id_, name=short_code, target_url='https://example.com/', short_code=short_code,
+            user_id=1, created_at=created_at, updated_at=created_at,
+        ))
+
+
+def _catch_up(code_filter, executor):
+    return code_filter.apply_catch_up(executor.execute(*code_filter.catch_up_query()).all())
+
+
+def test_catch_up_finds_a_lower_id_that_committed_late(engine):
+    executor = EngineExecutor(engine)
+    _add_code(engine, 1, 'old', T0)
+    _add_code(engine, 3, 'early', T0 + timedelta(seconds=2))
+    code_filter = ShortCodeFilter(capacity=100, catch_up_interval=0, commit_lag=30)
+    code_filter.load(executor)
+    assert 'late' not in code_filter
+
+    # id 2 was taken before id 3 but its transaction committed after the load.
+    _add_code(engine, 2, 'late', T0 + timedelta(seconds=1))
+    assert code_filter.might_exist('late', executor)
+
+
+def test_catch_up_counts_each_code_once(engine):
+    from models import QRCode
+
+    executor = EngineExecutor(engine)
+    _add_code(engine, 1, 'old', T0 - timedelta(hours=1))
+    code_filter = ShortCodeFilter(capacity=100, catch_up_interval=0, commit_lag=30)
+    code_filter.load(executor)
+    _add_code(engine, 2, 'new', T0)
+    assert _catch_up(code_filter, executor)
+    # Re-read inside the overlap window, and an old code edited: neither is new.
+    with engine.begin() as conn:
+        conn.execute(update(QRCode.__table__).where(QRCode.__table__.c.id == 1).values(updated_at=T0))
+    assert not _catch_up(code_filter, executor)
+    assert code_filter.stats()['codes'] == 2
+
+    code_filter.remove('new')
+    assert 'new' not in code_filter
+    assert 'old' in code_filter
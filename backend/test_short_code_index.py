@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import create_engine, delete, insert, update
+
+from short_code_index import ShortCodeIndex, _read_entries, write_index
+from standalone_db import EngineExecutor
+
+
+def test_urls_too_long_for_a_record_are_left_out(tmp_path):
+    path = str(tmp_path / 'codes.idx')
+    long_url = 'https://example.com/?q=' + 'x' * 70000
+    assert write_index(path, {'ok': (1, 'https://example.com/'), 'long': (2, long_url)}) == 1
+    index = ShortCodeIndex(path)
+    assert index.lookup('ok') == (1, 'https://example.com/', 'https://example.com/')
+    assert index.lookup('long') is None
+
+
+@pytest.fixture
+def node(tmp_path, monkeypatch):
+    """A worker with the shared index enabled, reading from a SQLite database."""
+    from extensions import db
+    from models import QRCode, User
+    from collections import OrderedDict
+
+    from redirect_cache import redirect_cache
+    from short_code_filter import negative_cache, short_code_filter
+    from short_code_index import short_code_index
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'index.db'}")
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__).values(id=1, email='i@example.com', password_hash='x'))
+        conn.execute(insert(QRCode.__table__).values(
+            id=1, name='n', target_url='https://example.com/old', short_code='abc', user_id=1))
+    monkeypatch.setattr(short_code_index, 'path', str(tmp_path / 'codes.idx'))
+    monkeypatch.setattr(short_code_index, '_mapping', None)
+    monkeypatch.setattr(redirect_cache, 'ttl', 0)  # every entry is due for a check
+    monkeypatch.setattr(short_code_filter, '_bloom', None)  # unloaded: every code may exist
+    monkeypatch.setattr(negative_cache, '_data', OrderedDict())
+    short_code_index.rebuild([('abc', 1, 'https://example.com/old')])
+    redirect_cache.clear()
+    yield engine, EngineExecutor(engine), short_code_index
+    redirect_cache.clear()
+    engine.dispose()
+
+
+def test_index_hits_are_checked_against_the_database_after_the_ttl(node):
+    from models import QRCode
+    from redirect_cache import resolve_short_code
+
+    engine, executor, index = node
+    # Edited on another node: this node's index still has the old target.
+    with engine.begin() as conn:
+        conn.execute(update(QRCode.__table__).values(target_url='https://example.com/new'))
+    assert resolve_short_code('abc', executor).target_url == 'https://example.com/old'
+    assert resolve_short_code('abc', executor).target_url == 'https://example.com/new'
+    index.flush()
+    assert _read_entries(index.path) == {'abc': (1, 'https://example.com/new')}
+
+
+def test_codes_deleted_elsewhere_leave_the_index(node):
+    from models import QRCode
+    from redirect_cache import resolve_short_code
+
+    engine, executor, index = node
+    with engine.begin() as conn:
+        conn.execute(delete(QRCode.__table__))
+    resolve_short_code('abc', executor)
+    assert resolve_short_code('abc', executor) is None
+    index.flush()
+    assert _read_entries(index.path) == {}
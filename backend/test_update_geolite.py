@@ -0,0 +1,136 @@
+import io
+import os
+import tarfile
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+mmdb_writer = pytest.importorskip('mmdb_writer')
+from netaddr import IPSet  # noqa: E402 (installed with mmdb-writer)
+
+import update_geolite  # noqa: E402
+from geoip_lookup import GeoLocator  # noqa: E402
+
+
+def _archive(tmp_path, city, database_type='GeoLite2-City'):
+    """A GeoLite2-style tar.gz whose database places 8.8.8.0/24 in city."""
+    writer = mmdb_writer.MMDBWriter(ip_version=6, database_type=database_type, ipv4_compatible=True)
+    writer.insert_network(IPSet(['8.8.8.0/24']), {
+        'country': {'names': {'en': 'United States'}, 'iso_code': 'US'},
+        'city': {'names': {'en': city}},
+    })
+    path = tmp_path / f'{city}.mmdb'
+    writer.to_db_file(str(path))
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        tar.add(str(path), arcname='GeoLite2-City_20261016/GeoLite2-City.mmdb')
+    return buf.getvalue()
+
+
+class _Release:
+    """What the stand-in download server currently serves."""
+
+    def __init__(self):
+        self.body = b''
+        self.etag = None
+        self.last_modified = None
+        self.requests = []
+
+    def publish(self, body, etag=None, modified=0):
+        self.body = body
+        self.etag = etag
+        self.last_modified = formatdate(1_792_152_000 + modified, usegmt=True)
+
+
+@pytest.fixture
+def release(tmp_path, monkeypatch):
+    release = _Release()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            release.requests.append(dict(self.headers))
+            if (release.etag and self.headers.get('If-None-Match') == release.etag) or (
+                    not release.etag and self.headers.get('If-Modified-Since') == release.last_modified):
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            if release.etag:
+                self.send_header('ETag', release.etag)
+            self.send_header('Last-Modified', release.last_modified)
+            self.send_header('Content-Length', str(len(release.body)))
+            self.end_headers()
+            self.wfile.write(release.body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    output = str(tmp_path / 'geo' / 'GeoLite2-City.mmdb')
+    os.makedirs(os.path.dirname(output))
+    monkeypatch.setattr(update_geolite, 'DOWNLOAD_URL', f'http://127.0.0.1:{server.server_port}/GeoLite2-City.tar.gz')
+    monkeypatch.setattr(update_geolite, 'OUTPUT_FILE', output)
+    monkeypatch.setattr(update_geolite, 'META_FILE', output + '.meta.json')
+    yield release
+    server.shutdown()
+    server.server_close()
+
+
+def test_unchanged_release_is_not_downloaded_again(tmp_path, release):
+    release.publish(_archive(tmp_path, 'Old Town'), etag='"v1"')
+    assert update_geolite.update_geolite()
+    assert not update_geolite.update_geolite()
+    assert release.requests[-1]['If-None-Match'] == '"v1"'
+
+
+def test_last_modified_is_used_without_an_etag(tmp_path, release):
+    release.publish(_archive(tmp_path, 'Old Town'))
+    assert update_geolite.update_geolite()
+    assert not update_geolite.update_geolite()
+    assert release.requests[-1]['If-Modified-Since'] == release.last_modified
+
+
+def test_new_release_replaces_the_file_in_one_step(tmp_path, release):
+    release.publish(_archive(tmp_path, 'Old Town'), etag='"v1"')
+    update_geolite.update_geolite()
+    old_inode = os.stat(update_geolite.OUTPUT_FILE).st_ino
+
+    release.publish(_archive(tmp_path, 'New Town'), etag='"v2"', modified=86400)
+    assert update_geolite.update_geolite()
+    # Renamed over the old file, which lives on as the backup.
+    assert os.stat(update_geolite.OUTPUT_FILE).st_ino != old_inode
+    directory = os.path.dirname(update_geolite.OUTPUT_FILE)
+    backups = [name for name in os.listdir(directory) if '.bak.' in name]
+    assert len(backups) == 1
+    assert os.stat(os.path.join(directory, backups[0])).st_ino == old_inode
+    assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_a_bad_release_leaves_the_database_alone(tmp_path, release):
+    release.publish(_archive(tmp_path, 'Old Town'), etag='"v1"')
+    update_geolite.update_geolite()
+    before = os.stat(update_geolite.OUTPUT_FILE)
+
+    release.publish(_archive(tmp_path, 'Elsewhere', database_type='GeoLite2-ASN'), etag='"v2"')
+    with pytest.raises(ValueError):
+        update_geolite.update_geolite()
+    after = os.stat(update_geolite.OUTPUT_FILE)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    directory = os.path.dirname(update_geolite.OUTPUT_FILE)
+    assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_running_locator_switches_to_the_new_release(tmp_path, release):
+    release.publish(_archive(tmp_path, 'Old Town'), etag='"v1"')
+    update_geolite.update_geolite()
+    locator = GeoLocator(update_geolite.OUTPUT_FILE, check_interval=0)
+    assert locator.locate('8.8.8.8').city == 'Old Town'
+
+    release.publish(_archive(tmp_path, 'New Town'), etag='"v2"', modified=86400)
+    update_geolite.update_geolite()
+    assert locator.locate('8.8.8.8').city == 'New Town'
+    assert locator.stats()['reloads'] == 1
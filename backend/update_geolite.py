@@ -1,70 +1,161 @@
 #!/usr/bin/env python3
+"""Download the GeoLite2 City database and swap it in without downtime.
+
+The archive is requested conditionally (If-None-Match / If-Modified-Since
+from the previous download, kept in <database>.meta.json), so an unchanged
+release costs one 304. A new release is extracted straight from the
+response stream into a temporary file next to the database, opened and
+checked, and then renamed over the live file in one step. Running
+workers notice the new file (see geoip_lookup.py) and switch readers
+without missing a lookup. The previous file is kept as a dated backup.
+
+Set GEOLITE_DOWNLOAD_URL to fetch from elsewhere, e.g. a local
+`python -m http.server` serving a test archive.
+"""
+import json
 import os
 import shutil
 import tarfile
+import tempfile
+import urllib.error
 import urllib.request
 from datetime import datetime
 from typing import Optional
 
+import maxminddb
+
 # Configuration
 ACCOUNT_ID = os.getenv('MAXMIND_ACCOUNT_ID')
 LICENSE_KEY = os.getenv('MAXMIND_LICENSE_KEY')
-DOWNLOAD_URL = "https://download.maxmind.com/geoip/databases/GeoLite2-City/download?suffix=tar.gz"
+DOWNLOAD_URL = os.getenv(
+    'GEOLITE_DOWNLOAD_URL',
+    "https://download.maxmind.com/geoip/databases/GeoLite2-City/download?suffix=tar.gz",
+)
 OUTPUT_DIR = os.path.dirname(os.path.abspath(__file__))
-OUTPUT_FILE = os.path.join(OUTPUT_DIR, 'GeoLite2-City.mmdb')
+OUTPUT_FILE = os.getenv('GEOIP_DB_PATH', os.path.join(OUTPUT_DIR, 'GeoLite2-City.mmdb'))
+META_FILE = OUTPUT_FILE + '.meta.json'
+
+
+def load_meta() -> dict:
+    """Validators of the last installed download, if any."""
+    if not os.path.exists(OUTPUT_FILE):
+        return {}
+    try:
+        with open(META_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
 
-def download_file(url: str, output_path: str) -> str:
-    """Download a file from a URL to the specified path"""
+def save_meta(meta: dict) -> None:
+    tmp = META_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, META_FILE)
+
+
+def open_download(url: str, meta: dict):
+    """The response for a changed archive, or None if it is unchanged."""
     print(f"Downloading {url}...")
     req = urllib.request.Request(url)
     if ACCOUNT_ID and LICENSE_KEY:
         import base64
         credentials = base64.b64encode(f"{ACCOUNT_ID}:{LICENSE_KEY}".encode()).decode()
         req.add_header('Authorization', f'Basic {credentials}')
-    
-    with urllib.request.urlopen(req) as response, open(output_path, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
-    return output_path
-
-def extract_mmdb(tar_path: str, output_path: str) -> None:
-    """Extract the .mmdb file from the downloaded tar.gz"""
-    print(f"Extracting {tar_path}...")
-    with tarfile.open(tar_path, 'r:gz') as tar:
-        for member in tar.getmembers():
-            if member.name.endswith('.mmdb'):
-                member.name = os.path.basename(member.name)  # Remove directory structure
-                tar.extract(member, path=os.path.dirname(output_path))
-                os.rename(
-                    os.path.join(os.path.dirname(output_path), member.name),
-                    output_path
-                )
-                break
-
-def update_geolite() -> None:
-    """Update the GeoLite2 database"""
+    if meta.get('etag'):
+        req.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        req.add_header('If-Modified-Since', meta['last_modified'])
     try:
-        # Create a temporary file
-        temp_tar = os.path.join(OUTPUT_DIR, 'geolite_temp.tar.gz')
-        
-        # Download the database
-        download_file(DOWNLOAD_URL, temp_tar)
-        
-        # Backup old database if it exists
-        if os.path.exists(OUTPUT_FILE):
-            backup_file = f"{OUTPUT_FILE}.bak.{datetime.now().strftime('%Y%m%d')}"
-            os.rename(OUTPUT_FILE, backup_file)
-            print(f"Backed up old database to {backup_file}")
-        
-        # Extract the new database
-        extract_mmdb(temp_tar, OUTPUT_FILE)
-        
-        # Clean up
-        os.remove(temp_tar)
-        print(f"Successfully updated GeoLite2 database at {OUTPUT_FILE}")
-        
-    except Exception as e:
-        print(f"Error updating GeoLite2 database: {str(e)}")
+        return urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
         raise
 
+
+def extract_mmdb(stream, directory: str) -> str:
+    """Stream the .mmdb member of a tar.gz into a temporary file in directory."""
+    print("Extracting...")
+    with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.mmdb'):
+                continue
+            fd, tmp_path = tempfile.mkstemp(prefix='.GeoLite2-City.', suffix='.mmdb.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as out_file:
+                    shutil.copyfileobj(tar.extractfile(member), out_file, 1024 * 1024)
+                    out_file.flush()
+                    os.fsync(out_file.fileno())
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return tmp_path
+    raise ValueError("Archive contains no .mmdb file")
+
+
+def verify_mmdb(path: str) -> str:
+    """Open the database and run a lookup; returns its description."""
+    reader = maxminddb.open_database(path, maxminddb.MODE_FILE)
+    try:
+        metadata = reader.metadata()
+        if 'City' not in metadata.database_type:
+            raise ValueError(f"Unexpected database type {metadata.database_type!r}")
+        if metadata.node_count <= 0:
+            raise ValueError("Database has no records")
+        reader.get('8.8.8.8')
+    finally:
+        reader.close()
+    built = datetime.utcfromtimestamp(metadata.build_epoch).strftime('%Y-%m-%d')
+    return f"{metadata.database_type} built {built}"
+
+
+def install(tmp_path: str) -> Optional[str]:
+    """Atomically replace OUTPUT_FILE with tmp_path; returns the backup path."""
+    backup_file = None
+    if os.path.exists(OUTPUT_FILE):
+        backup_file = f"{OUTPUT_FILE}.bak.{datetime.now().strftime('%Y%m%d')}"
+        if os.path.exists(backup_file):
+            os.remove(backup_file)
+        try:
+            os.link(OUTPUT_FILE, backup_file)
+        except OSError:
+            shutil.copy2(OUTPUT_FILE, backup_file)
+    os.replace(tmp_path, OUTPUT_FILE)
+    return backup_file
+
+
+def update_geolite() -> bool:
+    """Update the GeoLite2 database; returns False if it was already current."""
+    meta = load_meta()
+    response = open_download(DOWNLOAD_URL, meta)
+    if response is None:
+        print(f"GeoLite2 database at {OUTPUT_FILE} is up to date")
+        return False
+    with response:
+        headers = response.headers
+        tmp_path = extract_mmdb(response, os.path.dirname(OUTPUT_FILE))
+    try:
+        description = verify_mmdb(tmp_path)
+        backup_file = install(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if backup_file:
+        print(f"Backed up old database to {backup_file}")
+    save_meta({
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'installed_at': datetime.utcnow().isoformat(),
+    })
+    print(f"Successfully updated GeoLite2 database at {OUTPUT_FILE} ({description})")
+    return True
+
+
 if __name__ == '__main__':
-    update_geolite()
+    try:
+        update_geolite()
+    except Exception as e:
+        print(f"Error updating GeoLite2 database: {str(e)}")
+        raise
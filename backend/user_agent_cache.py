@@ -0,0 +1,44 @@
+"""Memoized user-agent parsing for scan records.
+
+user_agents.parse runs a cascade of regexes for the device, OS and browser
+on every call, but a few thousand distinct strings cover nearly all scans.
+Each worker keeps the (device_type, os_family, browser_family) triple for
+recently seen strings in a bounded LRU; functools.lru_cache is thread-safe,
+so the threads of a gthread worker share one cache.
+"""
+import functools
+import os
+from collections import namedtuple
+
+from user_agents import parse
+
+UserAgentFamilies = namedtuple('UserAgentFamilies', ['device_type', 'os_family', 'browser_family'])
+
+
+class UserAgentParser:
+
+    def __init__(self, cache_size=4096):
+        self._families = functools.lru_cache(maxsize=cache_size)(self._parse_uncached)
+
+    def families(self, user_agent):
+        """The device, OS and browser families for a User-Agent string."""
+        return self._families(user_agent or '')
+
+    @staticmethod
+    def _parse_uncached(user_agent):
+        parsed = parse(user_agent)
+        return UserAgentFamilies(parsed.device.family, parsed.os.family, parsed.browser.family)
+
+    def stats(self):
+        info = self._families.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'cache_hits': info.hits,
+            'cache_misses': info.misses,
+            'hit_rate': round(info.hits / lookups, 4) if lookups else None,
+            'cache_size': info.currsize,
+            'max_size': info.maxsize,
+        }
+
+
+user_agent_parser = UserAgentParser(cache_size=int(os.getenv('UA_CACHE_SIZE', 4096)))